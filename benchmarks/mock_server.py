@@ -0,0 +1,206 @@
+"""
+Local stand-in for the SecureBox API, used by the benchmarks. It implements the endpoints used by the client with the
+same request and response formats, but it has no limits on the size or number of files. Uploaded files are stored
+in a temporary directory, so files of several GB can be sent without holding them in memory.
+
+It can also be run on its own, to point the client at it (setting API.base_url to the printed URL):
+
+    python benchmarks/mock_server.py [--port 8765]
+"""
+import argparse
+import json
+import os
+import secrets
+import shutil
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MockServer:
+    """
+    SecureBox API served from a background thread. Use it as a context manager, or call start and stop
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+        :param host: address to listen on
+        :param port: port to listen on. If 0, a free one is chosen
+        """
+        self.folder = tempfile.mkdtemp(prefix="securebox-mock-")
+        # userID -> user (as returned by /users/search), fileID -> (file name, path of the body, start, end)
+        self.users = {}
+        self.files = {}
+        self.lock = Lock()
+        self._server = ThreadingHTTPServer((host, port), _handler_class(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        :return: URL to be used as API.base_url
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def _handler_class(server: MockServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, obj, status: int = 200):
+            body = json.dumps(obj).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_code(self, error_code: str):
+            self.send_json({"error_code": error_code, "description": error_code}, status=401)
+
+        def read_body(self, output):
+            # The client always sends Content-Length (MultipartStream knows its length)
+            remaining = int(self.headers.get("Content-Length", 0))
+            while remaining:
+                chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    break
+                output.write(chunk)
+                remaining -= len(chunk)
+
+        def do_GET(self):
+            if self.path.endswith("/files/list"):
+                with server.lock:
+                    files = [{"fileID": file_id, "fileName": name} for file_id, (name, *_) in server.files.items()]
+                self.send_json({"num_files": len(files), "files_list": files})
+            else:
+                self.send_error_code("ARGS1")
+
+        def do_POST(self):
+            endpoint = self.path[self.path.find("/api") + len("/api"):]
+            if endpoint == "/files/upload":
+                return self.upload()
+
+            with tempfile.SpooledTemporaryFile() as f:
+                self.read_body(f)
+                f.seek(0)
+                try:
+                    body = json.load(f)
+                except ValueError:
+                    return self.send_error_code("ARGS1")
+
+            if endpoint == "/users/register":
+                user_id = str(secrets.randbelow(10 ** 6))
+                user = {"userID": user_id, "nombre": body["nombre"], "email": body["email"],
+                        "publicKey": body["publicKey"], "ts": time.time()}
+                with server.lock:
+                    server.users[user_id] = user
+                self.send_json({"userID": user_id, "ts": user["ts"]})
+            elif endpoint == "/users/search":
+                with server.lock:
+                    users = [user for user in server.users.values()
+                             if body["data_search"] in user["nombre"] or body["data_search"] in user["email"]]
+                self.send_json(users)
+            elif endpoint == "/users/getPublicKey":
+                user = server.users.get(body["userID"])
+                if user is None:
+                    return self.send_error_code("USER_ID1")
+                self.send_json({"publicKey": user["publicKey"]})
+            elif endpoint == "/users/delete":
+                with server.lock:
+                    server.users.pop(body["userID"], None)
+                self.send_json({"userID": body["userID"]})
+            elif endpoint == "/files/download":
+                self.download(body["file_id"])
+            elif endpoint == "/files/delete":
+                with server.lock:
+                    file = server.files.pop(body["file_id"], None)
+                if file is None:
+                    return self.send_error_code("FILE2")
+                os.remove(file[1])
+                self.send_json({"file_id": body["file_id"]})
+            else:
+                self.send_error_code("ARGS1")
+
+        def upload(self):
+            # The whole body is stored, and the file is located inside it afterwards: the multipart header is at
+            # the beginning and the closing boundary at the end
+            file_id = secrets.token_hex(4)
+            path = os.path.join(server.folder, file_id)
+            with open(path, "w+b") as f:
+                self.read_body(f)
+                size = f.tell()
+                f.seek(0)
+                head = f.read(CHUNK_SIZE)
+
+            boundary = self.headers["Content-Type"].split("boundary=")[1].encode()
+            start = head.find(b"\r\n\r\n") + len(b"\r\n\r\n")
+            end = size - len(b"\r\n--" + boundary + b"--\r\n")
+            name = head[head.find(b'filename="') + len(b'filename="'):]
+            name = name[:name.find(b'"')].decode()
+
+            with server.lock:
+                server.files[file_id] = (name, path, start, end)
+            self.send_json({"file_id": file_id, "file_size": end - start})
+
+        def download(self, file_id: str):
+            file = server.files.get(file_id)
+            if file is None:
+                return self.send_error_code("FILE2")
+
+            name, path, start, end = file
+            self.send_response(200)
+            self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = end - start
+                while remaining:
+                    chunk = f.read(min(remaining, CHUNK_SIZE))
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a local stand-in for the SecureBox API")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (8765 by default)")
+    args = parser.parse_args()
+
+    with MockServer(port=args.port) as server:
+        print(f"Listening on {server.url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Benchmarks of sb_crypto and of the SecureBoxClient pipelines, the latter run against a local mock server
+(benchmarks/mock_server.py). Each case is run in its own process, so that its peak RSS is not affected by the
+others. The results are written as JSON, and can be compared with the ones of a previous version:
+
+    python benchmarks/run_benchmarks.py --sizes 1K 1M 64M --key_sizes 2048 4096 --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json --threshold 0.1
+
+With --baseline, it exits with status 1 if the throughput of any case has dropped more than the threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from typing import Callable, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Benchmarks whose inputs are held in memory, which are only run up to --max_memory_size
+MESSAGE_BENCHMARKS = ["sign_message", "verify_signature", "encrypt_message", "decrypt_message",
+                      "encrypt_framed_message", "decrypt_framed_message"]
+# Benchmarks that stream files from disk, which can be run with files of several GB
+FILE_BENCHMARKS = ["encrypt_file", "decrypt_file", "encrypt_file_mmap", "decrypt_file_mmap"]
+# End-to-end benchmarks against the mock server
+CLIENT_BENCHMARKS = ["upload", "download", "decrypt_helper"]
+BENCHMARKS = ["rsa_generate_key"] + MESSAGE_BENCHMARKS + FILE_BENCHMARKS + CLIENT_BENCHMARKS
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(size: str) -> int:
+    """
+    :param size: number of bytes, optionally followed by K, M or G
+    :return: the number of bytes
+    """
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1] if size[-1] in UNITS else ""
+    return int(float(size[:len(size) - len(unit)]) * UNITS[unit])
+
+
+def write_random_file(filename: str, size: int):
+    with open(filename, "wb") as f:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(remaining, 1024 ** 2))
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def peak_rss_mb() -> float:
+    """
+    :return: maximum resident set size of the current process so far, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports it in KB, macOS in bytes
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def prepare(benchmark: str, size: int, key_size: int, threads: int, url: str) -> Callable[[], None]:
+    """
+    Prepares the inputs of a benchmark. Only the function returned is timed
+    :param threads: threads used by the benchmarks of the framed format
+    :param url: URL of the mock server (only used by the client benchmarks)
+    :return: function that runs the operation measured once
+    """
+    from sb_crypto.sb_crypto import (decrypt_framed_message, decrypt_message, encrypt_framed_message,
+                                     encrypt_message, read_chunks, rsa_generate_key, sign_message, verify_signature)
+
+    if benchmark == "rsa_generate_key":
+        return lambda: rsa_generate_key(key_size)
+
+    key = rsa_generate_key(key_size)
+    public_key = key.publickey()
+
+    if benchmark in MESSAGE_BENCHMARKS:
+        message = os.urandom(size)
+        if benchmark == "sign_message":
+            return lambda: sign_message(message, key)
+        if benchmark == "verify_signature":
+            signed_message = sign_message(message, key) + message
+            return lambda: verify_signature(signed_message, public_key)
+        if benchmark == "encrypt_message":
+            return lambda: encrypt_message(message, public_key)
+        if benchmark == "encrypt_framed_message":
+            return lambda: encrypt_framed_message(message, public_key, key, workers=threads)
+        if benchmark == "decrypt_framed_message":
+            framed_message = encrypt_framed_message(message, public_key, key)
+            return lambda: decrypt_framed_message(framed_message, key, public_key, workers=threads)
+        encrypted_message = encrypt_message(sign_message(message, key) + message, public_key)
+        return lambda: decrypt_message(encrypted_message, key)
+
+    from securebox import SecureBoxClient, decrypt_file, decrypt_file_mmap, encrypt_file, encrypt_file_mmap
+
+    write_random_file("file", size)
+    if benchmark in FILE_BENCHMARKS:
+        with open("file.crypt", "wb") as f:
+            encrypt_file("file", f, key, public_key)
+        if benchmark == "encrypt_file":
+            def encrypt():
+                with open("file.crypt", "wb") as output:
+                    encrypt_file("file", output, key, public_key)
+            return encrypt
+        if benchmark == "encrypt_file_mmap":
+            return lambda: encrypt_file_mmap("file", "file.crypt", key, public_key)
+        if benchmark == "decrypt_file_mmap":
+            return lambda: decrypt_file_mmap("file.crypt", "file.out", key, public_key)
+
+        def decrypt():
+            with open("file.crypt", "rb") as encrypted_file:
+                decrypt_file(read_chunks(encrypted_file), "file.out", key, public_key)
+        return decrypt
+
+    from sb_api.sb_api import API
+    API.base_url = url
+    client = SecureBoxClient("benchmark")
+    user_id = client.api.user_register("benchmark", "benchmark@example.com", public_key)["userID"]
+    # Files already sent to the user would not be sent again, so every repetition would only look for them
+    if benchmark == "upload":
+        return lambda: client.upload("file", user_id, key, force=True)
+
+    file_id = client.upload("file", user_id, key, force=True)
+    if benchmark == "download":
+        return lambda: client.download(file_id, user_id, key)
+    with open("file.crypt", "wb") as f:
+        encrypt_file("file", f, key, public_key)
+    return lambda: client.decrypt_helper(filename="file.crypt", sender_id=user_id, private_key=key)
+
+
+def run_case(case: dict) -> dict:
+    """
+    Runs a benchmark case in the current process, inside a temporary folder
+    :param case: dictionary with fields benchmark, size, key_size, threads, repeat and url
+    :return: the case with its results: latencies (in ms), throughput (in MB/s) and peak RSS (in MB)
+    """
+    sys.path.insert(0, ROOT)
+    with tempfile.TemporaryDirectory(prefix="securebox-benchmark-") as folder:
+        os.chdir(folder)
+        # The client prints its progress, which would be mixed with the results
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            operation = prepare(case["benchmark"], case["size"], case["key_size"], case["threads"], case["url"])
+            latencies = []
+            for _ in range(case["repeat"]):
+                start = time.perf_counter()
+                operation()
+                latencies.append(time.perf_counter() - start)
+        os.chdir(ROOT)
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return dict(case,
+                latency_ms={"min": min(latencies) * 1000,
+                            "mean": statistics.mean(latencies) * 1000,
+                            "p50": quantiles[49] * 1000,
+                            "p90": quantiles[89] * 1000,
+                            "p99": quantiles[98] * 1000,
+                            "max": max(latencies) * 1000},
+                throughput_mb_s=case["size"] / 1024 ** 2 / statistics.median(latencies) if case["size"] else None,
+                peak_rss_mb=peak_rss_mb())
+
+
+def build_cases(args: argparse.Namespace, url: str) -> List[dict]:
+    cases = []
+    for benchmark in args.benchmarks:
+        for key_size in args.key_sizes:
+            sizes = [0] if benchmark == "rsa_generate_key" else args.sizes
+            for size in sizes:
+                if benchmark in MESSAGE_BENCHMARKS and size > args.max_memory_size:
+                    continue
+                # Generating keys is much slower than the rest, so it is repeated less
+                repeat = max(1, args.repeat // 5) if benchmark == "rsa_generate_key" else args.repeat
+                threads = args.threads if "framed" in benchmark else 1
+                cases.append({"benchmark": benchmark, "size": size, "key_size": key_size, "threads": threads,
+                              "repeat": repeat, "url": url})
+    return cases
+
+
+def case_name(case: dict) -> str:
+    name = f"{case['benchmark']} size={case['size']} key_size={case['key_size']}"
+    return name + f" threads={case['threads']}" if case.get("threads", 1) > 1 else name
+
+
+def compare(results: List[dict], baseline_filename: str, threshold: float) -> List[Tuple[str, float]]:
+    """
+    Compares the throughput (or the median latency, if the case has no size) of the results with a previous run
+    :return: a list with the name and the relative slowdown of the cases that are slower than the threshold
+    """
+    with open(baseline_filename, "r") as f:
+        baseline = {case_name(case): case for case in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(case_name(result))
+        if previous is None:
+            continue
+        if result["throughput_mb_s"]:
+            slowdown = 1 - result["throughput_mb_s"] / previous["throughput_mb_s"]
+        else:
+            slowdown = result["latency_ms"]["p50"] / previous["latency_ms"]["p50"] - 1
+        if slowdown > threshold:
+            regressions.append((case_name(result), slowdown))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the cryptography and the client of SecureBox")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, metavar="name",
+                        help=f"Benchmarks to be run (all by default): {', '.join(BENCHMARKS)}")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size(size) for size in
+                                                                         ["1K", "64K", "1M", "16M"]],
+                        metavar="size", help="Sizes of the messages, with an optional K, M or G suffix "
+                                             "(1K 64K 1M 16M by default)")
+    parser.add_argument("--key_sizes", nargs="+", type=int, default=[2048], metavar="bits",
+                        help="Sizes of the RSA keys (2048 by default)")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1,
+                        help="Threads used by the benchmarks of the framed format (number of CPUs by default)")
+    parser.add_argument("--repeat", type=int, default=10, help="Times each case is run (10 by default)")
+    parser.add_argument("--max_memory_size", type=parse_size, default=parse_size("256M"), metavar="size",
+                        help="Largest size used with the benchmarks that hold the whole message in memory "
+                             "(256M by default)")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="File where the results are written (benchmark_results.json by default)")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Slowdown relative to the baseline considered a regression (0.1 by default)")
+    parser.add_argument("--run_case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return
+
+    from mock_server import MockServer
+
+    results = []
+    with MockServer() as server:
+        for case in build_cases(args, server.url):
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run_case", json.dumps(case)],
+                                     stdout=subprocess.PIPE, universal_newlines=True)
+            if process.returncode != 0:
+                print(f"FAILED {case_name(case)}")
+                continue
+            result = json.loads(process.stdout.splitlines()[-1])
+            del result["url"]
+            results.append(result)
+            throughput = f"{result['throughput_mb_s']:9.1f} MB/s" if result["throughput_mb_s"] else " " * 14
+            print(f"{case_name(case):50} p50 {result['latency_ms']['p50']:10.2f} ms  {throughput}  "
+                  f"peak RSS {result['peak_rss_mb']:7.1f} MB")
+
+    with open(args.output, "w") as f:
+        json.dump({"timestamp": time.time(),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "results": results}, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        for name, slowdown in regressions:
+            print(f"REGRESSION {name}: {slowdown:.0%} slower")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
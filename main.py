@@ -1,12 +1,25 @@
 import argparse
+import json
+import os
 import sys
-from securebox import *
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from typing import List, TextIO
 
 
-def main():
-    is_dest_id_required = '--upload' in sys.argv or '--encrypt' in sys.argv or 'enc_sign' in sys.argv
-    is_source_id_required = '--download' in sys.argv or '--decrypt-and-verify' in sys.argv or '--verify' in sys.argv
+def parse_date(date: str) -> float:
+    """
+    :param date: date in ISO format (local time)
+    :return: the date as Unix time
+    """
+    from datetime import datetime
+    try:
+        return datetime.fromisoformat(date).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {date}")
 
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='SecureBox client')
     parser.add_argument('--create_id', nargs=2, metavar=('name', 'email'),
                         help='Creates a new identity (public and private key pair) for a user with name and email specified. '
@@ -16,113 +29,424 @@ def main():
                              'returning its ID.')
     parser.add_argument('--delete_id', action='store_true',
                         help='Deletes the identity with the id of the current user, reading it from the bundle.')
-    parser.add_argument('--upload', metavar='file',
-                        help='Sends a file to another user, whose ID is specified in --dest_id. '
+    parser.add_argument('--upload', nargs='+', metavar='file',
+                        help='Sends files to other users, whose IDs are specified in --dest_id. '
                              'By default, the file will be uploaded to SecureBox signed and encrypted with the appropiate keys '
-                             'so the receiver is able to decrypt and verify it.')
-    parser.add_argument('--source_id', metavar='id', required=is_source_id_required, help='Sender\'s ID.')
-    parser.add_argument('--dest_id', metavar='id', required=is_dest_id_required, help='Receiver\'s ID.')
+                             'so the receiver is able to decrypt and verify it. If several files, directories or '
+                             'receivers are specified, each file is signed once and encrypted for every receiver in '
+                             'parallel.')
+    parser.add_argument('--source_id', metavar='id', help='Sender\'s ID.')
+    parser.add_argument('--dest_id', nargs='+', metavar='id',
+                        help='Receiver\'s ID(s). --encrypt and --enc_sign only accept more than one with a --cipher '
+                             'other than cbc, in which case the file is encrypted once for all of them (as it is '
+                             'uploaded by --upload).')
+    parser.add_argument('--workers', type=int, default=4, metavar='n',
+                        help='Number of files transferred at the same time in batch operations (4 by default).')
+    parser.add_argument('--rate', type=float, default=10, metavar='n',
+                        help='Maximum number of files deleted per second by --delete_files (10 by default).')
+    parser.add_argument('--use_async', action='store_true',
+                        help='Runs batch uploads, downloads and deletions with asyncio instead of threads. In that '
+                             'case, --workers is the number of requests in flight.')
+    parser.add_argument('--sync', metavar='directory',
+                        help='Uploads the files of a directory that are new or have changed since the last --sync '
+                             'to the receivers specified with --dest_id. Unchanged files are detected with a local '
+                             'index, so they are not uploaded again.')
+    parser.add_argument('--prune', action='store_true',
+                        help='Makes --sync delete from SecureBox the previous version of every file it uploads again. '
+                             'By default they are kept, as the receiver may not have downloaded them yet.')
+    parser.add_argument('--force', action='store_true',
+                        help='Makes --upload and --sync send files even if the receiver already has a file with the '
+                             'same content, which is otherwise not sent again.')
     parser.add_argument('--list_files', action='store_true', help='List all the files owned by the user.')
-    parser.add_argument('--download', metavar='file_id', help='Downloads the file with the specified file_id')
-    parser.add_argument('--delete_files', nargs='*', metavar='file_id',
-                        help='Deletes the files with the specified file_id(s)')
-    parser.add_argument('--encrypt', metavar='file',
-                        help='Encrypts a file so that it can be decrypted by the user whose id is specified by --dest_id.')
-    parser.add_argument('--sign', metavar='file', help='Signs the file')
-    parser.add_argument('--enc_sign', metavar='file', help='Encrypts and signs a file.')
-    parser.add_argument('--decrypt-and-verify', metavar='file',
+    parser.add_argument('--download', nargs='+', metavar='file',
+                        help='Downloads the files with the specified file_id(s), names or glob patterns (e.g. '
+                             '"*.pdf"; "all" downloads every file), which are looked up in a local catalog of the '
+                             'files uploaded. Several files are downloaded at the same time (see --workers) and '
+                             'decrypted in parallel.')
+    parser.add_argument('--delete_files', nargs='*', metavar='file',
+                        help='Deletes the files with the specified file_id(s), names or glob patterns ("all" deletes '
+                             'every file).')
+    parser.add_argument('--since', type=parse_date, metavar='date',
+                        help='Only downloads or deletes the files (matched by name, pattern or "all") uploaded from '
+                             'this date (YYYY-MM-DD or YYYY-MM-DDTHH:MM) on. Upload dates are only known for the files '
+                             'uploaded from this computer.')
+    parser.add_argument('--until', type=parse_date, metavar='date',
+                        help='Only downloads or deletes the files (matched by name, pattern or "all") uploaded before '
+                             'this date.')
+    parser.add_argument('--encrypt', nargs='+', metavar='file',
+                        help='Encrypts a file so that it can be decrypted by the user whose id is specified by --dest_id. '
+                             'This and the following options accept several files, directories or glob patterns, '
+                             'which are processed in parallel by as many processes as CPUs.')
+    parser.add_argument('--sign', nargs='+', metavar='file', help='Signs the file')
+    parser.add_argument('--enc_sign', nargs='+', metavar='file', help='Encrypts and signs a file.')
+    parser.add_argument('--decrypt-and-verify', nargs='+', metavar='file',
                         help='Decrypts a file sent by user whose id is specified by --source_id, verifying its signature')
-    parser.add_argument('--verify', metavar='file', help='Verifies a file signed by the user specified in --source_id')
-    parser.add_argument('--decrypt', metavar='file', help='Decrypts the file whose filename is provided')
+    parser.add_argument('--verify', nargs='+', metavar='file',
+                        help='Verifies a file signed by the user specified in --source_id')
+    parser.add_argument('--decrypt', nargs='+', metavar='file', help='Decrypts the file whose filename is provided')
+
+    parser.add_argument('--agent', nargs='?', type=int, const=900, metavar='seconds',
+                        help='Keeps the bundle unlocked in a background agent for the specified seconds (900 by '
+                             'default), so that next executions do not ask for the password.')
+    parser.add_argument('--stop_agent', action='store_true', help='Stops the agent, locking the bundle again.')
+    parser.add_argument('--bundle_kdf', metavar='kdf',
+                        help='Encrypts the bundle again deriving its key with the specified KDF: scrypt[:N] or '
+                             'pbkdf2[:iterations].')
+    parser.add_argument('--serve', action='store_true',
+                        help='After running the other commands, keeps running commands read from the standard input, '
+                             'one per line, as JSON lists of arguments (e.g. ["--list_files"]). A JSON response is '
+                             'written to the standard output for each of them. The bundle, the connections with the '
+                             'server and the public keys are reused between commands.')
+    parser.add_argument('--cipher', choices=['cbc', 'aes-gcm', 'chacha20'], default='cbc',
+                        help='Cipher used to encrypt files. cbc (the default) produces the legacy format that every '
+                             'SecureBox client understands, while aes-gcm and chacha20 produce a framed format whose '
+                             'parts are authenticated independently. Files are decrypted in either format.')
+    parser.add_argument('--compress', choices=['none', 'auto', 'zlib', 'lzma', 'zstd'], default='none',
+                        help='Compresses files before encrypting them (requires --cipher aes-gcm or chacha20). auto '
+                             'samples each file, skips the ones that look incompressible and chooses between zlib '
+                             'and lzma for the rest. zstd requires the zstandard package, on the receiver too. Files '
+                             'are decompressed transparently.')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='file',
+                        help='Measures the time spent and the bytes processed in each stage of the commands (reading '
+                             'files, hashing, AES, RSA, HTTP requests...). The report is printed as a table, or '
+                             'written to file: in the Prometheus text format if its extension is .prom (for the '
+                             'textfile collector of node_exporter), or as JSON if not.')
+
+    return parser
+
+
+class Context:
+    """
+    Objects shared by the commands. They are created the first time a command needs them, so that commands which
+    do not use them neither initialize them nor import their (heavy) modules
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self._bundle = None
+        self._client = None
+
+    @property
+    def bundle(self):
+        if self._bundle is None:
+            from sb_bundle.sb_bundle import Bundle
+
+            # Try to read the ini file to retrieve the token
+            self._bundle = Bundle()
+            if self._bundle.initialization_needed():
+                print(f"Bundle not found... Creating ID...")
+
+                token = input("Insert token: ")
+                self._bundle.set_token(token)
+                username = input("Insert username: ")
+                email = input("Insert email: ")
+
+                self.client.create_id(self._bundle, username, email)
+        return self._bundle
+
+    @property
+    def client(self):
+        if self._client is None:
+            from securebox import SecureBoxClient
+            self._client = SecureBoxClient(self.bundle.get_token())
+        # It is set every time, as it may change between the commands of --serve
+        self._client.cipher = None if self.args.cipher == "cbc" else self.args.cipher
+        self._client.compression = None if self.args.compress == "none" else self.args.compress
+        return self._client
+
+
+def stop_agent_command(context: Context):
+    from sb_agent.sb_agent import stop_agent
+    print("Agent stopped" if stop_agent() else "No agent was running")
+
+
+def bundle_kdf_command(context: Context):
+    name, _, parameter = context.args.bundle_kdf.partition(":")
+    if name == "scrypt":
+        kdf = dict(context.bundle.default_kdf, N=int(parameter) if parameter else context.bundle.default_kdf["N"])
+    elif name == "pbkdf2":
+        kdf = {"name": "pbkdf2", "count": int(parameter) if parameter else 600000, "hash": "SHA256"}
+    else:
+        raise ValueError("--bundle_kdf must be scrypt[:N] or pbkdf2[:iterations]")
+    if context.bundle.password is None:
+        # The bundle was taken from the agent, so its password is not known. If an empty one was typed when writing
+        # it, bundle.ini would be written, while the old bundle.crypt would still be the one read
+        raise ValueError("--bundle_kdf needs the password of the bundle, so the agent must be stopped first "
+                         "(--stop_agent)")
+    context.bundle.set_kdf(kdf)
+    context.bundle.write()
+
+
+def agent_command(context: Context):
+    print(f"Starting agent with PID {context.bundle.start_agent(context.args.agent)}")
+
+
+def create_id_command(context: Context):
+    username, email = context.args.create_id
+    return context.client.create_id(context.bundle, username, email)
+
+
+def search_id_command(context: Context):
+    query = context.args.search_id
+    return context.client.search_id(query)
+
+
+def delete_id_command(context: Context):
+    user_id = context.bundle.get_user_id()
+    return context.client.delete_id(user_id)
+
+
+def upload_command(context: Context):
+    args = context.args
+    filenames = args.upload
+    receiver_ids = args.dest_id
+    private_key = context.bundle.get_key()
+    sb = context.client
 
-    args = parser.parse_args()
+    if len(filenames) == 1 and len(receiver_ids) == 1 and not os.path.isdir(filenames[0]):
+        return sb.upload(filenames[0], receiver_ids[0], private_key, force=args.force)
+    elif args.use_async:
+        import asyncio
+        return asyncio.run(sb.upload_batch_async(filenames, receiver_ids, private_key, max_concurrency=args.workers,
+                                                 force=args.force))
+    else:
+        return sb.upload_batch(filenames, receiver_ids, private_key, upload_workers=args.workers, force=args.force)
+
+
+def sync_command(context: Context):
+    return context.client.sync(context.args.sync, context.args.dest_id, context.bundle.get_key(),
+                               upload_workers=context.args.workers, force=context.args.force,
+                               prune=context.args.prune)
+
+
+def list_files_command(context: Context):
+    return context.client.list_files()
+
+
+def download_command(context: Context):
+    args = context.args
+    sender_id = args.source_id
+    private_key = context.bundle.get_key()
+    sb = context.client
+    files_id = sb.find_files(args.download, args.since, args.until)
 
-    # Try to read the ini file to retrieve the token
-    bundle = Bundle()
-    if bundle.initialization_needed():
-        print(f"Bundle not found... Creating ID...")
+    if not files_id:
+        print("No files found")
+        return []
+    if len(files_id) == 1 and files_id == args.download:
+        return sb.download(files_id[0], sender_id, private_key)
+    elif args.use_async:
+        import asyncio
+        return asyncio.run(sb.download_batch_async(files_id, sender_id, private_key, max_concurrency=args.workers))
+    else:
+        return sb.download_batch(files_id, sender_id, private_key, download_workers=args.workers)
 
-        token = input("Insert token: ")
-        bundle.set_token(token)
-        username = input("Insert username: ")
-        email = input("Insert email: ")
 
-        sb = SecureBoxClient(token)
-        sb.create_id(bundle, username, email)
+def delete_files_command(context: Context):
+    args = context.args
+    files_id = context.client.find_files(args.delete_files, args.since, args.until)
+    if not files_id:
+        print("No files found")
+        return []
+    if args.use_async:
+        import asyncio
+        return asyncio.run(context.client.delete_files_async(*files_id, max_concurrency=args.workers, rate=args.rate))
     else:
-        token = bundle.get_token()
-        sb = SecureBoxClient(token)
+        return context.client.delete_files(*files_id, max_workers=args.workers, rate=args.rate)
+
+
+def _single_file(filenames: List[str]) -> bool:
+    # Several files, directories and patterns are processed by the batch methods, which report a summary at the end
+    return len(filenames) == 1 and os.path.isfile(filenames[0])
+
+
+def encrypt_command(context: Context):
+    filenames = context.args.encrypt
+    receiver_id = context.args.dest_id if len(context.args.dest_id) > 1 else context.args.dest_id[0]
+
+    if _single_file(filenames):
+        return context.client.encrypt_helper(filenames[0], receiver_id=receiver_id, to_disk=True)
+    return context.client.encrypt_batch(filenames, receiver_id=receiver_id)
+
 
-    if args.create_id:
-        username, email = args.create_id
-        sb.create_id(bundle, username, email)
+def sign_command(context: Context):
+    filenames = context.args.sign
+    private_key = context.bundle.get_key()
 
-    if args.search_id:
-        query = args.search_id
-        sb.search_id(query)
+    if _single_file(filenames):
+        return context.client.encrypt_helper(filenames[0], private_key=private_key, to_disk=True)
+    return context.client.encrypt_batch(filenames, private_key=private_key)
 
-    if args.delete_id:
-        user_id = bundle.get_user_id()
-        sb.delete_id(user_id)
 
-    if args.upload:
-        filename = args.upload
-        receiver_id = args.dest_id
-        private_key = bundle.get_key()
+def enc_sign_command(context: Context):
+    filenames = context.args.enc_sign
+    receiver_id = context.args.dest_id if len(context.args.dest_id) > 1 else context.args.dest_id[0]
+    private_key = context.bundle.get_key()
 
-        sb.upload(filename, receiver_id, private_key)
+    if _single_file(filenames):
+        return context.client.encrypt_helper(filenames[0], private_key=private_key, receiver_id=receiver_id,
+                                             to_disk=True)
+    return context.client.encrypt_batch(filenames, private_key=private_key, receiver_id=receiver_id)
 
-    if args.list_files:
-        sb.list_files()
 
-    if args.download:
-        file_id = args.download
-        sender_id = args.source_id
-        private_key = bundle.get_key()
+def decrypt_command(context: Context):
+    filenames = context.args.decrypt
+    private_key = context.bundle.get_key()
 
-        sb.download(file_id, sender_id, private_key)
+    if _single_file(filenames):
+        return context.client.decrypt_helper(filename=filenames[0], private_key=private_key)
+    return context.client.decrypt_batch(filenames, private_key=private_key)
 
-    if args.delete_files:
-        files_id = args.delete_files
-        sb.delete_files(*files_id)
 
-    if args.encrypt:
-        filename = args.encrypt
-        receiver_id = args.dest_id
+def decrypt_and_verify_command(context: Context):
+    filenames = context.args.decrypt_and_verify
+    sender_id = context.args.source_id
+    private_key = context.bundle.get_key()
 
-        sb.encrypt_helper(filename, receiver_id=receiver_id, to_disk=True)
+    if _single_file(filenames):
+        return context.client.decrypt_helper(filename=filenames[0], sender_id=sender_id, private_key=private_key)
+    return context.client.decrypt_batch(filenames, private_key=private_key, sender_id=sender_id)
 
-    if args.sign:
-        filename = args.sign
-        private_key = bundle.get_key()
 
-        sb.encrypt_helper(filename, private_key=private_key, to_disk=True)
+def verify_command(context: Context):
+    filenames = context.args.verify
+    sender_id = context.args.source_id
 
-    if args.enc_sign:
-        filename = args.enc_sign
-        receiver_id = args.dest_id
-        private_key = bundle.get_key()
+    if _single_file(filenames):
+        return context.client.decrypt_helper(filename=filenames[0], sender_id=sender_id)
+    return context.client.decrypt_batch(filenames, sender_id=sender_id)
 
-        sb.encrypt_helper(filename, private_key=private_key, receiver_id=receiver_id, to_disk=True)
 
-    if args.decrypt:
-        filename = args.decrypt
-        private_key = bundle.get_key()
+# Commands in the order they are run when several of them are requested at once. Each one is run if its argument
+# has been provided
+COMMANDS = [
+    ("stop_agent", stop_agent_command),
+    ("bundle_kdf", bundle_kdf_command),
+    ("agent", agent_command),
+    ("create_id", create_id_command),
+    ("search_id", search_id_command),
+    ("delete_id", delete_id_command),
+    ("upload", upload_command),
+    ("sync", sync_command),
+    ("list_files", list_files_command),
+    ("download", download_command),
+    ("delete_files", delete_files_command),
+    ("encrypt", encrypt_command),
+    ("sign", sign_command),
+    ("enc_sign", enc_sign_command),
+    ("decrypt", decrypt_command),
+    ("decrypt_and_verify", decrypt_and_verify_command),
+    ("verify", verify_command),
+]
 
-        sb.decrypt_helper(filename=filename, private_key=private_key)
 
-    if args.decrypt_and_verify:
-        filename = args.decrypt_and_verify
-        sender_id = args.source_id
-        private_key = bundle.get_key()
+def parse_args(parser: argparse.ArgumentParser, argv: List[str] = None) -> argparse.Namespace:
+    """
+    Parses and validates the arguments of the CLI
+    :param argv: arguments to be parsed (sys.argv by default)
+    """
+    args = parser.parse_args(argv)
 
-        sb.decrypt_helper(filename=filename, sender_id=sender_id, private_key=private_key)
+    if (args.upload or args.sync or args.encrypt or args.enc_sign) and not args.dest_id:
+        parser.error("--dest_id is required by --upload, --sync, --encrypt and --enc_sign")
+    if (args.download or args.decrypt_and_verify or args.verify) and not args.source_id:
+        parser.error("--source_id is required by --download, --decrypt-and-verify and --verify")
+    if (args.encrypt or args.enc_sign) and len(args.dest_id) > 1 and args.cipher == "cbc":
+        parser.error("--encrypt and --enc_sign only accept several --dest_id with --cipher aes-gcm or chacha20")
+    if args.compress != "none" and args.cipher == "cbc":
+        parser.error("--compress requires --cipher aes-gcm or chacha20")
+    if args.compress == "zstd":
+        # find_spec does not import the package, which would slow down the start
+        from importlib.util import find_spec
+        if find_spec("zstandard") is None:
+            parser.error("--compress zstd requires the zstandard package (pip install zstandard)")
 
-    if args.verify:
-        filename = args.verify
-        sender_id = args.source_id
+    return args
+
+
+def run_commands(context: Context) -> list:
+    """
+    Runs the commands requested in context.args
+    :return: the results of the commands
+    """
+    commands = [command for dest, command in COMMANDS if getattr(context.args, dest)]
+    if not commands:
+        # Even without commands, the bundle is read so that the identity is created in the first execution
+        context.bundle
+    return [command(context) for command in commands]
+
+
+def run_commands_with_stats(context: Context) -> list:
+    """
+    Runs the commands requested in context.args, measuring them if --stats was provided
+    :return: the results of the commands
+    """
+    if not context.args.stats:
+        return run_commands(context)
+
+    from sb_stats.sb_stats import stats
+    stats.enable()
+    try:
+        return run_commands(context)
+    finally:
+        stats.enabled = False
+        if context.args.stats == "-":
+            print(stats.format_table())
+        else:
+            stats.write(context.args.stats)
+            print(f"Stats written to {context.args.stats}")
+
+
+def serve(context: Context, parser: argparse.ArgumentParser, requests_file: TextIO, responses_file: TextIO):
+    """
+    Runs commands read from requests_file, one per line, until it is closed. As the same context is used for all
+    of them, the bundle is unlocked once and the connections with the server and the public keys are reused.
+    Each line is a JSON object with the arguments of the command as they would be passed to main.py, for instance
+    {"id": 1, "args": ["--download", "0eA92C1E", "--source_id", "383112"]} (or just the JSON list of arguments).
+    For every command, a JSON object is written to responses_file with its id, whether it succeeded (ok), the
+    values returned by the command (result) and what it printed (output)
+    """
+    # The bundle is read before the commands, as it may ask for the token or the password
+    context.bundle
+
+    for line in requests_file:
+        if not line.strip():
+            continue
+
+        request_id = None
+        output = StringIO()
+        response = {"ok": True}
+        try:
+            request = json.loads(line)
+            if isinstance(request, dict):
+                request_id = request.get("id")
+                request = request["args"]
+            with redirect_stdout(output), redirect_stderr(output):
+                context.args = parse_args(parser, request)
+                if context.args.serve:
+                    raise ValueError("--serve cannot be used inside --serve")
+                response["result"] = run_commands_with_stats(context)
+        except SystemExit:
+            # argparse exits when the arguments are not valid (the reason is in the output)
+            response = {"ok": False, "error": "Invalid arguments"}
+        except Exception as e:
+            response = {"ok": False, "error": str(e)}
+
+        response["id"] = request_id
+        response["output"] = output.getvalue()
+        # Objects that cannot be represented in JSON (such as exceptions in the results) are sent as strings
+        responses_file.write(json.dumps(response, default=str) + "\n")
+        responses_file.flush()
+
+
+def main():
+    parser = build_parser()
+    args = parse_args(parser)
 
-        sb.decrypt_helper(filename=filename, sender_id=sender_id)
+    context = Context(args)
+    run_commands_with_stats(context)
+    if args.serve:
+        serve(context, parser, sys.stdin, sys.stdout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+import json
+import os
+import socket
+import tempfile
+import time
+from typing import Optional
+
+
+def socket_path() -> str:
+    """
+    :return: path of the Unix socket of the agent. It can be changed with the SECUREBOX_AGENT_SOCK variable
+    """
+    if "SECUREBOX_AGENT_SOCK" in os.environ:
+        return os.environ["SECUREBOX_AGENT_SOCK"]
+    folder = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(tempfile.gettempdir(), f"securebox-{os.getuid()}")
+    return os.path.join(folder, "securebox-agent.sock")
+
+
+def _send(request: dict, timeout: float = 2) -> Optional[dict]:
+    """
+    Sends a request to the agent
+    :return: its response, or None if there is no agent running
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path())
+            with client.makefile("rwb") as f:
+                f.write(json.dumps(request).encode() + b"\n")
+                f.flush()
+                return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def fetch_config(bundle_filename: str) -> Optional[dict]:
+    """
+    Asks the agent for the unlocked content of a bundle
+    :param bundle_filename: path of the encrypted bundle
+    :return: the content of the bundle (as a dictionary of sections), or None if no agent holds it
+    """
+    response = _send({"command": "get", "bundle": os.path.abspath(bundle_filename)})
+    if response is None:
+        return None
+    return response.get("config")
+
+
+def stop_agent() -> bool:
+    """
+    Stops the agent, forgetting the bundle it holds
+    :return: true if there was an agent running
+    """
+    return _send({"command": "stop"}) is not None
+
+
+def start_agent(bundle_filename: str, config: dict, lifetime: float) -> int:
+    """
+    Starts an agent in a background process that holds the unlocked content of a bundle for some time, so that
+    next executions do not have to ask for the password nor derive the key again. Only the user who started the
+    agent can talk to it
+    :param bundle_filename: path of the encrypted bundle
+    :param config: content of the bundle
+    :param lifetime: seconds after which the agent stops
+    :return: pid of the agent
+    """
+    stop_agent()
+    path = socket_path()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)  # The socket is created readable and writable only by its owner
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+
+    pid = os.fork()
+    if pid:
+        server.close()
+        return pid
+
+    # Child process: detach from the terminal and serve until the lifetime expires
+    os.setsid()
+    try:
+        _serve(server, os.path.abspath(bundle_filename), config, time.monotonic() + lifetime)
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os._exit(0)
+
+
+def _serve(server: socket.socket, bundle_filename: str, config: dict, deadline: float):
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        server.settimeout(remaining)
+        try:
+            connection, _ = server.accept()
+        except socket.timeout:
+            return
+
+        with connection, connection.makefile("rwb") as f:
+            connection.settimeout(2)
+            try:
+                # Refuse connections from other users, in case the permissions of the socket have been changed
+                if hasattr(socket, "SO_PEERCRED"):
+                    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+                    if int.from_bytes(credentials[4:8], "little") != os.getuid():
+                        continue
+                request = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+
+            if request.get("command") == "stop":
+                f.write(b"{}\n")
+                f.flush()
+                return
+            elif request.get("command") == "get" and request.get("bundle") == bundle_filename:
+                f.write(json.dumps({"config": config}).encode() + b"\n")
+            else:
+                f.write(b"{}\n")
+            f.flush()
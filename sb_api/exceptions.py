@@ -46,6 +46,12 @@ class IncorrectArgsException(Exception):
         super().__init__(message)
 
 
+class ServerErrorException(Exception):
+    def __init__(self, status_code: int = None):
+        message = f"The server is temporarily unavailable (HTTP {status_code})"
+        super().__init__(message)
+
+
 api_exceptions = {
     "TOK1": WrongTokenException,
     "TOK2": ExpiredTokenException,
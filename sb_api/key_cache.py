@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+from Crypto.PublicKey import RSA
+from Crypto.PublicKey.RSA import RsaKey
+
+
+class PublicKeyCache:
+    """
+    LRU cache of public keys indexed by userID, whose entries expire after some time. It can be persisted to a file,
+    so the keys are also reused between executions
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 24 * 60 * 60, filename: str = None):
+        """
+        :param max_size: maximum number of keys kept. The least recently used one is discarded when it is exceeded
+        :param ttl: seconds a key is considered valid since it was fetched
+        :param filename: if provided, the cache will be loaded from and saved to this file
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.filename = filename
+        # userID -> (expiration timestamp, key). Keys loaded from disk are kept as PEM until they are requested
+        self._keys = OrderedDict()
+        self._lock = Lock()
+        # Held while the cache is written, so that concurrent saves do not overwrite a newer copy with an older one
+        self._save_lock = Lock()
+
+        if filename and os.path.exists(filename):
+            self._load()
+
+    def get(self, user_id: str) -> Optional[RsaKey]:
+        """
+        Gets a key from the cache
+        :param user_id: owner of the key
+        :return: the public key of the user, or None if it is not cached or it has expired
+        """
+        with self._lock:
+            entry = self._keys.get(user_id)
+            if entry is None:
+                return None
+
+            expiration, key = entry
+            if expiration < time.time():
+                del self._keys[user_id]
+                return None
+
+            if isinstance(key, str):
+                key = RSA.import_key(key)
+                self._keys[user_id] = (expiration, key)
+            self._keys.move_to_end(user_id)
+            return key
+
+    def put(self, user_id: str, key: RsaKey):
+        """
+        Adds a key to the cache, saving it to disk if a filename was provided
+        :param user_id: owner of the key
+        :param key: public key of the user
+        """
+        with self._lock:
+            self._keys[user_id] = (time.time() + self.ttl, key)
+            self._keys.move_to_end(user_id)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+        self.save()
+
+    def invalidate(self, user_id: str = None):
+        """
+        Removes a key from the cache, so it will be fetched again the next time it is needed
+        :param user_id: owner of the key. If not provided, the whole cache is cleared
+        """
+        with self._lock:
+            if user_id is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(user_id, None)
+        self.save()
+
+    def save(self):
+        """
+        Saves the cache to its file (if any). The file is replaced atomically, so it is never left half-written. Each
+        save uses a temporary file of its own, so other processes using the same cache do not interfere with it
+        """
+        if not self.filename:
+            return
+
+        with self._save_lock:
+            with self._lock:
+                data = {user_id: {"expiration": expiration,
+                                  "publicKey": key if isinstance(key, str) else key.export_key("PEM").decode()}
+                        for user_id, (expiration, key) in self._keys.items()}
+
+            fd, temp_filename = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.filename)))
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                os.replace(temp_filename, self.filename)
+            except BaseException:
+                os.remove(temp_filename)
+                raise
+
+    def _load(self):
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # A corrupt cache is not an error: the keys will just be fetched again
+            return
+
+        now = time.time()
+        for user_id, entry in data.items():
+            if entry["expiration"] > now:
+                self._keys[user_id] = (entry["expiration"], entry["publicKey"])
@@ -0,0 +1,40 @@
+import time
+from threading import Lock
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: tokens are added at a constant rate up to a maximum, and each request consumes one.
+    It can be shared between threads
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: tokens added per second (that is, sustained requests per second)
+        :param capacity: maximum number of tokens stored, which is the size of the bursts allowed (rate by default)
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        """
+        Takes a token, even if it is not available yet
+        :return: seconds the caller has to wait before using the token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Takes a token, blocking until it is available
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
@@ -1,25 +1,184 @@
 import json
+import os
+import secrets
+import time
 from io import BytesIO
-from typing import Tuple
+from typing import BinaryIO, Callable, Iterator, List, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
 from Crypto.PublicKey import RSA
 from Crypto.PublicKey.RSA import RsaKey
 
 from sb_api.exceptions import *
+from sb_api.key_cache import PublicKeyCache
+from sb_stats.sb_stats import stats
+
+
+def filename_from_header(content_disposition: str) -> str:
+    """
+    Extracts the name of a downloaded file from the Content-Disposition header
+    :param content_disposition: header with the following format: attachment; filename="<FILENAME>"
+    :return: the name of the file
+    """
+    filename = content_disposition[content_disposition.find("filename=\"") + len("filename=\""):]
+    return filename[:filename.find('"')]
+
+
+class MultipartStream:
+    """
+    Body of a multipart/form-data request with a single file, which is read in chunks as the request is sent.
+    As its length is known, requests sends it with a Content-Length header instead of using chunked encoding
+    """
+
+    def __init__(self, field: str, filename: str, file: BinaryIO, progress: Callable[[int, int], None] = None,
+                 chunk_size: int = 64 * 1024):
+        """
+        :param field: name of the form field
+        :param filename: name of the file sent to the server
+        :param file: file opened in binary mode. It is sent from its current position until its end
+        :param progress: if provided, it will be called with the bytes of the file sent so far and its total size
+        :param chunk_size: size of the blocks in which the file is read
+        """
+        self.file = file
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.start = file.tell()
+        self.size = file.seek(0, os.SEEK_END) - self.start
+        file.seek(self.start)
+
+        boundary = secrets.token_hex(16)
+        filename = filename.replace('"', "%22")
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._head = (f"--{boundary}\r\n"
+                      f"Content-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+                      f"Content-Type: application/octet-stream\r\n\r\n").encode()
+        self._tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def __len__(self):
+        return len(self._head) + self.size + len(self._tail)
+
+    def __iter__(self) -> Iterator[bytes]:
+        # The file is rewound every time the body is iterated, so the request can be sent again
+        self.file.seek(self.start)
+        yield self._head
+        sent = 0
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                break
+            sent += len(chunk)
+            yield chunk
+            if self.progress:
+                self.progress(sent, self.size)
+        yield self._tail
+
+
+class DownloadStream:
+    """
+    Content of a streamed response, received in chunks as it is iterated. The connection is given back to the pool
+    when the content is consumed entirely or when the stream is closed, even if it was never iterated
+    """
+
+    def __init__(self, response: requests.Response, chunk_size: int = 64 * 1024):
+        """
+        :param response: response of a request sent with stream=True
+        :param chunk_size: maximum size of the chunks returned
+        """
+        self.response = response
+        self._chunks = stats.iterate("http /files/download (body)", response.iter_content(chunk_size))
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        # Only the response is closed, as it may be done while another thread is waiting for the next chunk
+        self.response.close()
 
 
 class API:
     # base_url = "https://vega.ii.uam.es:8080/api"
     base_url = "https://tfg.eps.uam.es:8080/api"
-
-    def __init__(self, token):
+    retry_status_codes = (502, 503, 504)  # Status codes considered transient, so the request can be repeated
+    # The server cannot delete several files in a single request. If it ever can, this should be set to the
+    # endpoint, so that file_delete_batch is used by SecureBoxClient.delete_files
+    batch_delete_endpoint = None
+    # Errors after which a request may succeed if it is sent again
+    transient_errors = (requests.ConnectionError, requests.Timeout, ServerErrorException)
+
+    def __init__(self, token, pool_size: int = 10, timeout: float = 60, retries: int = 3, backoff: float = 0.5,
+                 key_cache: PublicKeyCache = None):
         """
         Initializes an API object. If the token is not valid, an exception will be thrown when calling a method
         of the API, NOT during initialization.
+        All the requests are sent through the same session, so connections to the server are kept alive and reused
+        (also between threads) instead of doing a new TCP + TLS handshake each time.
         :param token: token to be used
+        :param pool_size: maximum number of connections kept open with the server
+        :param timeout: seconds to wait for the server to respond
+        :param retries: times an idempotent request is repeated if it fails due to a transient error
+        :param backoff: seconds to wait before the first retry. It is doubled after each retry
+        :param key_cache: cache used by user_get_public_key. If not provided, an in-memory one is used
         """
         self.header = {"Authorization": f"Bearer {token}"}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.key_cache = key_cache if key_cache is not None else PublicKeyCache()
+
+        self.session = requests.Session()
+        self.session.headers.update(self.header)
+        # Requests are only repeated by _request, so the adapter does not retry failed connections itself
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        """
+        Closes all the connections kept open with the server
+        """
+        self.session.close()
+
+    def _request(self, method: str, endpoint: str, idempotent: bool = False, **kwargs) -> requests.Response:
+        """
+        Sends a request to the server using the shared session
+        :param method: HTTP method
+        :param endpoint: path of the endpoint, relative to base_url
+        :param idempotent: if true, the request will be repeated with exponential backoff when the connection
+        fails or the server responds with a transient error
+        :param kwargs: arguments passed to requests
+        :return: the response of the server
+        :raise: ServerErrorException if the server keeps responding with a transient error
+        """
+        url = API.base_url + endpoint
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                with stats.stage(f"http {endpoint}", len(kwargs.get("data") or b"")):
+                    response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                if response.status_code not in API.retry_status_codes:
+                    return response
+                if last_attempt:
+                    raise ServerErrorException(response.status_code)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
 
     def user_register(self, username: str, email: str, public_key: RsaKey):
         """
@@ -29,14 +188,13 @@ class API:
         :param public_key:
         :return: a dictionary with keys userID and ts
         """
-        url = API.base_url + "/users/register"
         body = {
             "nombre": username,
             "email": email,
             "publicKey": public_key.export_key("PEM").decode()
         }
 
-        response = requests.post(url, headers=self.header, json=body)
+        response = self._request("POST", "/users/register", json=body)
         parsed_response = json.loads(response.text)
 
         if response.status_code != 200:
@@ -51,10 +209,9 @@ class API:
         :return: a list with the users. Each user is represented as a dictionary with fields userID, nombre, email,
         publicKey and ts.
         """
-        url = API.base_url + "/users/search"
         body = {"data_search": query}
 
-        response = requests.post(url, headers=self.header, json=body)
+        response = self._request("POST", "/users/search", json=body, idempotent=True)
         parsed_response = json.loads(response.text)
 
         if response.status_code != 200:
@@ -62,22 +219,30 @@ class API:
 
         return parsed_response
 
-    def user_get_public_key(self, user_id: str) -> RsaKey:
+    @stats.timed("api.get_public_key")
+    def user_get_public_key(self, user_id: str, use_cache: bool = True) -> RsaKey:
         """
         Gets the public key of a user whose user_id is passed as a parameter
         :param user_id:
+        :param use_cache: if true, the key is taken from key_cache when possible instead of asking the server
         :return: public RsaKey of the requested user
         """
-        url = API.base_url + "/users/getPublicKey"
+        if use_cache:
+            public_key = self.key_cache.get(user_id)
+            if public_key is not None:
+                return public_key
+
         body = {"userID": user_id}
 
-        response = requests.post(url, headers=self.header, json=body)
+        response = self._request("POST", "/users/getPublicKey", json=body, idempotent=True)
         parsed_response = json.loads(response.text)
 
         if response.status_code != 200:
             raise api_exceptions[parsed_response["error_code"]]
 
-        return RSA.import_key(parsed_response["publicKey"])
+        public_key = RSA.import_key(parsed_response["publicKey"])
+        self.key_cache.put(user_id, public_key)
+        return public_key
 
     def user_delete(self, user_id: str) -> dict:
         """
@@ -85,10 +250,9 @@ class API:
         :param user_id: user_id of the user whose token is being used to do the query
         :return: a dictionary with a field called userID
         """
-        url = API.base_url + "/users/delete"
         body = {"userID": user_id}
 
-        response = requests.post(url, headers=self.header, json=body)
+        response = self._request("POST", "/users/delete", json=body)
         parsed_response = json.loads(response.text)
 
         if response.status_code != 200:
@@ -102,9 +266,7 @@ class API:
         Lists the files uploaded by us (they are linked to our token/ID)
         :return: a list of files. Each file is represented as a dictionary with fields fileID and fileName
         """
-        url = API.base_url + "/files/list"
-
-        response = requests.get(url, headers=self.header)
+        response = self._request("GET", "/files/list", idempotent=True)
         parsed_response = json.loads(response.text)
 
         if response.status_code != 200:
@@ -112,26 +274,30 @@ class API:
 
         return parsed_response["files_list"]
 
-    def file_upload(self, filename: str, data: bytes = None) -> dict:
+    def file_upload(self, filename: str, data: Union[bytes, BinaryIO] = None,
+                    progress: Callable[[int, int], None] = None) -> dict:
         """
-        Uploads a file to the server
+        Uploads a file to the server. The body of the request is streamed, so the file is never loaded in memory
         :param filename: name of the file to be uploaded
-        :param data: If specified, it will be the content of the file. If not, the file named filename will be sent.
+        :param data: If specified, it will be the content of the file (either bytes or a file opened in binary
+        mode). If not, the file named filename will be sent.
+        :param progress: if provided, it will be called with the bytes of the file sent so far and its total size
         :return: a dictionary with fields file_id and file_size
         """
-        url = API.base_url + "/files/upload"
-
-        if data:
+        if isinstance(data, bytes):
             file = BytesIO(data)
-            file.name = filename
+        elif data is not None:
+            file = data
         else:
             file = open(filename, "rb")
 
-        body = {"ufile": file}
-
         # Note that this is the only function of the API which receives an ordinary POST form instead of a JSON one
-        response = requests.post(url, headers=self.header, files=body)
-        file.close()
+        body = MultipartStream("ufile", os.path.basename(filename), file, progress)
+        try:
+            response = self._request("POST", "/files/upload", data=body, headers={"Content-Type": body.content_type})
+        finally:
+            if file is not data:
+                file.close()
         parsed_response = json.loads(response.text)
 
         if response.status_code != 200:
@@ -145,21 +311,34 @@ class API:
         :param file_id: id of the file to be downloaded
         :return: a tuple with the content of the file (in bytes) and the name of it (as an ordinary string)
         """
-        url = API.base_url + "/files/download"
         body = {"file_id": file_id}
 
-        response = requests.post(url, headers=self.header, json=body)
+        response = self._request("POST", "/files/download", json=body, idempotent=True)
 
         if response.status_code != 200:
             parsed_response = json.loads(response.text)
             raise api_exceptions[parsed_response["error_code"]]
 
-        # Filename has the following format: Content-Disposition: attachment; filename="<FILENAME>"
-        filename = response.headers["Content-Disposition"]
-        filename = filename[filename.find("filename=\"") + len("filename=\""):]
-        filename = filename[:filename.find('"')]
+        return response.content, filename_from_header(response.headers["Content-Disposition"])
+
+    def file_download_stream(self, file_id: str, chunk_size: int = 64 * 1024) -> Tuple[DownloadStream, str]:
+        """
+        Downloads a file from the server without loading it in memory: its content is received as it is consumed
+        :param file_id: id of the file to be downloaded
+        :param chunk_size: maximum size of the chunks returned
+        :return: a tuple with a DownloadStream over the content of the file, which must be closed if it is not
+        consumed entirely, and the name of it
+        """
+        body = {"file_id": file_id}
+
+        response = self._request("POST", "/files/download", json=body, idempotent=True, stream=True)
+
+        if response.status_code != 200:
+            with response:
+                parsed_response = json.loads(response.text)
+            raise api_exceptions[parsed_response["error_code"]]
 
-        return response.content, filename
+        return DownloadStream(response, chunk_size), filename_from_header(response.headers["Content-Disposition"])
 
     def file_delete(self, file_id: str) -> dict:
         """
@@ -167,10 +346,26 @@ class API:
         :param file_id: id of the file to be deleted
         :return: a dictionary with a field called file_id
         """
-        url = API.base_url + "/files/delete"
         body = {"file_id": file_id}
 
-        response = requests.post(url, headers=self.header, json=body)
+        response = self._request("POST", "/files/delete", json=body)
+        parsed_response = json.loads(response.text)
+
+        if response.status_code != 200:
+            raise api_exceptions[parsed_response["error_code"]]
+
+        return parsed_response
+
+    def file_delete_batch(self, files_id: List[str]) -> dict:
+        """
+        Deletes several files from the server in a single request. It can only be used if batch_delete_endpoint
+        is set
+        :param files_id: ids of the files to be deleted
+        :return: a dictionary with a field called files_id, with the ids of the files deleted
+        """
+        body = {"files_id": files_id}
+
+        response = self._request("POST", API.batch_delete_endpoint, json=body)
         parsed_response = json.loads(response.text)
 
         if response.status_code != 200:
@@ -0,0 +1,223 @@
+import asyncio
+import json
+import os
+from io import BytesIO
+from typing import BinaryIO, Tuple, Union
+
+import aiohttp
+from Crypto.PublicKey import RSA
+from Crypto.PublicKey.RSA import RsaKey
+
+from sb_api.exceptions import *
+from sb_api.key_cache import PublicKeyCache
+from sb_api.sb_api import API, filename_from_header
+from sb_stats.sb_stats import stats
+
+
+class AsyncAPI:
+    """
+    asyncio counterpart of API. All the requests share a single connection pool, and the number of requests in
+    flight is limited by a semaphore, so hundreds of them can be sent concurrently from one thread.
+    It has to be used as an asynchronous context manager (async with AsyncAPI(token) as api: ...)
+    """
+    # Errors after which a request may succeed if it is sent again
+    transient_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError, ServerErrorException)
+
+    def __init__(self, token, max_concurrency: int = 100, timeout: float = 60, retries: int = 3,
+                 backoff: float = 0.5, key_cache: PublicKeyCache = None):
+        """
+        Initializes an AsyncAPI object. If the token is not valid, an exception will be thrown when calling a method
+        of the API, NOT during initialization.
+        :param token: token to be used
+        :param max_concurrency: maximum number of requests in flight (and of connections kept open)
+        :param timeout: seconds to wait for the server to respond
+        :param retries: times an idempotent request is repeated if it fails due to a transient error
+        :param backoff: seconds to wait before the first retry. It is doubled after each retry
+        :param key_cache: cache used by user_get_public_key. If not provided, an in-memory one is used
+        """
+        self.header = {"Authorization": f"Bearer {token}"}
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.key_cache = key_cache if key_cache is not None else PublicKeyCache()
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        # Both objects have to be created inside the event loop that will use them
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = aiohttp.ClientSession(headers=self.header,
+                                              connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes all the connections kept open with the server
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method: str, endpoint: str, idempotent: bool = False, output: BinaryIO = None,
+                       **kwargs) -> Tuple[int, bytes, dict]:
+        """
+        Sends a request to the server once there are less than max_concurrency requests in flight
+        :param method: HTTP method
+        :param endpoint: path of the endpoint, relative to API.base_url
+        :param idempotent: if true, the request will be repeated with exponential backoff when the connection
+        fails or the server responds with a transient error
+        :param output: if provided, the body of a successful response is written to it as it is received instead
+        of being returned
+        :param kwargs: arguments passed to aiohttp
+        :return: a tuple with the status code, the body (empty if it was written to output) and the headers of the
+        response
+        :raise: ServerErrorException if the server keeps responding with a transient error
+        """
+        url = API.base_url + endpoint
+        attempts = self.retries + 1 if idempotent else 1
+        async with self._semaphore:
+            for attempt in range(attempts):
+                last_attempt = attempt == attempts - 1
+                try:
+                    # Concurrent requests overlap, so the time of this stage may exceed the wall-clock time
+                    with stats.stage(f"http {endpoint}"):
+                        async with self._session.request(method, url, **kwargs) as response:
+                            if output is not None and response.status == 200:
+                                # Discard whatever a previous attempt may have written
+                                output.seek(0)
+                                output.truncate()
+                                async for chunk in response.content.iter_chunked(64 * 1024):
+                                    output.write(chunk)
+                                return response.status, b"", dict(response.headers)
+                            body = await response.read()
+                            if response.status not in API.retry_status_codes:
+                                return response.status, body, dict(response.headers)
+                            if last_attempt:
+                                raise ServerErrorException(response.status)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if last_attempt:
+                        raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _json_request(self, method: str, endpoint: str, idempotent: bool = False, **kwargs):
+        status, body, _ = await self._request(method, endpoint, idempotent, **kwargs)
+        parsed_response = json.loads(body)
+
+        if status != 200:
+            raise api_exceptions[parsed_response["error_code"]]
+
+        return parsed_response
+
+    async def user_register(self, username: str, email: str, public_key: RsaKey) -> dict:
+        """
+        Registers a new user
+        :return: a dictionary with keys userID and ts
+        """
+        body = {
+            "nombre": username,
+            "email": email,
+            "publicKey": public_key.export_key("PEM").decode()
+        }
+        return await self._json_request("POST", "/users/register", json=body)
+
+    async def user_search(self, query: str) -> list:
+        """
+        Looks for users in the server whose name or email contains the query
+        :return: a list with the users, as in API.user_search
+        """
+        return await self._json_request("POST", "/users/search", idempotent=True, json={"data_search": query})
+
+    async def user_get_public_key(self, user_id: str, use_cache: bool = True) -> RsaKey:
+        """
+        Gets the public key of a user whose user_id is passed as a parameter
+        :param use_cache: if true, the key is taken from key_cache when possible instead of asking the server
+        :return: public RsaKey of the requested user
+        """
+        if use_cache:
+            public_key = self.key_cache.get(user_id)
+            if public_key is not None:
+                return public_key
+
+        parsed_response = await self._json_request("POST", "/users/getPublicKey", idempotent=True,
+                                                   json={"userID": user_id})
+        public_key = RSA.import_key(parsed_response["publicKey"])
+        self.key_cache.put(user_id, public_key)
+        return public_key
+
+    async def user_delete(self, user_id: str) -> dict:
+        """
+        Deletes our user
+        :return: a dictionary with a field called userID
+        """
+        return await self._json_request("POST", "/users/delete", json={"userID": user_id})
+
+    async def file_list(self) -> list:
+        """
+        Lists the files uploaded by us
+        :return: a list of files, as in API.file_list
+        """
+        return (await self._json_request("GET", "/files/list", idempotent=True))["files_list"]
+
+    async def file_upload(self, filename: str, data: Union[bytes, BinaryIO] = None) -> dict:
+        """
+        Uploads a file to the server
+        :param filename: name of the file to be uploaded
+        :param data: If specified, it will be the content of the file (either bytes or a file opened in binary
+        mode). If not, the file named filename will be sent.
+        :return: a dictionary with fields file_id and file_size
+        """
+        if isinstance(data, bytes):
+            file = BytesIO(data)
+        elif data is not None:
+            file = data
+        else:
+            file = open(filename, "rb")
+
+        form = aiohttp.FormData()
+        form.add_field("ufile", file, filename=os.path.basename(filename))
+        try:
+            return await self._json_request("POST", "/files/upload", data=form)
+        finally:
+            if file is not data:
+                file.close()
+
+    async def file_download(self, file_id: str) -> Tuple[bytes, str]:
+        """
+        Downloads a file from the server
+        :return: a tuple with the content of the file (in bytes) and the name of it
+        """
+        status, body, headers = await self._request("POST", "/files/download", idempotent=True,
+                                                     json={"file_id": file_id})
+
+        if status != 200:
+            raise api_exceptions[json.loads(body)["error_code"]]
+
+        return body, filename_from_header(headers["Content-Disposition"])
+
+    async def file_download_to(self, file_id: str, output: BinaryIO) -> str:
+        """
+        Downloads a file from the server writing its content to output as it is received, so it is never loaded in
+        memory
+        :param file_id: id of the file to be downloaded
+        :param output: file opened in binary mode where the content is written
+        :return: the name of the file
+        """
+        status, body, headers = await self._request("POST", "/files/download", idempotent=True, output=output,
+                                                     json={"file_id": file_id})
+
+        if status != 200:
+            raise api_exceptions[json.loads(body)["error_code"]]
+
+        return filename_from_header(headers["Content-Disposition"])
+
+    async def file_delete(self, file_id: str) -> dict:
+        """
+        Deletes a file from the server
+        :return: a dictionary with a field called file_id
+        """
+        return await self._json_request("POST", "/files/delete", json={"file_id": file_id})
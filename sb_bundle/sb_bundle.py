@@ -1,33 +1,90 @@
 import configparser
 import json
+from base64 import b64decode, b64encode
 from getpass import getpass
 from pathlib import Path
 
 from Crypto.Cipher import AES
-from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Hash import SHA1, SHA256
+from Crypto.Protocol.KDF import PBKDF2, scrypt
 from Crypto.PublicKey import RSA
 from Crypto.PublicKey.RSA import RsaKey
 from Crypto.Random import get_random_bytes
+from Crypto.Util.asn1 import DerSequence
 from Crypto.Util.Padding import unpad, pad
 
+from sb_agent.sb_agent import fetch_config, start_agent
 from sb_bundle.exceptions import IncorrectPassword
 
 
+def _derive_key(password: str, salt: bytes, kdf: dict) -> bytes:
+    """
+    Derives the key used to encrypt the bundle from its password
+    :param kdf: name and parameters of the KDF, as stored in the header of the bundle
+    :return: 32 bytes key
+    """
+    if kdf["name"] == "scrypt":
+        return scrypt(password, salt, key_len=32, N=kdf["N"], r=kdf["r"], p=kdf["p"])
+    hash_module = {"SHA1": SHA1, "SHA256": SHA256}[kdf["hash"]]
+    return PBKDF2(password, salt, dkLen=32, count=kdf["count"], hmac_hash_module=hash_module)
+
+
+def _import_der_key(key_der: bytes) -> RsaKey:
+    """
+    Parses a private key stored in DER (PKCS#1) by set_key. Unlike RSA.import_key, the consistency checks are
+    skipped, which makes it around 50 times faster for 4096 bits keys. The key was generated by us and comes from
+    the bundle, so there is no need to check it every time it is read
+    :param key_der: private key in DER
+    :return: private RsaKey
+    """
+    version, n, e, d, p, q = DerSequence().decode(key_der)[:6]
+    return RSA.construct((n, e, d, p, q), consistency_check=False)
+
+
 class Bundle:
     plain_filename = "bundle.ini"
     cyphered_filename = "bundle.crypt"
-
-    def __init__(self):
+    magic = b"SBBUNDLE"  # Bundles without this header were written with the legacy KDF parameters
+    # KDF used when writing the bundle. scrypt makes brute-forcing the password much more expensive than PBKDF2
+    default_kdf = {"name": "scrypt", "N": 2 ** 16, "r": 8, "p": 1}
+    legacy_kdf = {"name": "pbkdf2", "count": 1000, "hash": "SHA1"}
+
+    def __init__(self, use_agent: bool = True):
+        """
+        Reads the bundle from disk, asking for its password if it is encrypted
+        :param use_agent: if true and an agent holds the bundle unlocked, it is taken from the agent instead of
+        asking for the password and deriving the key again
+        """
         self.config = configparser.ConfigParser()
+        self.kdf = Bundle.default_kdf
+        # Fields already read from config, so they are only parsed once
+        self._token = None
+        self._user_id = None
+        self._key = None
 
         if Path(Bundle.cyphered_filename).exists():
+            config = fetch_config(Bundle.cyphered_filename) if use_agent else None
+            if config is not None:
+                # The password is not known, so it will be asked again if the bundle is written
+                self.password = None
+                self.config.read_dict(config)
+                return
+
             with open(Bundle.cyphered_filename, "rb") as f:
+                if f.read(len(Bundle.magic)) == Bundle.magic:
+                    kdf_len = int.from_bytes(f.read(2), "big")
+                    self.kdf = json.loads(f.read(kdf_len).decode())
+                    kdf = self.kdf
+                else:
+                    # The bundle is written with the default KDF next time, so it gets upgraded
+                    f.seek(0)
+                    kdf = Bundle.legacy_kdf
                 salt = f.read(32)
                 iv = f.read(16)
                 ciphered_data = f.read()
 
             self.password = getpass("Enter bundle password: ")
-            key = PBKDF2(self.password, salt, dkLen=32)
+            key = _derive_key(self.password, salt, kdf)
 
             try:
                 decipher = AES.new(key, AES.MODE_CBC, iv=iv)
@@ -61,13 +118,17 @@ class Bundle:
 
         if self.password:
             salt = get_random_bytes(32)
-            key = PBKDF2(self.password, salt, dkLen=32)
+            key = _derive_key(self.password, salt, self.kdf)
 
             cipher = AES.new(key, AES.MODE_CBC)
             data = json.dumps(self.config._sections).encode()
             ciphered_data = cipher.encrypt(pad(data, AES.block_size))
 
+            kdf = json.dumps(self.kdf).encode()
             with open(Bundle.cyphered_filename, "wb") as f:
+                f.write(Bundle.magic)
+                f.write(len(kdf).to_bytes(2, "big"))
+                f.write(kdf)
                 f.write(salt)
                 f.write(cipher.iv)
                 f.write(ciphered_data)
@@ -75,20 +136,56 @@ class Bundle:
             with open(Bundle.plain_filename, "w") as f:
                 self.config.write(f)
 
+    def set_kdf(self, kdf: dict):
+        """
+        Changes the KDF used to derive the key from the password the next time the bundle is written
+        :param kdf: dictionary with the name of the KDF ("scrypt" or "pbkdf2") and its parameters (N, r and p for
+        scrypt; count and hash for PBKDF2)
+        """
+        self.kdf = kdf
+
+    def start_agent(self, lifetime: float) -> int:
+        """
+        Starts an agent that holds this bundle unlocked for some time
+        :param lifetime: seconds the agent will be running
+        :return: pid of the agent
+        """
+        return start_agent(Bundle.cyphered_filename, self.config._sections, lifetime)
+
     def get_token(self) -> str:
-        return self.config["SecureBox"]["token"]
+        if self._token is None:
+            self._token = self.config["SecureBox"]["token"]
+        return self._token
 
     def set_token(self, token: str):
         self.config["SecureBox"]["token"] = token
+        self._token = token
 
     def get_user_id(self) -> str:
-        return self.config["SecureBox"]["user_id"]
+        if self._user_id is None:
+            self._user_id = self.config["SecureBox"]["user_id"]
+        return self._user_id
 
     def set_user_id(self, user_id: str):
         self.config["SecureBox"]["user_id"] = user_id
+        self._user_id = user_id
 
     def get_key(self) -> RsaKey:
-        return RSA.import_key(self.config["SecureBox"]["key"])
+        """
+        Gets the private key of the user. It is parsed only the first time it is requested
+        :return: private RsaKey
+        """
+        if self._key is None:
+            section = self.config["SecureBox"]
+            if "key_der" in section:
+                self._key = _import_der_key(b64decode(section["key_der"]))
+            else:
+                # Bundles written by older versions store the key in PEM
+                self._key = RSA.import_key(section["key"])
+        return self._key
 
     def set_key(self, key: RsaKey):
-        self.config["SecureBox"]["key"] = key.export_key("PEM").decode()
+        # DER is stored instead of PEM because it is faster to parse
+        self.config["SecureBox"]["key_der"] = b64encode(key.export_key("DER")).decode()
+        self.config.remove_option("SecureBox", "key")
+        self._key = key
@@ -0,0 +1,148 @@
+import sqlite3
+import time
+from typing import Iterable, List, Optional, Tuple
+
+
+class Catalog:
+    """
+    Local copy of the list of files uploaded to SecureBox, stored in a SQLite database. It is updated with the files
+    uploaded and deleted by this client, and reconciled with the list returned by the server from time to time, so
+    files can be looked up by name, pattern or upload date without listing them remotely. Files uploaded by other
+    clients only get their ID and name when reconciling, as that is all the server returns
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: SQLite database. It is created if it does not exist
+        """
+        self.connection = sqlite3.connect(filename)
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS remote_files (
+                                           file_id TEXT PRIMARY KEY,
+                                           file_name TEXT NOT NULL,
+                                           size INTEGER,
+                                           uploaded_at REAL,
+                                           content_hash TEXT)""")
+            # GLOB patterns with a literal prefix (e.g. "report*") use the index on the name too
+            self.connection.execute("CREATE INDEX IF NOT EXISTS remote_files_name ON remote_files (file_name)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS remote_files_date ON remote_files (uploaded_at)")
+            # Used to find files already uploaded with the same content
+            self.connection.execute("CREATE INDEX IF NOT EXISTS remote_files_hash ON remote_files (content_hash)")
+            # A file encrypted for several users is uploaded once, so it can have several receivers
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS remote_file_receivers (
+                                           file_id TEXT NOT NULL,
+                                           receiver_id TEXT NOT NULL,
+                                           PRIMARY KEY (file_id, receiver_id))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS catalog_state (
+                                           key TEXT PRIMARY KEY,
+                                           value)""")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, files: Iterable[Tuple[str, str, int, float, Optional[str], Iterable[str]]]):
+        """
+        Adds or replaces files in the catalog, in a single transaction
+        :param files: tuples with the ID, name, size, upload time (Unix time), content hash (or None) and IDs of the
+        receivers of each file
+        """
+        with self.connection:
+            for file_id, file_name, size, uploaded_at, content_hash, receiver_ids in files:
+                self.connection.execute("INSERT OR REPLACE INTO remote_files VALUES (?, ?, ?, ?, ?)",
+                                        (file_id, file_name, size, uploaded_at, content_hash))
+                self.connection.executemany("INSERT OR IGNORE INTO remote_file_receivers VALUES (?, ?)",
+                                            [(file_id, receiver_id) for receiver_id in receiver_ids])
+
+    def remove(self, file_ids: Iterable[str]):
+        """
+        Removes files from the catalog, in a single transaction
+        """
+        rows = [(file_id,) for file_id in file_ids]
+        with self.connection:
+            self.connection.executemany("DELETE FROM remote_files WHERE file_id = ?", rows)
+            self.connection.executemany("DELETE FROM remote_file_receivers WHERE file_id = ?", rows)
+
+    def reconcile(self, files: List[dict]):
+        """
+        Makes the catalog match the files in the server: the files that are not there any more are removed, and the
+        ones that are missing are added with just their ID and name
+        :param files: list of files as returned by API.file_list (dictionaries with fields fileID and fileName)
+        """
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS listed_files "
+                                    "(file_id TEXT PRIMARY KEY, file_name TEXT)")
+            self.connection.execute("DELETE FROM listed_files")
+            self.connection.executemany("INSERT OR REPLACE INTO listed_files VALUES (?, ?)",
+                                        [(file["fileID"], file["fileName"]) for file in files])
+            self.connection.execute("""DELETE FROM remote_files
+                                       WHERE file_id NOT IN (SELECT file_id FROM listed_files)""")
+            self.connection.execute("""DELETE FROM remote_file_receivers
+                                       WHERE file_id NOT IN (SELECT file_id FROM listed_files)""")
+            self.connection.execute("""INSERT OR IGNORE INTO remote_files (file_id, file_name)
+                                       SELECT file_id, file_name FROM listed_files""")
+            self.connection.execute("INSERT OR REPLACE INTO catalog_state VALUES ('reconciled_at', ?)",
+                                    (time.time(),))
+
+    @property
+    def reconciled_at(self) -> Optional[float]:
+        """
+        :return: time (Unix time) the catalog was last reconciled with the server, or None if it never was
+        """
+        row = self.connection.execute("SELECT value FROM catalog_state WHERE key = 'reconciled_at'").fetchone()
+        return row[0] if row else None
+
+    def contains(self, file_id: str) -> bool:
+        row = self.connection.execute("SELECT 1 FROM remote_files WHERE file_id = ?", (file_id,)).fetchone()
+        return row is not None
+
+    def find(self, pattern: str = None, since: float = None, until: float = None, receiver_id: str = None,
+             content_hash: str = None) -> List[dict]:
+        """
+        Looks up files in the catalog. Every condition provided has to be met
+        :param pattern: name of the files, or a glob pattern (with *, ? and [...]) it has to match
+        :param since: only files uploaded at this time (Unix time) or later
+        :param until: only files uploaded before this time (Unix time)
+        :param receiver_id: only files uploaded for this user
+        :param content_hash: only files whose content (before being encrypted) has this SHA256, in hexadecimal
+        :return: list of dictionaries with fields fileID, fileName, size, uploaded_at, content_hash and receivers,
+        sorted by upload time. Fields that are not known are None (receivers is empty). Files whose upload time is not
+        known never match since and until
+        """
+        conditions = []
+        parameters = []
+        if pattern is not None:
+            conditions.append("file_name GLOB ?")
+            parameters.append(pattern)
+        if since is not None:
+            conditions.append("uploaded_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("uploaded_at < ?")
+            parameters.append(until)
+        if receiver_id is not None:
+            conditions.append("file_id IN (SELECT file_id FROM remote_file_receivers WHERE receiver_id = ?)")
+            parameters.append(receiver_id)
+        if content_hash is not None:
+            conditions.append("content_hash = ?")
+            parameters.append(content_hash)
+
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        files = [{"fileID": file_id, "fileName": file_name, "size": size, "uploaded_at": uploaded_at,
+                  "content_hash": content_hash, "receivers": []}
+                 for file_id, file_name, size, uploaded_at, content_hash in
+                 self.connection.execute("SELECT file_id, file_name, size, uploaded_at, content_hash FROM remote_files"
+                                         + where + " ORDER BY uploaded_at, file_name", parameters)]
+
+        by_id = {file["fileID"]: file for file in files}
+        receivers = self.connection.execute("""SELECT file_id, receiver_id FROM remote_file_receivers
+                                               WHERE file_id IN (SELECT file_id FROM remote_files""" + where + """)
+                                               ORDER BY receiver_id""", parameters)
+        for file_id, receiver_id in receivers:
+            by_id[file_id]["receivers"].append(receiver_id)
+        return files
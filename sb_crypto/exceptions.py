@@ -1,4 +1,23 @@
-class SignatureNotAuthentic(Exception):
+class _ExceptionWithoutArgs(Exception):
+    def __reduce__(self):
+        # The message is set by __init__, which takes no arguments, so they are not passed when unpickling (as
+        # when the exception is raised in a worker process)
+        return self.__class__, ()
+
+
+class SignatureNotAuthentic(_ExceptionWithoutArgs):
     def __init__(self):
         message = "The signature is not authentic"
         super().__init__(message)
+
+
+class MessageNotAuthentic(_ExceptionWithoutArgs):
+    def __init__(self):
+        message = "The encrypted message has been modified or is incomplete"
+        super().__init__(message)
+
+
+class NotARecipient(_ExceptionWithoutArgs):
+    def __init__(self):
+        message = "The message has not been encrypted for this key"
+        super().__init__(message)
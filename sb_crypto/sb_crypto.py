@@ -1,13 +1,54 @@
+import math
+import struct
+import time
+import zlib
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Union
+
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
 from Crypto.PublicKey.RSA import RsaKey
 from Crypto.Signature import pkcs1_15
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import AES, ChaCha20_Poly1305, PKCS1_OAEP
 from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
 from sb_crypto.exceptions import *
+from sb_stats.sb_stats import stats
 
 IV_LEN = 16  # IV is always 16 bytes long when using AES
+CHUNK_SIZE = 64 * 1024  # Size of the blocks in which files are read when streaming them
+
+# Framed messages (see FramedEncryptor) start with MAGIC followed by the version of the format. Legacy messages start
+# with a random IV, so they are told apart by the absence of the magic
+MAGIC = b"SBOX"
+FRAMED_VERSION = 2
+CIPHERS = {"aes-gcm": 1, "chacha20": 2}  # Name -> identifier stored in the header
+FLAG_SIGNED = 0x01
+# The symmetric key is wrapped for several recipients: instead of a single wrapped key, the header has a table with
+# the number of recipients (2 bytes) and, for each of them, the fingerprint of their key, the length of the wrapped
+# key (2 bytes) and the wrapped key
+FLAG_RECIPIENTS = 0x02
+FINGERPRINT_LEN = 8
+# The upper 4 bits of the flags hold the algorithm the message was compressed with before being encrypted (0 if it
+# was not compressed). Name -> identifier stored in the header
+COMPRESSIONS = {"zlib": 1, "lzma": 2, "zstd": 3}
+_COMPRESSION_SHIFT = 4
+# Data with more bits of entropy per byte than this (already compressed or encrypted) is not worth compressing
+COMPRESSION_MAX_ENTROPY = 7.5
+# lzma is only chosen over zlib if it compresses a sample to this fraction of the size zlib does or less
+LZMA_MIN_GAIN = 0.9
+TAG_LEN = 16
+# Magic, version, cipher, flags, frame size, signature length and wrapped key length
+_FRAMED_HEADER = struct.Struct(">4sBBBIHH")
+# Bytes of the message in each frame of new messages (messages with any other frame size can be decrypted too).
+# Setting up the cipher of a frame runs in Python, holding the GIL, so frames are large enough for it to be a small
+# part of the time spent on them, and threads encrypting different frames do not wait for each other
+FRAME_SIZE = 1024 * 1024
+# Largest frame size accepted in a header, since a whole frame is kept in memory before it can be authenticated
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+SEGMENT_SIZE = 1024 * 1024  # Minimum number of bytes of frames processed by a thread at once
+# Last byte of the nonce, so frames cannot be reordered or truncated without being noticed
+_DATA_FRAME, _FINAL_FRAME, _SIGNATURE_FRAME = 0, 1, 2
 
 
 def rsa_generate_key(nbits: int = 2048) -> RsaKey:
@@ -19,6 +60,7 @@ def rsa_generate_key(nbits: int = 2048) -> RsaKey:
     return RSA.generate(nbits)
 
 
+@stats.timed("crypto.sign_message", size_arg=0)
 def sign_message(message: bytes, sender_private_key: RsaKey) -> bytes:
     """
     Signs a message with the specified key
@@ -26,24 +68,73 @@ def sign_message(message: bytes, sender_private_key: RsaKey) -> bytes:
     :param sender_private_key: key to use in signing
     :return: signed message
     """
-    return pkcs1_15.new(sender_private_key).sign(SHA256.new(message))
+    # pycryptodome takes any buffer through a memoryview (a mmap, for instance), without copying it
+    with memoryview(message) as data:
+        h = SHA256.new(data)
+    return pkcs1_15.new(sender_private_key).sign(h)
+
+
+def hash_stream(chunks: Iterable[bytes]):
+    """
+    Computes the SHA256 of a message that is provided in chunks
+    :param chunks: iterable with the consecutive parts of the message
+    :return: SHA256 hash object, which can be signed with sign_hash
+    """
+    h = SHA256.new()
+    for chunk in chunks:
+        with stats.stage("crypto.sha256", len(chunk)):
+            h.update(chunk)
+    return h
 
 
+def sign_hash(h, sender_private_key: RsaKey) -> bytes:
+    """
+    :param h: SHA256 hash object of a message
+    :param sender_private_key: key to use in signing
+    :return: signature of the message, the same that sign_message would produce
+    """
+    with stats.stage("crypto.rsa_sign"):
+        return pkcs1_15.new(sender_private_key).sign(h)
+
+
+def sign_stream(chunks: Iterable[bytes], sender_private_key: RsaKey) -> bytes:
+    """
+    Signs a message that is provided in chunks, so that it never has to be in memory at once
+    :param chunks: iterable with the consecutive parts of the message to be signed
+    :param sender_private_key: key to use in signing
+    :return: signature of the whole message, the same that sign_message would produce
+    """
+    return sign_hash(hash_stream(chunks), sender_private_key)
+
+
+def read_chunks(file: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Reads a file from its current position until the end in blocks of chunk_size bytes
+    :param file: file opened in binary mode
+    :param chunk_size: maximum size of each block
+    :return: iterator over the blocks read
+    """
+    return stats.iterate("file.read", iter(lambda: file.read(chunk_size), b""))
+
+
+@stats.timed("crypto.verify_signature", size_arg=0)
 def verify_signature(message: bytes, sender_public_key: RsaKey) -> bytes:
     """
     Verifies if the message has a valid signature, raising SignatureNotAuthentic if not
-    :param message: message to be verified
+    :param message: message to be verified. Any bytes-like object is accepted: if it is a memoryview, the result is
+    a view of it, so the message is not copied
     :param sender_public_key: public key of the pretended sender
     :return: original message without signature if it is valid
     :raise: SignatureNotAuthentic if signature is not valid
     """
-    signature = message[:sender_public_key.size_in_bytes()]  # Assume encryption has been done with same key size
-    original_message = message[sender_public_key.size_in_bytes():]
-    h = SHA256.new(original_message)
+    signature_len = sender_public_key.size_in_bytes()  # Assume encryption has been done with same key size
+    signature = bytes(message[:signature_len])
+    with memoryview(message) as data:
+        h = SHA256.new(data[signature_len:])
     verifier = pkcs1_15.new(sender_public_key)
     try:
         verifier.verify(h, signature)
-        return original_message
+        return message[signature_len:]
     except ValueError:
         raise SignatureNotAuthentic
 
@@ -56,12 +147,55 @@ def encrypt_message(message: bytes, receiver_public_key: RsaKey, nbits: int = 25
     :param nbits: number of bits of the symmetric key
     :return: IV + encrypted symmetric key + encrypted message
     """
+    output = bytearray(encrypted_message_size(len(message), receiver_public_key))
+    encrypt_message_into(message, receiver_public_key, output, nbits=nbits)
+    return bytes(output)
+
+
+def encrypted_message_size(message_len: int, receiver_public_key: RsaKey) -> int:
+    """
+    :return: length of the result of encrypting a message of message_len bytes with encrypt_message
+    """
+    # Padding is always added, even if the message fits in exact blocks
+    return IV_LEN + receiver_public_key.size_in_bytes() + (message_len // AES.block_size + 1) * AES.block_size
+
+
+@stats.timed("crypto.encrypt_message", size_arg=0)
+def encrypt_message_into(message, receiver_public_key: RsaKey, output, prefix: bytes = b"", nbits: int = 256) -> int:
+    """
+    Same as encrypt_message(prefix + message), but the message can be any bytes-like object (a memoryview, a mmap...)
+    and the result is written into output, so neither the message nor the result is copied
+    :param message: message to be encrypted
+    :param receiver_public_key: destination public key
+    :param output: writable bytes-like object (a bytearray, a mmap...) with room for at least
+    encrypted_message_size(len(prefix) + len(message)) bytes
+    :param prefix: a few bytes encrypted before the message, like its signature
+    :param nbits: number of bits of the symmetric key
+    :return: number of bytes written to output
+    """
     aes_key = get_random_bytes(nbits // 8)
     cipher_aes = AES.new(aes_key, AES.MODE_CBC)
-    return cipher_aes.iv + _encrypt_aes_key(aes_key, receiver_public_key) + cipher_aes.encrypt(
-        pad(message, AES.block_size))  # Padding have to be added in case the size does not fit in exact blocks
+    wrapped_key = _encrypt_aes_key(aes_key, receiver_public_key)
+    with memoryview(message) as data, memoryview(output) as out:
+        position = IV_LEN + len(wrapped_key)
+        out[:IV_LEN] = cipher_aes.iv
+        out[IV_LEN:position] = wrapped_key
+
+        # The prefix is completed to whole blocks with the first bytes of the message, so that the rest of the
+        # message is encrypted straight from its buffer. Only the last block is padded
+        head_len = min(-len(prefix) % AES.block_size, len(data))
+        head = bytes(prefix) + bytes(data[:head_len])
+        head_blocks_len = len(head) - len(head) % AES.block_size
+        body_end = len(data) - (len(data) - head_len) % AES.block_size
+        last = pad(head[head_blocks_len:] + bytes(data[body_end:]), AES.block_size)
+        for part in (head[:head_blocks_len], data[head_len:body_end], last):
+            if part:
+                cipher_aes.encrypt(part, output=out[position:position + len(part)])
+                position += len(part)
+    return position
 
 
+@stats.timed("crypto.rsa_wrap")
 def _encrypt_aes_key(aes_key: bytes, receiver_public_key: RsaKey) -> bytes:
     """
     Encrypts symmetric key with the specified RsaKey
@@ -80,12 +214,872 @@ def decrypt_message(message: bytes, receiver_private_key: RsaKey) -> bytes:
     :param receiver_private_key: RsaKey to decrypt symmetric key
     :return: decrypted message
     """
-    iv = message[:IV_LEN]
-    enc_aes_key = message[IV_LEN:IV_LEN + receiver_private_key.size_in_bytes()]  # Assume encryption has been done with same key size
-    enc_message = message[IV_LEN + receiver_private_key.size_in_bytes():]
+    output = bytearray(max(len(message) - IV_LEN - receiver_private_key.size_in_bytes(), 0))
+    with memoryview(output) as out:
+        return bytes(out[:decrypt_message_into(message, receiver_private_key, output)])
+
+
+@stats.timed("crypto.decrypt_message", size_arg=0)
+def decrypt_message_into(message, receiver_private_key: RsaKey, output) -> int:
+    """
+    Same as decrypt_message, but the message can be any bytes-like object (a memoryview, a mmap...) and the result
+    is written into output, so neither the message nor the result is copied
+    :param message: message with the following structure: IV + encrypted symmetric key + encrypted message
+    :param receiver_private_key: RsaKey to decrypt symmetric key
+    :param output: writable bytes-like object (a bytearray, a mmap...) with room for at least the length of the
+    encrypted message (len(message) - IV_LEN - size of the key)
+    :return: length of the decrypted message, which is written at the beginning of output
+    :raise: ValueError if the message is truncated or the padding is not correct
+    """
+    with memoryview(message) as data, memoryview(output) as out:
+        key_end = IV_LEN + receiver_private_key.size_in_bytes()  # Assume encryption has been done with same key size
+        enc_message_len = len(data) - key_end
+        if enc_message_len < AES.block_size or enc_message_len % AES.block_size:
+            raise ValueError("The encrypted message is incomplete")
+
+        cipher_rsa = PKCS1_OAEP.new(receiver_private_key)
+        aes_key = cipher_rsa.decrypt(bytes(data[IV_LEN:key_end]))
+
+        cipher_aes = AES.new(aes_key, AES.MODE_CBC, bytes(data[:IV_LEN]))
+        cipher_aes.decrypt(data[key_end:], output=out[:enc_message_len])
+        # Padding have to be removed
+        last_block = unpad(bytes(out[enc_message_len - AES.block_size:enc_message_len]), AES.block_size)
+        return enc_message_len - AES.block_size + len(last_block)
+
+
+class StreamEncryptor:
+    """
+    Encrypts a message chunk by chunk with the same hybrid scheme used by encrypt_message, so that
+    header + update(chunk_1) + ... + update(chunk_n) + finalize() can be decrypted by decrypt_message
+    """
+
+    def __init__(self, receiver_public_key: RsaKey, nbits: int = 256):
+        """
+        :param receiver_public_key: destination public key
+        :param nbits: number of bits of the symmetric key
+        """
+        aes_key = get_random_bytes(nbits // 8)
+        self._cipher = AES.new(aes_key, AES.MODE_CBC)
+        self._pending = b""  # Bytes that do not fill a whole AES block yet
+        self.header = self._cipher.iv + _encrypt_aes_key(aes_key, receiver_public_key)
+
+    @stats.timed("crypto.aes_encrypt", size_arg=1)
+    def update(self, data: bytes) -> bytes:
+        """
+        Encrypts the next chunk of the message. Trailing bytes that do not complete a block are kept until more
+        data is provided or finalize is called
+        :param data: next chunk of the message
+        :return: encrypted blocks available so far (may be empty)
+        """
+        if self._pending:
+            data = self._pending + data
+        full_blocks_len = len(data) - len(data) % AES.block_size
+        self._pending = data[full_blocks_len:]
+        return self._cipher.encrypt(data[:full_blocks_len])
+
+    def finalize(self) -> bytes:
+        """
+        Pads and encrypts the remaining bytes. No more data can be provided after calling it
+        :return: last encrypted block(s)
+        """
+        return self._cipher.encrypt(pad(self._pending, AES.block_size))
+
+
+class StreamDecryptor:
+    """
+    Decrypts chunk by chunk a message produced by encrypt_message or StreamEncryptor. The IV and the encrypted
+    symmetric key are taken from the first bytes provided
+    """
+
+    def __init__(self, receiver_private_key: RsaKey):
+        """
+        :param receiver_private_key: RsaKey to decrypt symmetric key
+        """
+        self._private_key = receiver_private_key
+        # Assume encryption has been done with same key size
+        self._header_len = IV_LEN + receiver_private_key.size_in_bytes()
+        self._cipher = None
+        self._pending = b""  # Bytes that cannot be processed yet
+
+    @stats.timed("crypto.aes_decrypt", size_arg=1)
+    def update(self, data: bytes) -> bytes:
+        """
+        Decrypts the next chunk of the message. The last block received is always kept until finalize is called,
+        as it may contain the padding
+        :param data: next chunk of the message
+        :return: decrypted data available so far (may be empty)
+        """
+        if self._pending:
+            data = self._pending + data
+
+        if self._cipher is None:
+            if len(data) < self._header_len:
+                self._pending = data
+                return b""
+            with stats.stage("crypto.rsa_unwrap"):
+                cipher_rsa = PKCS1_OAEP.new(self._private_key)
+                aes_key = cipher_rsa.decrypt(data[IV_LEN:self._header_len])
+            self._cipher = AES.new(aes_key, AES.MODE_CBC, data[:IV_LEN])
+            data = data[self._header_len:]
+
+        full_blocks_len = len(data) - len(data) % AES.block_size
+        if full_blocks_len == len(data):
+            full_blocks_len = max(full_blocks_len - AES.block_size, 0)
+        self._pending = data[full_blocks_len:]
+        return self._cipher.decrypt(data[:full_blocks_len])
+
+    def finalize(self) -> bytes:
+        """
+        Decrypts the last block and removes its padding
+        :return: last decrypted bytes
+        :raise: ValueError if the message is truncated or the padding is not correct
+        """
+        if self._cipher is None or len(self._pending) != AES.block_size:
+            raise ValueError("The encrypted message is incomplete")
+        return unpad(self._cipher.decrypt(self._pending), AES.block_size)  # Padding have to be removed
+
+
+class StreamVerifier:
+    """
+    Verifies chunk by chunk a message produced by sign_message (signature + original message), stripping the
+    signature from the data it returns
+    """
+
+    def __init__(self, sender_public_key: RsaKey):
+        """
+        :param sender_public_key: public key of the pretended sender
+        """
+        self._verifier = pkcs1_15.new(sender_public_key)
+        self._signature_len = sender_public_key.size_in_bytes()  # Assume signing has been done with same key size
+        self._signature = b""
+        self._hash = SHA256.new()
+
+    @stats.timed("crypto.sha256", size_arg=1)
+    def update(self, data: bytes) -> bytes:
+        """
+        Processes the next chunk of the signed message
+        :param data: next chunk of the message
+        :return: part of the original message contained in the chunk, without signature
+        """
+        missing = self._signature_len - len(self._signature)
+        if missing > 0:
+            self._signature += data[:missing]
+            data = data[missing:]
+        self._hash.update(data)
+        return data
+
+    def verify(self):
+        """
+        Checks the signature once the whole message has been processed
+        :raise: SignatureNotAuthentic if signature is not valid
+        """
+        try:
+            with stats.stage("crypto.rsa_verify"):
+                self._verifier.verify(self._hash, self._signature)
+        except ValueError:
+            raise SignatureNotAuthentic
+
+
+def is_framed(message: bytes) -> bool:
+    """
+    :param message: the message, or at least its first bytes
+    :return: true if the message uses the framed format, false if it is a legacy (CBC) one
+    """
+    return len(message) > len(MAGIC) and message[:len(MAGIC)] == MAGIC and message[len(MAGIC)] == FRAMED_VERSION
+
+
+def key_fingerprint(key: RsaKey) -> bytes:
+    """
+    :param key: public or private key
+    :return: short identifier of the key pair, used to find the slot of a recipient in a message
+    """
+    return SHA256.new(key.publickey().export_key("DER")).digest()[:FINGERPRINT_LEN]
+
+
+def _wrap_key_for_recipients(key: bytes, receiver_public_keys: List[RsaKey]) -> bytes:
+    """
+    Builds the recipient table of a message with the FLAG_RECIPIENTS flag
+    :param key: symmetric key of the message
+    :param receiver_public_keys: public keys of the recipients
+    :return: the table
+    """
+    table = [struct.pack(">H", len(receiver_public_keys))]
+    for public_key in receiver_public_keys:
+        wrapped_key = _encrypt_aes_key(key, public_key)
+        table.append(key_fingerprint(public_key) + struct.pack(">H", len(wrapped_key)) + wrapped_key)
+    return b"".join(table)
+
+
+def _frame_cipher(cipher_id: int, key: bytes, index: int, frame_type: int, header: bytes):
+    """
+    Creates the AEAD cipher of a frame. As the key is different for every message, the nonce only has to be
+    unique inside it: it is the index of the frame followed by its type
+    """
+    nonce = index.to_bytes(11, "big") + bytes([frame_type])
+    if cipher_id == CIPHERS["aes-gcm"]:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_LEN)
+    elif cipher_id == CIPHERS["chacha20"]:
+        cipher = ChaCha20_Poly1305.new(key=key, nonce=nonce)
+    else:
+        raise ValueError(f"Unknown cipher {cipher_id}")
+    # Every frame authenticates the header, so it cannot be modified either
+    cipher.update(header)
+    return cipher
+
+
+def _encrypt_frame(cipher_id: int, key: bytes, index: int, frame_type: int, header: bytes, data: bytes) -> bytes:
+    ciphertext, tag = _frame_cipher(cipher_id, key, index, frame_type, header).encrypt_and_digest(data)
+    return ciphertext + tag
+
+
+def _decrypt_frame(cipher_id: int, key: bytes, index: int, frame_type: int, header: bytes, frame: bytes) -> bytes:
+    try:
+        return _frame_cipher(cipher_id, key, index, frame_type, header).decrypt_and_verify(frame[:-TAG_LEN],
+                                                                                        frame[-TAG_LEN:])
+    except ValueError:
+        raise MessageNotAuthentic
+
+
+class FramedHeader:
+    """
+    Header of a framed message
+    """
+
+    def __init__(self, cipher_id: int, flags: int, frame_size: int, signature_len: int, wrapped_key: bytes):
+        self.cipher_id = cipher_id
+        self.flags = flags
+        self.frame_size = frame_size
+        self.signature_len = signature_len
+        self.wrapped_key = wrapped_key
+        if len(wrapped_key) > 0xFFFF:
+            raise ValueError("Too many recipients for a single message")
+        self.raw = _FRAMED_HEADER.pack(MAGIC, FRAMED_VERSION, cipher_id, flags, frame_size, signature_len,
+                                       len(wrapped_key)) + wrapped_key
+
+    @staticmethod
+    def parse(data: bytes) -> "FramedHeader":
+        """
+        :param data: first bytes of the message
+        :return: the header, or None if more bytes are needed to parse it
+        :raise: ValueError if the message is not a framed one, or its frame size is not valid
+        """
+        if len(data) < _FRAMED_HEADER.size:
+            return None
+        magic, version, cipher_id, flags, frame_size, signature_len, key_len = _FRAMED_HEADER.unpack_from(data)
+        if magic != MAGIC or version != FRAMED_VERSION:
+            raise ValueError("The message does not use the framed format")
+        if not 0 < frame_size <= MAX_FRAME_SIZE:
+            raise ValueError(f"Invalid frame size in the header of the message: {frame_size}")
+        if len(data) < _FRAMED_HEADER.size + key_len:
+            return None
+        return FramedHeader(cipher_id, flags, frame_size, signature_len,
+                            bytes(data[_FRAMED_HEADER.size:_FRAMED_HEADER.size + key_len]))
+
+    def unwrap_key(self, receiver_private_key: RsaKey) -> bytes:
+        """
+        Decrypts the symmetric key of the message, looking for the slot of the receiver if there are several
+        :param receiver_private_key: RsaKey of the receiver
+        :return: the symmetric key
+        :raise: NotARecipient if the message has not been encrypted for the key
+        """
+        cipher_rsa = PKCS1_OAEP.new(receiver_private_key)
+        if not self.flags & FLAG_RECIPIENTS:
+            try:
+                return cipher_rsa.decrypt(self.wrapped_key)
+            except ValueError:
+                raise NotARecipient
+
+        fingerprint = key_fingerprint(receiver_private_key)
+        count, = struct.unpack_from(">H", self.wrapped_key)
+        position = 2
+        for _ in range(count):
+            slot_fingerprint = self.wrapped_key[position:position + FINGERPRINT_LEN]
+            wrapped_key_len, = struct.unpack_from(">H", self.wrapped_key, position + FINGERPRINT_LEN)
+            position += FINGERPRINT_LEN + 2
+            if slot_fingerprint == fingerprint:
+                try:
+                    return cipher_rsa.decrypt(self.wrapped_key[position:position + wrapped_key_len])
+                except ValueError:
+                    break
+            position += wrapped_key_len
+        raise NotARecipient
+
+    @property
+    def compression(self) -> Optional[str]:
+        """
+        :return: name of the algorithm the message was compressed with, or None if it was not compressed
+        :raise: ValueError if the algorithm is unknown
+        """
+        compression_id = self.flags >> _COMPRESSION_SHIFT
+        if not compression_id:
+            return None
+        for name, identifier in COMPRESSIONS.items():
+            if identifier == compression_id:
+                return name
+        raise ValueError(f"Unknown compression {compression_id}")
+
+    @property
+    def trailer_len(self) -> int:
+        """
+        :return: length of the encrypted signature at the end of the message (0 if it is not signed)
+        """
+        return self.signature_len + TAG_LEN if self.flags & FLAG_SIGNED else 0
+
+    @property
+    def frame_len(self) -> int:
+        """
+        :return: length of a full encrypted frame
+        """
+        return self.frame_size + TAG_LEN
+
+
+def byte_entropy(data: bytes) -> float:
+    """
+    :return: Shannon entropy of the bytes of data, in bits per byte (from 0 to 8)
+    """
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in _byte_histogram(data) if count)
+
+
+def _byte_histogram(data: bytes) -> List[int]:
+    # bytes.count runs in C, which is much faster than counting in Python for samples of some KB
+    return [data.count(byte) for byte in range(256)]
+
+
+def choose_compression(sample: bytes) -> Optional[str]:
+    """
+    Decides whether it is worth compressing a message from a sample of it, and how. Only algorithms of the standard
+    library are chosen, so that any receiver can decompress the message: the sample is compressed with zlib and with
+    a fast preset of lzma, and lzma is chosen if it is clearly better (as with many binary files), since it is much
+    slower than zlib
+    :param sample: some bytes of the message (a few KB from different parts of it are enough)
+    :return: the algorithm to compress the message with (zlib or lzma), or None if the message looks incompressible
+    """
+    if byte_entropy(sample) > COMPRESSION_MAX_ENTROPY:
+        return None
+    import lzma
+    if len(lzma.compress(sample, preset=1)) <= LZMA_MIN_GAIN * len(zlib.compress(sample, 6)):
+        return "lzma"
+    return "zlib"
+
+
+def _import_zstandard():
+    # Optional dependency, only imported when it is used
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstandard required: zstd compression needs the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def _compressor(compression: str):
+    """
+    :return: object with compress and flush methods that compresses a stream with the algorithm
+    """
+    if compression == "zlib":
+        return zlib.compressobj(6)
+    if compression == "lzma":
+        import lzma
+        return lzma.LZMACompressor()
+    if compression == "zstd":
+        return _import_zstandard().ZstdCompressor().compressobj()
+    raise ValueError(f"Unknown compression {compression}")
+
+
+class _Decompressor:
+    """
+    Decompresses a stream given in chunks, returning the result in pieces of at most CHUNK_SIZE bytes as they are
+    consumed. The output is never produced all at once, so a small message that decompresses to a huge one (which
+    may not have been authenticated yet) does not have to fit in memory
+    """
+
+    def __init__(self, compression: str):
+        """
+        :param compression: algorithm the stream is compressed with
+        """
+        self._compression = compression
+        if compression == "zlib":
+            self._decompressor = zlib.decompressobj()
+        elif compression == "lzma":
+            import lzma
+            self._decompressor = lzma.LZMADecompressor()
+        elif compression == "zstd":
+            zstandard = _import_zstandard()
+            # The decompressors of zstandard that are given the input cannot limit their output, so the input is
+            # pulled by a reader instead (see read)
+            self._input = bytearray()
+            self._pieces = zstandard.ZstdDecompressor().read_to_iter(self, read_size=CHUNK_SIZE,
+                                                                     write_size=CHUNK_SIZE)
+        else:
+            raise ValueError(f"Unknown compression {compression}")
+
+    def read(self, size: int) -> bytes:
+        # Called by zstandard to get more input. It takes an empty result as the end of the stream, so pieces are only
+        # pulled while there is input left (see decompress) or once all of it has been given (see finish)
+        data = bytes(self._input[:size])
+        del self._input[:size]
+        return data
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        """
+        :param data: next chunk of the compressed stream
+        :return: iterator over the pieces of data decompressed from it. With zstd, some of them may only be returned
+        with the next chunk or by finish
+        """
+        if self._compression == "zlib":
+            while True:
+                piece = self._decompressor.decompress(data, CHUNK_SIZE)
+                if piece:
+                    yield piece
+                data = self._decompressor.unconsumed_tail
+                # A full piece may leave more output pending even if all the input has been consumed
+                if not data and len(piece) < CHUNK_SIZE:
+                    return
+        elif self._compression == "lzma":
+            while not self._decompressor.eof:
+                piece = self._decompressor.decompress(data, CHUNK_SIZE)
+                data = b""
+                if piece:
+                    yield piece
+                if self._decompressor.needs_input:
+                    return
+        else:
+            self._input += data
+            while self._input:
+                piece = next(self._pieces, None)
+                if piece is None:
+                    return
+                yield piece
+
+    def finish(self) -> Iterator[bytes]:
+        """
+        :return: iterator over the pieces of data still pending once all the stream has been given to decompress
+        """
+        if self._compression == "zlib":
+            piece = self._decompressor.flush()
+            if piece:
+                yield piece
+        elif self._compression == "zstd":
+            yield from self._pieces
+
+    @property
+    def eof(self) -> bool:
+        """
+        :return: whether the end of the compressed stream has been reached. zstd streams are always taken as complete
+        """
+        return getattr(self._decompressor, "eof", True) if self._compression != "zstd" else True
+
+
+def _encrypt_segment(cipher_id: int, key: bytes, first_index: int, header: bytes, frame_size: int,
+                     data: memoryview, output: memoryview, hashed: bool) -> List[bytes]:
+    """
+    Encrypts a segment of consecutive (non-final) frames. Segments are independent, so they can be encrypted in
+    parallel: pycryptodome releases the GIL while encrypting and hashing, and the frames are written straight to
+    their place in the result, so that they do not have to be copied (holding the GIL) to join them
+    :param first_index: index of the first frame of the segment
+    :param data: plaintext of the frames (a multiple of frame_size)
+    :param output: where the encrypted frames are written, each one followed by its tag
+    :param hashed: if true, the SHA256 of every frame is computed for the signature
+    :return: the SHA256 of each frame (empty if hashed is false)
+    """
+    digests = []
+    frame_len = frame_size + TAG_LEN
+    for n, start in enumerate(range(0, len(data), frame_size)):
+        frame = data[start:start + frame_size]
+        if hashed:
+            digests.append(SHA256.new(frame).digest())
+        cipher = _frame_cipher(cipher_id, key, first_index + n, _DATA_FRAME, header)
+        position = n * frame_len
+        cipher.encrypt(frame, output=output[position:position + frame_size])
+        output[position + frame_size:position + frame_len] = cipher.digest()
+    return digests
+
+
+def _decrypt_segment(cipher_id: int, key: bytes, first_index: int, header: bytes, frame_len: int,
+                     data: memoryview, output: memoryview, hashed: bool) -> List[bytes]:
+    """
+    Decrypts a segment of consecutive (non-final) frames, the counterpart of _encrypt_segment
+    :param data: the encrypted frames (a multiple of frame_len)
+    :param output: where the plaintext of the frames is written. If a frame is not authentic, it may have been
+    written anyway, so output must be discarded
+    :return: the SHA256 of each frame (empty if hashed is false)
+    """
+    digests = []
+    frame_size = frame_len - TAG_LEN
+    for n, start in enumerate(range(0, len(data), frame_len)):
+        plaintext = output[n * frame_size:(n + 1) * frame_size]
+        cipher = _frame_cipher(cipher_id, key, first_index + n, _DATA_FRAME, header)
+        cipher.decrypt(data[start:start + frame_size], output=plaintext)
+        try:
+            cipher.verify(data[start + frame_size:start + frame_len])
+        except ValueError:
+            raise MessageNotAuthentic
+        if hashed:
+            digests.append(SHA256.new(plaintext).digest())
+    return digests
+
+
+class _SegmentProcessor:
+    """
+    Base of FramedEncryptor and FramedDecryptor. Splits the frames available into segments, which are processed in
+    a pool of threads if there is more than one worker, writing their results in order to a single buffer
+    """
+
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self._workers = workers
+
+    def _process(self, function, cipher_id: int, key: bytes, first_index: int, header: bytes, size: int,
+                 output_size: int, data: memoryview, frames: int, digest) -> bytes:
+        """
+        Runs function (_encrypt_segment or _decrypt_segment) over the first frames of data
+        :param size: length of a frame in data
+        :param output_size: length of a frame in the result
+        :param frames: number of frames to be processed
+        :param digest: if not None, the SHA256 of each frame is added to it, in order
+        :return: the result of all the frames (a bytearray)
+        """
+        if not frames:
+            return b""
+        output = bytearray(frames * output_size)
+        output_view = memoryview(output)
+        # Small segments would spend more time dispatching them than processing them
+        per_segment = max(SEGMENT_SIZE // size, 1, -(-frames // (self._workers * 4)))
+        starts = range(0, frames, per_segment)
+        ends = [min(n + per_segment, frames) for n in starts]
+        segments = len(starts)
+        arguments = ([cipher_id] * segments, [key] * segments, [first_index + n for n in starts],
+                     [header] * segments, [size] * segments,
+                     [data[n * size:end * size] for n, end in zip(starts, ends)],
+                     [output_view[n * output_size:end * output_size] for n, end in zip(starts, ends)],
+                     [digest is not None] * segments)
+        results = self._executor.map(function, *arguments) if self._executor else map(function, *arguments)
+
+        for digests in results:
+            for frame_digest in digests:
+                digest.update(frame_digest)
+        return output
+
+    def _shutdown(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class FramedEncryptor(_SegmentProcessor):
+    """
+    Encrypts a message in the framed format: a header with the symmetric key wrapped with RSA-OAEP, followed by
+    frames of frame_size bytes encrypted with an AEAD cipher (AES-GCM or ChaCha20-Poly1305) and, if it is signed,
+    the signature encrypted as one last frame. Each frame is authenticated on its own, so the message can be
+    decrypted as it is received, or just a range of it, and frames can be encrypted in parallel. The signature is
+    computed over the header and the SHA256 of every frame, so the message is read only once. Optionally, the message
+    is compressed before being split in frames
+    """
+
+    def __init__(self, receiver_public_key: Union[RsaKey, List[RsaKey]], sender_private_key: RsaKey = None,
+                 cipher: str = "aes-gcm", frame_size: int = FRAME_SIZE, workers: int = 1,
+                 compression: str = None):
+        """
+        :param receiver_public_key: destination public key, or a list of them. In the latter case the message is
+        encrypted once and its key is wrapped for each recipient
+        :param sender_private_key: if provided, the message will be signed with it
+        :param cipher: AEAD cipher used, either aes-gcm or chacha20
+        :param frame_size: bytes of the message in each frame
+        :param workers: number of threads encrypting frames. Only chunks passed to update with several frames
+        can be split between them
+        :param compression: if provided, algorithm the message is compressed with (zlib, lzma or zstd, which
+        requires the zstandard package)
+        """
+        super().__init__(workers)
+        self._compressor = _compressor(compression) if compression else None
+        self._key = get_random_bytes(32)
+        self._private_key = sender_private_key
+        signature_len = sender_private_key.size_in_bytes() if sender_private_key else 0
+        flags = FLAG_SIGNED if sender_private_key else 0
+        if isinstance(receiver_public_key, list):
+            flags |= FLAG_RECIPIENTS
+            wrapped_key = _wrap_key_for_recipients(self._key, receiver_public_key)
+        else:
+            wrapped_key = _encrypt_aes_key(self._key, receiver_public_key)
+        if compression:
+            flags |= COMPRESSIONS[compression] << _COMPRESSION_SHIFT
+        self._header = FramedHeader(CIPHERS[cipher], flags, frame_size, signature_len, wrapped_key)
+        self.header = self._header.raw
+        self._digest = SHA256.new(self.header) if sender_private_key else None
+        # Bytes of the next frames. It is a bytearray, so that data given in small chunks is not copied every time
+        self._pending = bytearray()
+        self._index = 0
+
+    @stats.timed("crypto.aead_encrypt", size_arg=1)
+    def update(self, data: bytes) -> bytes:
+        """
+        Encrypts the next chunk of the message. As the last frame is marked, a frame is only encrypted once it is
+        known that more data follows it
+        :param data: next chunk of the message
+        :return: frames available so far (may be empty)
+        """
+        if self._compressor:
+            with stats.stage("compress", len(data)):
+                data = self._compressor.compress(data)
+        return self._encrypt_frames(data)
+
+    def _encrypt_frames(self, data: bytes) -> bytes:
+        if self._pending:
+            self._pending += data
+            data = self._pending
+        frame_size = self._header.frame_size
+        frames = max((len(data) - 1) // frame_size, 0)
+        result = b""
+        if frames:
+            result = self._process(_encrypt_segment, self._header.cipher_id, self._key, self._index, self.header,
+                                   frame_size, self._header.frame_len, memoryview(data), frames, self._digest)
+            self._index += frames
+            # The rest goes to a new bytearray, since the one the frames were taken from cannot be resized while
+            # there are views of it
+            data = data[frames * frame_size:]
+        self._pending = data if data is self._pending else bytearray(data)
+        return result
+
+    def finalize(self) -> bytes:
+        """
+        Encrypts the last frame and the signature. No more data can be provided after calling it
+        :return: the end of the message
+        """
+        result = b""
+        if self._compressor:
+            with stats.stage("compress"):
+                result = self._encrypt_frames(self._compressor.flush())
+        self._shutdown()
+        if self._digest:
+            self._digest.update(SHA256.new(self._pending).digest())
+        last_frame = _encrypt_frame(self._header.cipher_id, self._key, self._index, _FINAL_FRAME, self.header,
+                                    self._pending)
+        if not self._private_key:
+            return result + last_frame
+        with stats.stage("crypto.rsa_sign"):
+            signature = pkcs1_15.new(self._private_key).sign(self._digest)
+        signature_frame = _encrypt_frame(self._header.cipher_id, self._key, self._index + 1, _SIGNATURE_FRAME,
+                                         self.header, signature)
+        return result + last_frame + signature_frame
+
+
+class FramedDecryptor(_SegmentProcessor):
+    """
+    Decrypts chunk by chunk a message produced by FramedEncryptor, verifying its signature if a public key is
+    provided. Frames are only returned once they have been authenticated, but the signature can only be checked in
+    finalize, so the data returned should not be trusted until then. Compressed messages are decompressed as they
+    are decrypted
+    """
+
+    def __init__(self, receiver_private_key: RsaKey, sender_public_key: RsaKey = None, workers: int = 1):
+        """
+        :param receiver_private_key: RsaKey to decrypt symmetric key
+        :param sender_public_key: if provided, the signature of the message will be verified with it
+        :param workers: number of threads decrypting frames. Only chunks passed to update with several frames
+        can be split between them
+        """
+        super().__init__(workers)
+        self._private_key = receiver_private_key
+        self._public_key = sender_public_key
+        self._header = None
+        self._key = None
+        self._digest = None
+        self._decompressor = None
+        self._pending = bytearray()  # Bytes of the next frames, as in FramedEncryptor
+        self._index = 0
+
+    def update(self, data: bytes) -> bytes:
+        """
+        Decrypts the next chunk of the message. The last frame and the signature are kept until finalize is called.
+        The whole result is returned at once, so update_chunks should be used instead when the message may be
+        compressed and comes from an untrusted source
+        :param data: next chunk of the message
+        :return: decrypted data available so far (may be empty)
+        :raise: MessageNotAuthentic if a frame has been modified
+        """
+        return b"".join(self.update_chunks(data))
+
+    @stats.timed("crypto.aead_decrypt", size_arg=1)
+    def update_chunks(self, data: bytes) -> Iterator[bytes]:
+        """
+        Decrypts the next chunk of the message, as update does, but returns the decrypted data in pieces. When the
+        message is compressed, each piece is decompressed as it is consumed and has at most CHUNK_SIZE bytes
+        :param data: next chunk of the message
+        :return: iterator over the decrypted data available so far
+        :raise: MessageNotAuthentic if a frame has been modified
+        """
+        if self._pending:
+            self._pending += data
+            data = self._pending
+
+        if self._header is None:
+            self._header = FramedHeader.parse(data)
+            if self._header is None:
+                self._pending = data if data is self._pending else bytearray(data)
+                return iter(())
+            with stats.stage("crypto.rsa_unwrap"):
+                self._key = self._header.unwrap_key(self._private_key)
+            if self._public_key and self._header.flags & FLAG_SIGNED:
+                self._digest = SHA256.new(self._header.raw)
+            if self._header.compression:
+                self._decompressor = _Decompressor(self._header.compression)
+            data = data[len(self._header.raw):]
+
+        # A frame can only be the last one if there is not more than a frame and the trailer after it
+        frame_len = self._header.frame_len
+        frames = max((len(data) - self._header.trailer_len - 1) // frame_len, 0)
+        result = b""
+        if frames:
+            result = self._process(_decrypt_segment, self._header.cipher_id, self._key, self._index,
+                                   self._header.raw, frame_len, self._header.frame_size, memoryview(data), frames,
+                                   self._digest)
+            self._index += frames
+            data = data[frames * frame_len:]
+        self._pending = data if data is self._pending else bytearray(data)
+        return self._decompress(result)
+
+    def _decompress(self, data: bytes) -> Iterator[bytes]:
+        if not self._decompressor:
+            return iter((data,) if data else ())
+        return self._timed_pieces(self._decompressor.decompress(data))
+
+    @staticmethod
+    def _timed_pieces(pieces: Iterator[bytes]) -> Iterator[bytes]:
+        # Only the time spent producing each piece is measured, not the time the caller spends with it
+        while True:
+            start = time.perf_counter()
+            piece = next(pieces, None)
+            if piece is None:
+                return
+            if stats.enabled:
+                stats.add("decompress", time.perf_counter() - start, len(piece))
+            yield piece
+
+    def finalize(self) -> bytes:
+        """
+        Decrypts the last frame and verifies the signature. The whole result is returned at once (see
+        finalize_chunks)
+        :return: last decrypted bytes
+        :raise: MessageNotAuthentic if the message has been modified or truncated, SignatureNotAuthentic if the
+        signature is not valid (or the message is not signed)
+        """
+        return b"".join(self.finalize_chunks())
+
+    def finalize_chunks(self) -> Iterator[bytes]:
+        """
+        Decrypts the last frame and verifies the signature, as finalize does, but returns the decrypted data in
+        pieces. The signature is verified before returning, while the last frames are decompressed as the pieces are
+        consumed
+        :return: iterator over the last decrypted data
+        :raise: MessageNotAuthentic if the message has been modified or truncated, SignatureNotAuthentic if the
+        signature is not valid (or the message is not signed)
+        """
+        self._shutdown()
+        if self._header is None or len(self._pending) < TAG_LEN + self._header.trailer_len:
+            raise MessageNotAuthentic
+        last_frame_end = len(self._pending) - self._header.trailer_len
+        data = _decrypt_frame(self._header.cipher_id, self._key, self._index, _FINAL_FRAME, self._header.raw,
+                              self._pending[:last_frame_end])
+
+        if self._public_key:
+            if not self._header.flags & FLAG_SIGNED:
+                raise SignatureNotAuthentic
+            self._digest.update(SHA256.new(data).digest())
+            signature = _decrypt_frame(self._header.cipher_id, self._key, self._index + 1, _SIGNATURE_FRAME,
+                                       self._header.raw, self._pending[last_frame_end:])
+            try:
+                with stats.stage("crypto.rsa_verify"):
+                    pkcs1_15.new(self._public_key).verify(self._digest, signature)
+            except ValueError:
+                raise SignatureNotAuthentic
+        if not self._decompressor:
+            return iter((data,) if data else ())
+        return self._finish_decompression(data)
+
+    def _finish_decompression(self, data: bytes) -> Iterator[bytes]:
+        yield from self._decompress(data)
+        yield from self._timed_pieces(self._decompressor.finish())
+        if not self._decompressor.eof:
+            # The frames are authentic, so the compressed stream can only be incomplete if it was created that way
+            raise MessageNotAuthentic
+
+
+def encrypt_framed_message(message: bytes, receiver_public_key: Union[RsaKey, List[RsaKey]],
+                           sender_private_key: RsaKey = None, cipher: str = "aes-gcm", workers: int = 1,
+                           compression: str = None) -> bytes:
+    """
+    Encrypts (and optionally signs) a message in the framed format
+    :param message: message to be encrypted
+    :param receiver_public_key: destination public key, or a list of them to encrypt the message once for all
+    :param sender_private_key: if provided, the message will be signed with it
+    :param cipher: AEAD cipher used, either aes-gcm or chacha20
+    :param workers: number of threads encrypting frames (os.cpu_count() is a good choice for large messages)
+    :param compression: if provided, algorithm the message is compressed with before being encrypted (zlib, lzma
+    or zstd). "auto" chooses one with choose_compression, or none if the message looks incompressible
+    :return: the framed message
+    """
+    if compression == "auto":
+        compression = choose_compression(message[:64 * 1024])
+    encryptor = FramedEncryptor(receiver_public_key, sender_private_key, cipher, workers=workers,
+                                compression=compression)
+    return b"".join((encryptor.header, encryptor.update(message), encryptor.finalize()))
+
+
+def decrypt_framed_message(message: bytes, receiver_private_key: RsaKey, sender_public_key: RsaKey = None,
+                           workers: int = 1) -> bytes:
+    """
+    Decrypts a framed message, verifying its signature if a public key is provided
+    :param message: message produced by encrypt_framed_message or FramedEncryptor
+    :param receiver_private_key: RsaKey to decrypt symmetric key
+    :param sender_public_key: if provided, the signature of the message will be verified with it
+    :param workers: number of threads decrypting frames
+    :return: decrypted message
+    :raise: MessageNotAuthentic if the message has been modified, SignatureNotAuthentic if the signature is not
+    valid, NotARecipient if the message has not been encrypted for the key
+    """
+    decryptor = FramedDecryptor(receiver_private_key, sender_public_key, workers)
+    return b"".join((decryptor.update(message), decryptor.finalize()))
+
+
+def decrypt_range(file: BinaryIO, receiver_private_key: RsaKey, offset: int, length: int) -> bytes:
+    """
+    Decrypts part of a framed message stored in a file, reading only the frames that contain it. Every frame read
+    is authenticated, but the signature is not verified, since that requires the whole message
+    :param file: file opened in binary mode with the framed message
+    :param receiver_private_key: RsaKey to decrypt symmetric key
+    :param offset: position of the first byte wanted in the decrypted message
+    :param length: maximum number of bytes wanted
+    :return: the decrypted bytes (less than length if the end of the message is reached)
+    :raise: MessageNotAuthentic if a frame read has been modified, ValueError if the message is compressed (its
+    frames cannot be decompressed on their own)
+    """
+    file.seek(0)
+    data = file.read(_FRAMED_HEADER.size)
+    if len(data) == _FRAMED_HEADER.size:
+        # The header ends with the length of the wrapped key (or of the recipient table)
+        data += file.read(struct.unpack_from(">H", data, _FRAMED_HEADER.size - 2)[0])
+    header = FramedHeader.parse(data)
+    if header is None:
+        raise MessageNotAuthentic
+    if header.compression:
+        raise ValueError("Ranges of compressed messages cannot be decrypted")
+    key = header.unwrap_key(receiver_private_key)
+
+    frames_start = len(header.raw)
+    frames_len = file.seek(0, 2) - frames_start - header.trailer_len
+    frame_len = header.frame_len
+    frames_count = max(-(-frames_len // frame_len), 1)
 
-    cipher_rsa = PKCS1_OAEP.new(receiver_private_key)
-    aes_key = cipher_rsa.decrypt(enc_aes_key)
+    first = offset // header.frame_size
+    last = min((offset + max(length, 1) - 1) // header.frame_size, frames_count - 1)
+    data = []
+    for index in range(first, last + 1):
+        file.seek(frames_start + index * frame_len)
+        frame = file.read(min(frame_len, frames_len - index * frame_len))
+        frame_type = _FINAL_FRAME if index == frames_count - 1 else _DATA_FRAME
+        data.append(_decrypt_frame(header.cipher_id, key, index, frame_type, header.raw, frame))
 
-    cipher_aes = AES.new(aes_key, AES.MODE_CBC, iv)
-    return unpad(cipher_aes.decrypt(enc_message), AES.block_size)  # Padding have to be removed
+    start = offset - first * header.frame_size
+    return b"".join(data)[start:start + length]
@@ -0,0 +1,169 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator
+
+_END = object()  # Marks the end of an iterator in Stats.iterate
+
+
+class Stats:
+    """
+    Accumulates the time spent and the bytes processed in each stage of an operation (reading files, hashing,
+    AES, HTTP requests...), so that it can be seen where the time goes. It is disabled by default, in which case
+    measuring a stage costs a single attribute check. It can be shared between threads
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # Stage name -> [calls, seconds, bytes]
+        self._stages = {}
+        self._lock = Lock()
+        self._start = time.perf_counter()
+
+    def enable(self):
+        """
+        Starts measuring, discarding what had been measured before
+        """
+        self.reset()
+        self.enabled = True
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._start = time.perf_counter()
+
+    def add(self, name: str, seconds: float, nbytes: int = 0):
+        """
+        Records a call to a stage
+        :param name: name of the stage
+        :param seconds: time spent in the call
+        :param nbytes: bytes processed in the call
+        """
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = [0, 0.0, 0]
+            stage[0] += 1
+            stage[1] += seconds
+            stage[2] += nbytes
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int = 0):
+        """
+        Measures the code run inside a with statement as a call to a stage
+        :param name: name of the stage
+        :param nbytes: bytes processed inside the with statement
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, nbytes)
+
+    def timed(self, name: str, size_arg: int = None) -> Callable:
+        """
+        Decorator that measures every call to a function as a call to a stage
+        :param name: name of the stage
+        :param size_arg: position of the argument whose length is the number of bytes processed (counting self in
+        methods). If not provided, no bytes are counted
+        """
+        def decorator(function: Callable) -> Callable:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    nbytes = len(args[size_arg]) if size_arg is not None and size_arg < len(args) else 0
+                    self.add(name, time.perf_counter() - start, nbytes)
+            return wrapper
+        return decorator
+
+    def iterate(self, name: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Measures the time spent producing each chunk of an iterable (e.g. reading a file or receiving a response),
+        but not the time spent by the consumer
+        :param name: name of the stage
+        :param chunks: iterable of bytes
+        :return: iterator over the same chunks
+        """
+        if not self.enabled:
+            yield from chunks
+            return
+        iterator = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(iterator, _END)
+            if chunk is _END:
+                return
+            self.add(name, time.perf_counter() - start, len(chunk))
+            yield chunk
+
+    def report(self) -> Dict[str, dict]:
+        """
+        :return: a dictionary with the calls, seconds and bytes of every stage, plus the wall-clock time since
+        measuring started under the key "total"
+        """
+        with self._lock:
+            report = {name: {"calls": calls, "seconds": seconds, "bytes": nbytes}
+                      for name, (calls, seconds, nbytes) in sorted(self._stages.items())}
+            report["total"] = {"calls": 1, "seconds": time.perf_counter() - self._start, "bytes": 0}
+        return report
+
+    def format_table(self) -> str:
+        """
+        :return: the report as a human-readable table, with the slowest stages first
+        """
+        report = self.report()
+        total = report.pop("total")["seconds"]
+        lines = [f"{'Stage':28} {'Calls':>8} {'Seconds':>10} {'% wall':>7} {'MB':>10} {'MB/s':>9}"]
+        for name, stage in sorted(report.items(), key=lambda item: -item[1]["seconds"]):
+            mb = stage["bytes"] / 1024 ** 2
+            speed = f"{mb / stage['seconds']:9.1f}" if stage["bytes"] and stage["seconds"] else " " * 9
+            lines.append(f"{name:28} {stage['calls']:8} {stage['seconds']:10.3f} "
+                         f"{stage['seconds'] / total:7.1%} {mb:10.2f} {speed}")
+        lines.append(f"{'wall-clock':28} {'':8} {total:10.3f}")
+        return "\n".join(lines)
+
+    def format_prometheus(self) -> str:
+        """
+        :return: the report in the Prometheus text exposition format, to be exported with the textfile collector
+        of node_exporter
+        """
+        report = self.report()
+        lines = []
+        for metric, field, description in [("calls", "calls", "Calls to each stage"),
+                                           ("seconds", "seconds", "Time spent in each stage"),
+                                           ("bytes", "bytes", "Bytes processed by each stage")]:
+            lines.append(f"# HELP securebox_stage_{metric}_total {description}")
+            lines.append(f"# TYPE securebox_stage_{metric}_total counter")
+            for name, stage in report.items():
+                lines.append(f'securebox_stage_{metric}_total{{stage="{name}"}} {stage[field]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename: str):
+        """
+        Writes the report to a file: in the Prometheus format if its extension is .prom, or as JSON if not.
+        The file is replaced atomically, so a collector never reads it half-written
+        """
+        if filename.endswith(".prom"):
+            content = self.format_prometheus()
+        else:
+            content = json.dumps(self.report(), indent=2)
+
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            f.write(content)
+        os.replace(temp_filename, filename)
+
+
+# Measurements of the whole process, used by sb_crypto, sb_api and securebox
+stats = Stats()
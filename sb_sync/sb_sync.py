@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from sb_crypto.sb_crypto import SHA256, read_chunks
+
+
+def scan_directory(directory: str) -> Iterator[Tuple[str, int, int]]:
+    """
+    Lists the files inside a directory (recursively) using os.scandir, which gets their size and modification
+    time without an extra system call per file on most platforms
+    :param directory: directory to be scanned
+    :return: iterator over tuples with the absolute path, the size and the modification time (in ns) of each file
+    """
+    pending = [os.path.abspath(directory)]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def file_hash(filename: str) -> str:
+    """
+    :return: the SHA256 of the content of a file, in hexadecimal
+    """
+    h = SHA256.new()
+    with open(filename, "rb") as f:
+        for chunk in read_chunks(f):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SyncIndex:
+    """
+    Local index of the files synchronized with SecureBox, stored in a SQLite database. For each file and receiver
+    it keeps the size, modification time and content hash the file had when it was uploaded, and the ID it got
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: SQLite database. It is created if it does not exist
+        """
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS synced_files (
+                                       path TEXT NOT NULL,
+                                       receiver_id TEXT NOT NULL,
+                                       size INTEGER NOT NULL,
+                                       mtime_ns INTEGER NOT NULL,
+                                       content_hash TEXT NOT NULL,
+                                       file_id TEXT NOT NULL,
+                                       synced_at REAL NOT NULL,
+                                       PRIMARY KEY (path, receiver_id))""")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def entries(self, receiver_id: str, directory: str) -> Dict[str, Tuple[int, int, str, str]]:
+        """
+        Gets the files of a directory synchronized with a receiver
+        :param receiver_id: ID of the receiver
+        :param directory: directory whose files (recursively) are returned
+        :return: a dictionary whose keys are the absolute paths of the files and its values tuples with their size,
+        modification time (in ns), content hash and file ID
+        """
+        prefix = os.path.join(os.path.abspath(directory), "")
+        # Prefixes are compared with a range instead of LIKE, so that the primary key index is used
+        rows = self.connection.execute("""SELECT path, size, mtime_ns, content_hash, file_id FROM synced_files
+                                          WHERE receiver_id = ? AND path >= ? AND path < ?""",
+                                       (receiver_id, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+        return {path: (size, mtime_ns, content_hash, file_id) for path, size, mtime_ns, content_hash, file_id in rows}
+
+    def update(self, entries: Iterable[Tuple[str, str, int, int, str, str]]):
+        """
+        Adds or replaces files in the index, in a single transaction
+        :param entries: tuples with the path, receiver ID, size, modification time (in ns), content hash and file ID
+        of each file
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO synced_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        [entry + (now,) for entry in entries])
+
+    def file_ids(self) -> List[str]:
+        """
+        :return: the IDs of all the files in the index
+        """
+        return [file_id for file_id, in self.connection.execute("SELECT DISTINCT file_id FROM synced_files")]
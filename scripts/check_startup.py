@@ -0,0 +1,82 @@
+"""
+Checks that the CLI starts fast: heavy modules must not be imported by commands that do not need them, and the
+import time of the client must stay under a budget. It is meant to be run in CI from the root of the repository:
+
+    python scripts/check_startup.py [--budget_ms 80]
+
+It exits with status 1 if any check fails.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules only needed to encrypt, decrypt or transfer several files at once
+CRYPTO_MODULES = ["sb_crypto.sb_crypto", "Crypto.Signature", "Crypto.Cipher.ChaCha20_Poly1305",
+                  "Crypto.Cipher.PKCS1_OAEP", "concurrent.futures", "asyncio", "aiohttp", "multiprocessing"]
+# Modules that must not be imported by each command. The commands are run in an empty folder without input, so
+# they stop when they ask for the token of a new bundle, once they have imported what they need
+CHECKS = [
+    (["main.py", "--help"], ["requests", "Crypto", "asyncio", "aiohttp", "multiprocessing", "securebox", "sb_api"]),
+    (["main.py", "--list_files"], CRYPTO_MODULES),
+    (["main.py", "--search_id", "name"], CRYPTO_MODULES),
+    (["-c", "import securebox"], CRYPTO_MODULES + ["requests"]),
+]
+
+
+def import_times(command: list) -> dict:
+    """
+    Runs python -X importtime with the specified arguments
+    :return: a dictionary with the cumulative import time (in microseconds) of every module imported
+    """
+    if command[0] == "main.py":
+        command = [os.path.join(ROOT, "main.py")] + command[1:]
+    # The agent is not used, as a bundle taken from it would let the commands go on and contact the server
+    env = dict(os.environ, PYTHONPATH=ROOT, SECUREBOX_AGENT_SOCK=os.path.join(ROOT, "nonexistent.sock"))
+    with tempfile.TemporaryDirectory() as folder:
+        result = subprocess.run([sys.executable, "-X", "importtime"] + command, cwd=folder, env=env,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # Format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the startup time of the SecureBox CLI")
+    parser.add_argument("--budget_ms", type=float, default=80,
+                        help="Maximum time (in ms) allowed to import securebox (80 by default). It is measured "
+                             "several times and the fastest run is taken, so that noise does not make it fail")
+    args = parser.parse_args()
+
+    failed = False
+    for command, forbidden in CHECKS:
+        times = import_times(command)
+        imported = sorted({name for name in times for module in forbidden
+                           if name == module or name.startswith(module + ".")})
+        if imported:
+            failed = True
+            print(f"FAILED {' '.join(command)} imports {', '.join(imported)}")
+        else:
+            print(f"OK     {' '.join(command)}")
+
+    elapsed = min(import_times(["-c", "import securebox"]).get("securebox", 0) for _ in range(5)) / 1000
+    if elapsed > args.budget_ms:
+        failed = True
+        print(f"FAILED importing securebox takes {elapsed:.0f} ms (budget: {args.budget_ms:.0f} ms)")
+    else:
+        print(f"OK     importing securebox takes {elapsed:.0f} ms (budget: {args.budget_ms:.0f} ms)")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
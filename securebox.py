@@ -1,19 +1,656 @@
+import glob
+import json
+import mmap
 import os
-from concurrent.futures.thread import ThreadPoolExecutor
-from threading import Thread
+import re
+import secrets
+import tempfile
+import time
+from contextlib import suppress
+from functools import lru_cache
+from itertools import chain
+from io import BytesIO
+from queue import Queue
+from threading import Event, Thread
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from sb_api.sb_api import API
+from Crypto.PublicKey.RSA import RsaKey
+
+# asyncio, concurrent.futures, requests (sb_api.sb_api) and sb_crypto are imported inside the functions that use them,
+# since importing them here would slow down the startup of every command of the CLI, even of those that do not
+# encrypt anything
+from sb_api.exceptions import IncorrectFileIDException
+from sb_api.rate_limiter import TokenBucket
 from sb_bundle.sb_bundle import Bundle
-from sb_crypto.sb_crypto import *
+from sb_crypto.exceptions import SignatureNotAuthentic
+from sb_stats.sb_stats import stats
+
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024  # Smaller files are encrypted by a single thread
+COMPRESSION_SAMPLE_SIZE = 16 * 1024  # Bytes read from the start, middle and end of a file to decide compression
+FILE_ID_PATTERN = re.compile(r"[0-9a-fA-F]{8}")  # IDs that SecureBox gives to the files (e.g. 0eA92C1E)
+
+
+def encrypt_file(filename: str, output: BinaryIO, private_key: RsaKey = None,
+                 public_key: Union[RsaKey, List[RsaKey]] = None, cipher: str = None, workers: int = None,
+                 compression: str = None, signature: bytes = None):
+    """
+    Signs and/or encrypts a file, writing the result to output. The file is read in chunks, so only a few chunks
+    are in memory at any time. Unless a cipher is specified, the result is the same that
+    sign_message and encrypt_message would produce with the whole file
+    :param filename: name of the file to be read
+    :param output: file-like object where the resulting message is written
+    :param private_key: if provided, the file will be signed digitally
+    :param public_key: if provided, the file will be encrypted for its owner. In the framed format, it can also be
+    a list of keys: the file is then encrypted once, and can be decrypted by the owner of any of them
+    :param cipher: if provided (aes-gcm or chacha20), the file is encrypted in the framed format with this cipher
+    instead of the legacy one (AES-CBC)
+    :param workers: threads encrypting the file in the framed format, as in encrypt_file_for_recipients
+    :param compression: algorithm the file is compressed with in the framed format, as in
+    encrypt_file_for_recipients
+    :param signature: signature of the file in the legacy format, as in encrypt_file_for_recipients
+    """
+    encrypt_file_for_recipients(filename, [(public_key, output)], private_key, cipher, workers, compression,
+                                signature)
+
+
+def encrypt_file_for_recipients(filename: str, outputs: List[Tuple[Union[None, RsaKey, List[RsaKey]], BinaryIO]],
+                                private_key: RsaKey = None, cipher: str = None, workers: int = None,
+                                compression: str = None, signature: bytes = None):
+    """
+    Signs a file once and encrypts it for several recipients, reading it only twice (once to sign it and once to
+    encrypt it for everybody). In the framed format the signature is computed while encrypting, so the file is
+    read only once
+    :param filename: name of the file to be read
+    :param outputs: list of (public key, file-like object). The message encrypted with each public key is written
+    to its object. If a public key is None, the message is written just signed (in the legacy format). In the
+    framed format, a list of keys can be used to write a single message for all of them
+    :param private_key: if provided, the file will be signed digitally
+    :param cipher: if provided (aes-gcm or chacha20), the messages are encrypted in the framed format with it
+    :param workers: threads encrypting each message in the framed format. By default, files of at least
+    PARALLEL_MIN_SIZE bytes are encrypted using every CPU
+    :param compression: if provided (zlib, lzma or zstd), the file is compressed before being encrypted in the
+    framed format. With "auto", a sample of the file decides whether it is compressed and with which algorithm
+    :param signature: if provided, signature of the file in the legacy format computed beforehand (for instance, by
+    hash_and_sign_file), so that the file does not have to be read to sign it
+    """
+    from sb_crypto.sb_crypto import (CHUNK_SIZE, SEGMENT_SIZE, FramedEncryptor, StreamEncryptor, choose_compression,
+                                     read_chunks, sign_stream)
+
+    if compression == "auto":
+        compression = choose_compression(_sample_file(filename)) if cipher else None
+    if workers is None:
+        workers = (os.cpu_count() or 1) if os.path.getsize(filename) >= PARALLEL_MIN_SIZE else 1
+    # Threads can only share the work if each chunk read has several frames
+    chunk_size = SEGMENT_SIZE * workers if cipher and workers > 1 else CHUNK_SIZE
+
+    with open(filename, "rb") as f:
+        # Sign the message using our private key if provided. The framed format does it while encrypting
+        if signature is None and private_key and not (cipher and all(public_key for public_key, _ in outputs)):
+            signature = sign_stream(read_chunks(f), private_key)
+            f.seek(0)
+        signature = signature or b""
+
+        # Encrypt the message using the remote public keys if provided
+        encryptors = []
+        for public_key, output in outputs:
+            if public_key and cipher:
+                encryptor = FramedEncryptor(public_key, private_key, cipher, workers=workers,
+                                            compression=compression)
+                output.write(encryptor.header)
+            elif isinstance(public_key, list):
+                raise ValueError("A message can only be encrypted for several users in the framed format")
+            elif public_key:
+                encryptor = StreamEncryptor(public_key)
+                output.write(encryptor.header)
+                output.write(encryptor.update(signature))
+            else:
+                encryptor = None
+                output.write(signature)
+            encryptors.append((encryptor, output))
+
+        for chunk in read_chunks(f, chunk_size):
+            for encryptor, output in encryptors:
+                data = encryptor.update(chunk) if encryptor else chunk
+                with stats.stage("file.write", len(data)):
+                    output.write(data)
+
+        for encryptor, output in encryptors:
+            if encryptor:
+                output.write(encryptor.finalize())
+
+
+def _sample_file(filename: str) -> bytes:
+    """
+    :return: up to COMPRESSION_SAMPLE_SIZE bytes from the start, the middle and the end of a file
+    """
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        if size <= 3 * COMPRESSION_SAMPLE_SIZE:
+            return f.read()
+        sample = []
+        for position in (0, (size - COMPRESSION_SAMPLE_SIZE) // 2, size - COMPRESSION_SAMPLE_SIZE):
+            f.seek(position)
+            sample.append(f.read(COMPRESSION_SAMPLE_SIZE))
+        return b"".join(sample)
+
+
+def hash_and_sign_file(filename: str, private_key: RsaKey = None) -> Tuple[str, bytes]:
+    """
+    Reads a file once to compute the hash of its content and, if a key is provided, its signature in the legacy
+    format, which signs that same hash
+    :param filename: name of the file to be read
+    :param private_key: if provided, the file is signed with it
+    :return: the SHA256 of the file in hexadecimal, and its signature (empty if no key was provided)
+    """
+    from sb_crypto.sb_crypto import hash_stream, read_chunks, sign_hash
+
+    with open(filename, "rb") as f:
+        h = hash_stream(read_chunks(f))
+    return h.hexdigest(), sign_hash(h, private_key) if private_key else b""
+
+
+@lru_cache(maxsize=None)
+def _import_key(key_der: bytes) -> RsaKey:
+    from Crypto.PublicKey import RSA
+
+    # RsaKey objects cannot be pickled, so keys are sent to worker processes in DER and parsed once per process
+    return RSA.import_key(key_der)
+
+
+def _encrypt_for_recipients_worker(filename: str, private_key_der: bytes, public_keys_der: Dict[str, bytes],
+                                   folder: str, cipher: str = None, compression: str = None,
+                                   catalog_filename: str = None,
+                                   content_hash: str = None) -> Tuple[str, Dict[str, str],
+                                                                      Dict[Tuple[str, ...], str]]:
+    """
+    Runs encrypt_file_for_recipients in a worker process, saving each encrypted message to a temporary file. In the
+    framed format a single message is written for all the receivers, while in the legacy one there is one for each.
+    The content of the file is hashed first (signing it in the legacy format), and if a catalog is provided, the
+    receivers who were already sent a file with the same content are skipped before encrypting anything
+    :param content_hash: if provided, SHA256 of the file in hexadecimal computed beforehand, so that in the framed
+    format the file is not read to hash it (the legacy format still reads it to sign it)
+    :return: the SHA256 of the file in hexadecimal, a dictionary with the IDs of the files already sent to the
+    receivers skipped, and a dictionary whose keys are tuples with the IDs of the receivers of each message and its
+    values the name of the temporary files
+    """
+    private_key = _import_key(private_key_der)
+    signature = None
+    if content_hash is None or not cipher:
+        content_hash, signature = hash_and_sign_file(filename, None if cipher else private_key)
+    existing = {}
+    if catalog_filename:
+        from sb_catalog.sb_catalog import Catalog
+        with Catalog(catalog_filename) as catalog:
+            for receiver_id in public_keys_der:
+                copies = catalog.find(content_hash=content_hash, receiver_id=receiver_id)
+                if copies:
+                    existing[receiver_id] = copies[-1]["fileID"]
+        public_keys_der = {receiver_id: key_der for receiver_id, key_der in public_keys_der.items()
+                           if receiver_id not in existing}
+        if not public_keys_der:
+            return content_hash, existing, {}
+
+    if cipher and len(public_keys_der) > 1:
+        recipients = {tuple(public_keys_der): [_import_key(key_der) for key_der in public_keys_der.values()]}
+    else:
+        recipients = {(receiver_id,): _import_key(key_der) for receiver_id, key_der in public_keys_der.items()}
+
+    encrypted_filenames = {}
+    outputs = []
+    try:
+        for receiver_ids, public_key in recipients.items():
+            fd, encrypted_filenames[receiver_ids] = tempfile.mkstemp(suffix=".crypt", dir=folder)
+            outputs.append((public_key, os.fdopen(fd, "wb")))
+        # Each process encrypts a different file, so they do not start threads of their own
+        encrypt_file_for_recipients(filename, outputs, private_key, cipher, workers=1, compression=compression,
+                                    signature=signature)
+    except BaseException:
+        for encrypted_filename in encrypted_filenames.values():
+            os.remove(encrypted_filename)
+        raise
+    finally:
+        for _, output in outputs:
+            output.close()
+
+    return content_hash, existing, encrypted_filenames
+
+
+def _decrypt_file_worker(filename: str, output_filename: str, private_key_der: bytes, public_key_der: bytes):
+    """
+    Runs decrypt_file in a worker process over the message saved in filename, which is deleted afterwards
+    """
+    from sb_crypto.sb_crypto import read_chunks
+
+    try:
+        with open(filename, "rb") as f:
+            decrypt_file(read_chunks(f), output_filename, _import_key(private_key_der), _import_key(public_key_der),
+                         workers=1)
+    finally:
+        os.remove(filename)
+
+
+def _write_temp_file(chunks: Iterable[bytes], folder: str, suffix: str = "") -> str:
+    """
+    Saves data provided in chunks to a new hidden temporary file inside folder
+    :return: name of the file
+    """
+    fd, filename = tempfile.mkstemp(prefix=".", suffix=suffix, dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                with stats.stage("file.write", len(chunk)):
+                    f.write(chunk)
+    except BaseException:
+        os.remove(filename)
+        raise
+    return filename
+
+
+def prefetch(chunks: Iterable[bytes], depth: int = 16) -> Iterator[bytes]:
+    """
+    Consumes an iterable in a background thread, so that producing the chunks (for instance, receiving them from
+    the network) overlaps with processing them. At most depth chunks are kept waiting in memory
+    :param chunks: iterable to be consumed
+    :param depth: maximum number of chunks produced but not consumed yet
+    :return: iterator over the same chunks
+    """
+    queue = Queue(depth)
+    stop = Event()
+    end = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                queue.put(chunk)
+            queue.put(end)
+        except BaseException as e:
+            queue.put(e)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = queue.get()
+            if item is end:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # If the consumer stops early, unblock the producer so that it can finish
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+
+
+def _progress_printer(label: str) -> Callable[[int, int], None]:
+    """
+    Creates a progress callback that prints the percentage of a transfer completed, overwriting the previous one
+    :param label: text printed before the percentage
+    """
+    last_percentage = [-1]
+
+    def progress(sent: int, total: int):
+        percentage = 100 * sent // total if total else 100
+        if percentage != last_percentage[0]:
+            last_percentage[0] = percentage
+            print(f"\r{label}: {percentage}%", end="\n" if sent >= total else "", flush=True)
+
+    return progress
+
+
+def walk_paths(paths: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Expands a list of paths, replacing each directory by all the files inside it (recursively) and each glob pattern
+    (with *, ? and [...], and ** to match any number of directories) by the files and directories it matches. Patterns
+    are expanded here as well as by the shell, since they are not when they are quoted or on Windows
+    :param paths: names of files, directories and/or glob patterns
+    :return: iterator over tuples with the name of each file and its name relative to the folder of the path it comes
+    from (so files inside a directory keep the directory and its subdirectories)
+    """
+    for path in paths:
+        if not os.path.exists(path) and any(char in path for char in "*?["):
+            yield from walk_paths(sorted(glob.glob(path, recursive=True)))
+        elif os.path.isdir(path):
+            parent = os.path.dirname(os.path.normpath(path))
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    filename = os.path.join(root, file)
+                    yield filename, os.path.relpath(filename, parent)
+        else:
+            yield path, os.path.basename(path)
+
+
+def expand_paths(paths: Iterable[str]) -> List[str]:
+    """
+    Expands a list of paths, replacing each directory by all the files inside it (recursively) and each glob pattern
+    by the files it matches
+    :param paths: names of files, directories and/or glob patterns
+    :return: names of the files
+    """
+    return [filename for filename, _ in walk_paths(paths)]
+
+
+def _peek(chunks: Iterable[bytes], size: int) -> Tuple[bytes, Iterator[bytes]]:
+    """
+    Reads the first bytes of an iterable of chunks without losing them
+    :param size: minimum number of bytes read (unless the iterable is shorter)
+    :return: a tuple with the bytes read and an iterator over all the chunks, including the ones read
+    """
+    iterator = iter(chunks)
+    head = []
+    while sum(map(len, head)) < size:
+        chunk = next(iterator, None)
+        if chunk is None:
+            break
+        head.append(chunk)
+    return b"".join(head), chain(head, iterator)
+
+
+def _coalesce(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """
+    Joins consecutive chunks of an iterable until they add up to at least size bytes
+    """
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= size:
+            yield b"".join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield b"".join(pending)
+
+
+def decrypt_file(chunks: Iterable[bytes], output_filename: str, private_key: RsaKey = None,
+                 public_key: RsaKey = None, workers: int = None):
+    """
+    Decrypts and/or verifies a message provided in chunks, writing the original file to output_filename. The
+    result is written to a temporary file in the same folder, which is only renamed to output_filename once the
+    signature (if any) has been verified
+    :param chunks: iterable with the consecutive parts of the message
+    :param output_filename: path where the original file will be saved
+    :param private_key: if provided, the message will be decrypted with it. Both the legacy and the framed
+    formats are accepted
+    :param public_key: if provided, the signature of the message will be verified with it
+    :param workers: threads decrypting a message in the framed format (os.cpu_count() by default)
+    :raise: SignatureNotAuthentic if signature is not valid, MessageNotAuthentic if a framed message has been
+    modified
+    """
+    from sb_crypto.sb_crypto import MAGIC, SEGMENT_SIZE, FramedDecryptor, StreamDecryptor, StreamVerifier, is_framed
+
+    decryptor = None
+    framed = False
+    verifier = StreamVerifier(public_key) if public_key else None
+    if private_key:
+        # The format is told by the first bytes of the message
+        head, chunks = _peek(chunks, len(MAGIC) + 1)
+        if is_framed(head):
+            # Framed messages carry their own signature, which the decryptor verifies
+            if workers is None:
+                workers = os.cpu_count() or 1
+            decryptor = FramedDecryptor(private_key, public_key, workers)
+            framed = True
+            verifier = None
+            if workers > 1:
+                # Threads can only share the work if each chunk has several frames
+                chunks = _coalesce(chunks, SEGMENT_SIZE * workers)
+        else:
+            decryptor = StreamDecryptor(private_key)
+
+    # mkstemp is not used because it creates the file readable only by its owner, unlike an ordinary open
+    folder, name = os.path.split(output_filename)
+    temp_filename = os.path.join(folder, f".{name}.{secrets.token_hex(4)}.part")
+    try:
+        with open(temp_filename, "xb") as output_file:
+            for chunk in chunks:
+                if framed:
+                    # Compressed messages are decompressed in pieces of limited size, so that a message that
+                    # decompresses to much more than it takes never has to fit in memory
+                    pieces = decryptor.update_chunks(chunk)
+                else:
+                    if decryptor:
+                        chunk = decryptor.update(chunk)
+                    if verifier:
+                        chunk = verifier.update(chunk)
+                    pieces = (chunk,)
+                for piece in pieces:
+                    with stats.stage("file.write", len(piece)):
+                        output_file.write(piece)
+
+            if framed:
+                for piece in decryptor.finalize_chunks():
+                    output_file.write(piece)
+            elif decryptor:
+                chunk = decryptor.finalize()
+                if verifier:
+                    chunk = verifier.update(chunk)
+                output_file.write(chunk)
+            if verifier:
+                verifier.verify()
+
+        os.replace(temp_filename, output_filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def encrypt_file_mmap(filename: str, output_filename: str, private_key: RsaKey = None, public_key: RsaKey = None):
+    """
+    Signs and/or encrypts a file in the legacy format, as encrypt_file does, but mapping both the file and the result
+    in memory: the file is hashed and encrypted straight from the page cache into the output file, without copying
+    it to Python buffers
+    :param filename: name of the file to be read. It cannot be empty, as empty files cannot be mapped
+    :param output_filename: name of the file where the resulting message is written
+    :param private_key: if provided, the file will be signed digitally
+    :param public_key: if provided, the file will be encrypted for its owner
+    """
+    from sb_crypto.sb_crypto import encrypt_message_into, encrypted_message_size, sign_message
+
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as message:
+        signature = sign_message(message, private_key) if private_key else b""
+        size = len(signature) + len(message)
+        if public_key:
+            size = encrypted_message_size(size, public_key)
+
+        with open(output_filename, "w+b") as output_file:
+            output_file.truncate(size)
+            with mmap.mmap(output_file.fileno(), size) as output:
+                if public_key:
+                    encrypt_message_into(message, public_key, output, prefix=signature)
+                else:
+                    output[:len(signature)] = signature
+                    output[len(signature):] = message
+
+
+def decrypt_file_mmap(filename: str, output_filename: str, private_key: RsaKey = None, public_key: RsaKey = None):
+    """
+    Decrypts and/or verifies a message in the legacy format, as decrypt_file does, but mapping both the message and
+    the result in memory, so that it is decrypted straight from the page cache into the output file. The result is
+    written to a temporary file in the same folder, which is only renamed to output_filename once the signature (if
+    any) has been verified
+    :param filename: name of the file with the message. It cannot be empty, as empty files cannot be mapped
+    :param output_filename: path where the original file will be saved
+    :param private_key: if provided, the message will be decrypted with it
+    :param public_key: if provided, the signature of the message will be verified with it
+    :raise: SignatureNotAuthentic if signature is not valid, ValueError if the message is not a valid one
+    """
+    from sb_crypto.sb_crypto import decrypt_message_into, verify_signature
+
+    folder, name = os.path.split(output_filename)
+    temp_filename = os.path.join(folder, f".{name}.{secrets.token_hex(4)}.part")
+    try:
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as message, \
+                open(temp_filename, "x+b") as output_file:
+            # The decrypted message is never longer than the encrypted one
+            output_file.truncate(len(message))
+            with mmap.mmap(output_file.fileno(), len(message)) as output:
+                if private_key:
+                    length = decrypt_message_into(message, private_key, output)
+                else:
+                    output[:] = message
+                    length = len(message)
+                start = 0
+                authentic = True
+                if public_key:
+                    # The exception is not raised from here, as its traceback would keep views of the mapping
+                    # alive and it could not be closed
+                    try:
+                        with memoryview(output) as view:
+                            verify_signature(view[:length], public_key)
+                    except SignatureNotAuthentic:
+                        authentic = False
+                    else:
+                        # The signature is removed moving the data inside the mapping, which needs no buffer
+                        start = public_key.size_in_bytes()
+                        output.move(0, start, length - start)
+            output_file.truncate(length - start)
+        if not authentic:
+            raise SignatureNotAuthentic
+        os.replace(temp_filename, output_filename)
+    except BaseException:
+        # The temporary file does not exist if the message could not be opened or mapped
+        with suppress(FileNotFoundError):
+            os.remove(temp_filename)
+        raise
+
+
+def encrypt_local_file(filename: str, output_filename: str, private_key: RsaKey = None,
+                       public_key: Union[None, RsaKey, List[RsaKey]] = None, cipher: str = None,
+                       compression: str = None, workers: int = None):
+    """
+    Signs and/or encrypts a file, saving the resulting message to output_filename. In the legacy format, both files
+    are mapped in memory (encrypt_file_mmap), and otherwise the file is streamed (encrypt_file)
+    :param workers: threads encrypting a file in the framed format (os.cpu_count() by default)
+    """
+    if not cipher and not isinstance(public_key, list) and os.path.getsize(filename) > 0:
+        encrypt_file_mmap(filename, output_filename, private_key, public_key)
+    else:
+        with open(output_filename, "wb") as output_file:
+            encrypt_file(filename, output_file, private_key, public_key, cipher, workers, compression)
+
+
+def decrypt_local_file(filename: str, output_filename: str, private_key: RsaKey = None, public_key: RsaKey = None,
+                       workers: int = None):
+    """
+    Decrypts and/or verifies a message saved in a file, writing the original file to output_filename. Messages in the
+    legacy format are mapped in memory (decrypt_file_mmap), and the rest are streamed (decrypt_file)
+    :param workers: threads decrypting a message in the framed format (os.cpu_count() by default)
+    :raise: SignatureNotAuthentic if signature is not valid, MessageNotAuthentic if a framed message has been
+    modified
+    """
+    from sb_crypto.sb_crypto import MAGIC, is_framed, read_chunks
+
+    with open(filename, "rb") as f:
+        if os.path.getsize(filename) == 0 or (private_key and is_framed(f.read(len(MAGIC) + 1))):
+            f.seek(0)
+            decrypt_file(read_chunks(f), output_filename, private_key, public_key, workers)
+            return
+    decrypt_file_mmap(filename, output_filename, private_key, public_key)
+
+
+def encrypted_filename(filename: str, signed: bool, encrypted: bool) -> str:
+    """
+    :return: name of the file where the message created from a file is saved when it is signed and/or encrypted
+    locally
+    """
+    if signed:
+        filename += ".signed"
+    if encrypted:
+        filename += ".crypt"
+    return filename
+
+
+def message_extensions(filename: str) -> Tuple[bool, bool]:
+    """
+    Tells what was done to the file a message was created from by the extensions that encrypted_filename adds at the
+    end of its name
+    :return: whether the message is signed and whether it is encrypted
+    """
+    encrypted = filename.endswith(".crypt")
+    if encrypted:
+        filename = filename[:-len(".crypt")]
+    return filename.endswith(".signed"), encrypted
+
+
+def decrypted_filename(filename: str) -> str:
+    """
+    :return: name given to the original file of a message decrypted and/or verified locally, without the extensions
+    added by encrypted_filename
+    """
+    signed, encrypted = message_extensions(filename)
+    if encrypted:
+        filename = filename[:-len(".crypt")]
+    if signed:
+        filename = filename[:-len(".signed")]
+    return filename
+
+
+def _encrypt_local_file_worker(filename: str, output_filename: str, private_key_der: Optional[bytes],
+                               public_key_der: Union[None, bytes, List[bytes]], cipher: str = None,
+                               compression: str = None):
+    """
+    Runs encrypt_local_file in a worker process
+    """
+    private_key = _import_key(private_key_der) if private_key_der else None
+    if isinstance(public_key_der, list):
+        public_key = [_import_key(key_der) for key_der in public_key_der]
+    else:
+        public_key = _import_key(public_key_der) if public_key_der else None
+    # Each process encrypts a different file, so they do not start threads of their own
+    encrypt_local_file(filename, output_filename, private_key, public_key, cipher, compression, workers=1)
+
+
+def _decrypt_local_file_worker(filename: str, output_filename: str, private_key_der: Optional[bytes],
+                               public_key_der: Optional[bytes]):
+    """
+    Runs decrypt_local_file in a worker process
+    """
+    private_key = _import_key(private_key_der) if private_key_der else None
+    public_key = _import_key(public_key_der) if public_key_der else None
+    decrypt_local_file(filename, output_filename, private_key, public_key, workers=1)
 
 
 class SecureBoxClient:
     received_folder = "received"
+    uploads_folder = ".uploads"  # Encrypted files waiting to be uploaded, so failed uploads can be resumed
+    public_keys_filename = "public_keys.json"
+    # Local index of the files synchronized by sync, and catalog of the files uploaded (see find_files)
+    index_filename = "securebox.db"
+    catalog_max_age = 600  # Seconds after which the catalog is reconciled with the server before being used
+    # Seconds after which the catalog is reconciled before trusting it to skip the upload of a file already sent.
+    # It only avoids listing the files again right after sync has done it
+    dedup_max_age = 10
+
+    def __init__(self, token, pool_size: int = 10, cipher: str = None, compression: str = None):
+        """
+        :param token: token used to authenticate against SecureBox
+        :param pool_size: maximum number of connections kept open with the server, shared by all the threads
+        :param cipher: AEAD cipher (aes-gcm or chacha20) used to encrypt files in the framed format. If not
+        provided, files are encrypted in the legacy format (AES-CBC), which every SecureBox client understands.
+        Files are decrypted in either format regardless of it
+        :param compression: algorithm (zlib, lzma, zstd or auto) files are compressed with before being encrypted.
+        Only used in the framed format. Compressed files are decompressed transparently when they are decrypted
+        """
+        from sb_api.key_cache import PublicKeyCache
+        from sb_api.sb_api import API
 
-    def __init__(self, token):
-        self.api = API(token)
+        self.token = token
+        self.cipher = cipher
+        self.compression = compression
+        # Public keys of other users are cached on disk, so repeated transfers with them skip the round trip
+        self.api = API(token, pool_size=pool_size, key_cache=PublicKeyCache(filename=self.public_keys_filename))
 
     def create_id(self, bundle: Bundle, username: str, email: str):
+        from sb_crypto.sb_crypto import rsa_generate_key
+
         print(f"Creating a new identity")
         key = rsa_generate_key()
         public_key = key.publickey()
@@ -28,7 +665,7 @@ class SecureBoxClient:
         # Save data to disk
         bundle.write()
 
-    def search_id(self, query: str):
+    def search_id(self, query: str) -> list:
         print(f"Searching query {query}")
         users = self.api.user_search(query)
         if users:
@@ -37,82 +674,734 @@ class SecureBoxClient:
                              f"Public Key: {user['publicKey']}")
         else:
             print("No users found with the specified query")
+        return users
 
     def delete_id(self, user_id: str):
         print(f"Deleting {user_id}...")
         self.api.user_delete(user_id)
+        self.api.key_cache.invalidate(user_id)
+
+    def upload(self, filename: str, receiver_id: str, private_key: RsaKey, force: bool = False) -> str:
+        """
+        Sends a file to another user, signed and encrypted. The encrypted file is kept on disk until it is uploaded,
+        so if the upload fails it can be resumed by calling this method again without encrypting the file again
+        (as long as it has not been modified). If a file with the same content was already sent to the user and is
+        still in the server, it is not sent again
+        :param filename: name of the file to be sent
+        :param receiver_id: ID of the user who will receive the file
+        :param private_key: key used to sign the file
+        :param force: if true, the file is sent even if the user already has it
+        :return: ID of the uploaded file (or of the one already sent)
+        """
+        encrypted_filename, checkpoint_filename = self._upload_checkpoint_filenames(filename, receiver_id)
+        stat = os.stat(filename)
+        checkpoint = {"filename": os.path.abspath(filename), "receiver_id": receiver_id, "size": stat.st_size,
+                      "mtime": stat.st_mtime_ns, "cipher": self.cipher,
+                      "compression": self.compression}
+
+        saved_checkpoint = self._read_upload_checkpoint(checkpoint_filename, encrypted_filename)
+        content_hash = saved_checkpoint.pop("content_hash", None) if saved_checkpoint else None
+        if saved_checkpoint == checkpoint:
+            print(f"Resuming upload of {filename} from a previous attempt")
+        else:
+            # The content is hashed before encrypting it, so that a file the receiver already has is not encrypted.
+            # This reads the file once more in the framed format, while the legacy one signs that same hash
+            content_hash, signature = hash_and_sign_file(filename, None if self.cipher else private_key)
+            if not force:
+                file_id = self._find_copy(content_hash, receiver_id)
+                if file_id:
+                    print(f"{receiver_id} already has a file with the content of {filename}, with ID {file_id}")
+                    return file_id
+            print(f"Retrieving {receiver_id}'s public key...")
+            public_key = self.api.user_get_public_key(receiver_id)
+            print(f"Signing and encrypting file {filename}...")
+            with open(encrypted_filename, "wb") as encrypted_file:
+                encrypt_file(filename, encrypted_file, private_key, public_key, self.cipher,
+                             compression=self.compression, signature=signature or None)
+            checkpoint["content_hash"] = content_hash
+            checkpoint["encrypted_size"] = os.path.getsize(encrypted_filename)
+            with open(checkpoint_filename, "w") as f:
+                json.dump(checkpoint, f)
+
+        with open(encrypted_filename, "rb") as encrypted_file:
+            file_id = self.api.file_upload(filename, encrypted_file,
+                                           progress=_progress_printer(f"Sending file {filename}"))["file_id"]
+        os.remove(checkpoint_filename)
+        os.remove(encrypted_filename)
+        self._record_uploads([{"filename": filename, "receiver_id": receiver_id, "file_id": file_id, "error": None}],
+                             {filename: content_hash})
 
-    def upload(self, filename: str, receiver_id: str, private_key: RsaKey):
-        encrypted_message = self.encrypt_helper(filename, private_key=private_key, receiver_id=receiver_id)
-        print(f"Sending file {filename}")
-        file_id = self.api.file_upload(filename, encrypted_message)["file_id"]
         print(f"Successfully sent {filename} which got ID {file_id}")
+        return file_id
+
+    @staticmethod
+    def _upload_checkpoint_filenames(filename: str, receiver_id: str) -> Tuple[str, str]:
+        """
+        :return: the names of the encrypted file and of the checkpoint of an upload
+        """
+        from Crypto.Hash import SHA256
+
+        if not os.path.exists(SecureBoxClient.uploads_folder):
+            os.mkdir(SecureBoxClient.uploads_folder)
+        key = SHA256.new(f"{os.path.abspath(filename)}\0{receiver_id}".encode()).hexdigest()[:32]
+        return (os.path.join(SecureBoxClient.uploads_folder, key + ".crypt"),
+                os.path.join(SecureBoxClient.uploads_folder, key + ".json"))
+
+    @staticmethod
+    def _read_upload_checkpoint(checkpoint_filename: str, encrypted_filename: str) -> Optional[dict]:
+        """
+        :return: the checkpoint without the size of the encrypted file, or None if there is no valid checkpoint
+        """
+        try:
+            with open(checkpoint_filename, "r") as f:
+                checkpoint = json.load(f)
+            if checkpoint.pop("encrypted_size") != os.path.getsize(encrypted_filename):
+                return None
+            return checkpoint
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def upload_batch(self, paths: List[str], receiver_ids: List[str], private_key: RsaKey,
+                     crypto_workers: int = None, upload_workers: int = 4, force: bool = False,
+                     hashes: Dict[str, str] = None) -> List[dict]:
+        """
+        Sends several files to several users. Each file is signed once and encrypted for every receiver in a pool of
+        processes, while the encrypted files are uploaded by a pool of threads. In the framed format (if cipher was
+        provided), each file is encrypted and uploaded only once for all the receivers, who get the same file ID.
+        Files are not sent again to the receivers who already have a file with the same content in the server
+        :param paths: files and/or directories (all the files inside them will be sent)
+        :param receiver_ids: IDs of the users who will receive the files
+        :param private_key: key used to sign the files
+        :param crypto_workers: number of processes signing and encrypting (number of CPUs by default)
+        :param upload_workers: number of files uploaded at the same time
+        :param force: if true, files are sent even if the receivers already have them
+        :param hashes: if provided, dictionary with the SHA256 in hexadecimal of some of the files, already computed
+        by the caller (see sync), so that they are not hashed again
+        :return: a list with a dictionary per file and receiver, with fields filename, receiver_id, file_id and
+        error (only one of the last two is not None). Files that were not sent again have the ID of the copy the
+        receiver already had, and a field deduplicated set to True
+        """
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+        filenames = expand_paths(paths)
+        crypto_workers = crypto_workers or os.cpu_count()
+
+        print(f"Retrieving public keys of {', '.join(receiver_ids)}...")
+        public_keys_der = {receiver_id: self.api.user_get_public_key(receiver_id).export_key("DER")
+                           for receiver_id in receiver_ids}
+        private_key_der = private_key.export_key("DER")
+        catalog_filename = None if force else self._refresh_catalog(self.dedup_max_age)
+
+        known_hashes = hashes or {}
+        results = []
+        hashes = {}
+        # Limit the files that are encrypted but not sent yet, so that they do not pile up in the temporary folder
+        # when the network is slower than the encryption
+        max_pending = crypto_workers + upload_workers
+        with tempfile.TemporaryDirectory() as folder, \
+                ProcessPoolExecutor(max_workers=crypto_workers) as crypto_pool, \
+                ThreadPoolExecutor(max_workers=upload_workers) as upload_pool:
+            pending_filenames = iter(filenames)
+            crypto_futures = {}
+            upload_futures = {}
+            while True:
+                while len(crypto_futures) + len(upload_futures) < max_pending:
+                    filename = next(pending_filenames, None)
+                    if filename is None:
+                        break
+                    print(f"Encrypting file {filename}...")
+                    future = crypto_pool.submit(_encrypt_for_recipients_worker, filename, private_key_der,
+                                                public_keys_der, folder, self.cipher, self.compression,
+                                                catalog_filename, known_hashes.get(filename))
+                    crypto_futures[future] = filename
+
+                if not crypto_futures and not upload_futures:
+                    break
+
+                done, _ = wait(list(crypto_futures) + list(upload_futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in crypto_futures:
+                        filename = crypto_futures.pop(future)
+                        try:
+                            hashes[filename], existing, encrypted_filenames = future.result()
+                        except Exception as e:
+                            results.extend({"filename": filename, "receiver_id": receiver_id, "file_id": None,
+                                            "error": e} for receiver_id in receiver_ids)
+                            continue
+                        results.extend(self._deduplicated_results(filename, existing))
+                        for file_receiver_ids, encrypted_filename in encrypted_filenames.items():
+                            upload_future = upload_pool.submit(self._upload_encrypted_file, filename,
+                                                               encrypted_filename)
+                            upload_futures[upload_future] = (filename, file_receiver_ids)
+                    else:
+                        filename, file_receiver_ids = upload_futures.pop(future)
+                        try:
+                            file_id = future.result()
+                            print(f"Successfully sent {filename} to {', '.join(file_receiver_ids)}, which got ID "
+                                  f"{file_id}")
+                            error = None
+                        except Exception as e:
+                            file_id = None
+                            error = e
+                        results.extend({"filename": filename, "receiver_id": receiver_id, "file_id": file_id,
+                                        "error": error} for receiver_id in file_receiver_ids)
+
+        self._record_uploads(results, hashes)
+        self._print_batch_summary(results, lambda result: f"{result['filename']} -> {result['receiver_id']}"
+                                                          f"{': ' + result['file_id'] if result['file_id'] else ''}")
+        return results
+
+    def sync(self, directory: str, receiver_ids: List[str], private_key: RsaKey, crypto_workers: int = None,
+             upload_workers: int = 4, force: bool = False, prune: bool = False) -> List[dict]:
+        """
+        Uploads the files of a directory (recursively) that are new or have changed since they were last synchronized
+        with the receivers. A local index remembers the size, modification time and content hash of every file
+        uploaded, so unchanged files are not even read. Files whose modification time has changed are hashed, and
+        only uploaded if their content has changed too. The versions uploaded before are kept in SecureBox (the
+        receivers may not have downloaded them yet) unless prune is true
+        :param directory: directory to be synchronized
+        :param receiver_ids: IDs of the users who will receive the files
+        :param private_key: key used to sign the files
+        :param crypto_workers: number of processes signing and encrypting (number of CPUs by default)
+        :param upload_workers: number of files uploaded (and hashed) at the same time
+        :param force: if true, changed files are uploaded even if the receivers already have a file with the same
+        content (see upload_batch)
+        :param prune: if true, when a file is uploaded again the version uploaded before is deleted from SecureBox
+        :return: a list with a dictionary per file uploaded and receiver, as in upload_batch
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from sb_sync.sb_sync import SyncIndex, file_hash, scan_directory
+
+        index = SyncIndex(self.index_filename)
+        try:
+            # Files deleted from SecureBox (for instance, with --delete_files) have to be uploaded again
+            remote_files = self.api.file_list()
+            with self._open_catalog() as catalog:
+                catalog.reconcile(remote_files)
+            remote_ids = {file["fileID"] for file in remote_files}
+            files = {path: (size, mtime_ns) for path, size, mtime_ns in scan_directory(directory)}
+            print(f"Checking {len(files)} files of {directory}...")
 
-    def list_files(self):
+            # Path -> list of (receiver ID, index entry or None) for the files that may have to be uploaded
+            candidates = {}
+            for receiver_id in receiver_ids:
+                entries = index.entries(receiver_id, directory)
+                for path, file_stat in files.items():
+                    entry = entries.get(path)
+                    if entry is None or entry[:2] != file_stat or entry[3] not in remote_ids:
+                        candidates.setdefault(path, []).append((receiver_id, entry))
+
+            def hash_if_exists(path: str) -> Optional[str]:
+                # Files deleted after the scan are skipped, instead of stopping the synchronization of the rest
+                try:
+                    return file_hash(path)
+                except FileNotFoundError:
+                    print(f"Skipping {path}, which has been deleted")
+                    return None
+
+            with ThreadPoolExecutor(max_workers=upload_workers) as pool:
+                hashes = dict(zip(candidates, pool.map(hash_if_exists, candidates)))
+            for path in [path for path, content_hash in hashes.items() if content_hash is None]:
+                del candidates[path], hashes[path]
+
+            # Files to be uploaded, grouped by the receivers they have to be uploaded to
+            groups = {}
+            unchanged = []
+            replaced = []
+            for path, receivers in candidates.items():
+                pending = []
+                for receiver_id, entry in receivers:
+                    if entry and entry[2] == hashes[path] and entry[3] in remote_ids:
+                        # Only the modification time has changed
+                        unchanged.append((path, receiver_id) + files[path] + (hashes[path], entry[3]))
+                        continue
+                    pending.append(receiver_id)
+                    if prune and entry and entry[3] in remote_ids:
+                        replaced.append((path, receiver_id, entry[3]))
+                if pending:
+                    groups.setdefault(tuple(pending), []).append(path)
+            index.update(unchanged)
+
+            if not groups:
+                print("Everything is up to date")
+                return []
+
+            results = []
+            for group_receiver_ids, paths in groups.items():
+                results.extend(self.upload_batch(paths, list(group_receiver_ids), private_key, crypto_workers,
+                                                 upload_workers, force, hashes))
+            index.update((result["filename"], result["receiver_id"]) + files[result["filename"]] +
+                         (hashes[result["filename"]], result["file_id"])
+                         for result in results if result["error"] is None)
+
+            # Old versions are only deleted if they have been replaced and no other file of the index uses them
+            uploaded = {(result["filename"], result["receiver_id"]) for result in results if result["error"] is None}
+            still_used = set(index.file_ids())
+            old_ids = {file_id for path, receiver_id, file_id in replaced
+                       if (path, receiver_id) in uploaded and file_id not in still_used}
+            if old_ids:
+                print(f"Deleting {len(old_ids)} replaced files...")
+                self.delete_files(*old_ids)
+            return results
+        finally:
+            index.close()
+
+    def _upload_encrypted_file(self, filename: str, encrypted_filename: str) -> str:
+        """
+        Uploads an already encrypted file with the name of the original one, deleting it afterwards
+        :return: ID of the uploaded file
+        """
+        try:
+            with open(encrypted_filename, "rb") as encrypted_file:
+                return self.api.file_upload(filename, encrypted_file)["file_id"]
+        finally:
+            os.remove(encrypted_filename)
+
+    @staticmethod
+    def _print_batch_summary(results: List[dict], describe: Callable[[dict], str]):
+        """
+        Prints the result of a batch operation
+        :param results: list of dictionaries with a field called error, which is None if the operation succeeded
+        :param describe: function that returns the text printed for each result
+        """
+        failed = [result for result in results if result["error"] is not None]
+        print(f"{len(results) - len(failed)} succeeded, {len(failed)} failed")
+        for result in results:
+            if result["error"] is None:
+                print(f"OK     {describe(result)}")
+            else:
+                print(f"FAILED {describe(result)}: {result['error']}")
+
+    def _open_catalog(self):
+        from sb_catalog.sb_catalog import Catalog
+        return Catalog(self.index_filename)
+
+    def _record_uploads(self, results: List[dict], hashes: Dict[str, str]):
+        """
+        Adds the files uploaded successfully to the catalog
+        :param results: list of dictionaries with fields filename, receiver_id, file_id and error, as returned by
+        upload_batch. Receivers of the same file ID are stored together
+        :param hashes: SHA256 of the content of each file uploaded, in hexadecimal, by name
+        """
+        files = {}
+        for result in results:
+            if result["error"] is None and not result.get("deduplicated"):
+                files.setdefault(result["file_id"], (result["filename"], []))[1].append(result["receiver_id"])
+        if not files:
+            return
+        now = time.time()
+        with self._open_catalog() as catalog:
+            catalog.add((file_id, os.path.basename(filename), os.path.getsize(filename), now, hashes.get(filename),
+                         receiver_ids) for file_id, (filename, receiver_ids) in files.items())
+
+    @staticmethod
+    def _deduplicated_results(filename: str, existing: Dict[str, str]) -> List[dict]:
+        """
+        :param existing: IDs of the copies of a file that its receivers already had, by receiver
+        :return: the results of a batch upload for the receivers of a file that was not sent again
+        """
+        for receiver_id, file_id in existing.items():
+            print(f"{receiver_id} already has a file with the content of {filename}, with ID {file_id}")
+        return [{"filename": filename, "receiver_id": receiver_id, "file_id": file_id, "error": None,
+                 "deduplicated": True} for receiver_id, file_id in existing.items()]
+
+    def _catalog_is_stale(self, catalog, max_age: float) -> bool:
+        reconciled_at = catalog.reconciled_at
+        return reconciled_at is None or time.time() - reconciled_at > max_age
+
+    def _refresh_catalog(self, max_age: float) -> str:
+        """
+        Reconciles the catalog with the server if it has not been in the last max_age seconds
+        :return: name of the catalog
+        """
+        with self._open_catalog() as catalog:
+            if self._catalog_is_stale(catalog, max_age):
+                catalog.reconcile(self.api.file_list())
+        return self.index_filename
+
+    def _find_copy(self, content_hash: str, receiver_id: str) -> Optional[str]:
+        """
+        Looks for a file with some content already sent to a user. The catalog is reconciled first if it has not
+        been in the last dedup_max_age seconds, so that files deleted from the server are not taken into account
+        :param content_hash: SHA256 of the content, in hexadecimal
+        :return: the ID of the file, or None if there is none
+        """
+        with self._open_catalog() as catalog:
+            copies = catalog.find(content_hash=content_hash, receiver_id=receiver_id)
+            if copies and self._catalog_is_stale(catalog, self.dedup_max_age):
+                catalog.reconcile(self.api.file_list())
+                copies = catalog.find(content_hash=content_hash, receiver_id=receiver_id)
+        return copies[-1]["fileID"] if copies else None
+
+    def _forget_files(self, results: List[dict]):
+        """
+        Removes the files deleted (or that did not exist) from the catalog
+        :param results: list of dictionaries with fields file_id and error, as returned by delete_files
+        """
+        with self._open_catalog() as catalog:
+            catalog.remove(result["file_id"] for result in results
+                           if result["error"] is None or isinstance(result["error"], IncorrectFileIDException))
+
+    def find_files(self, selectors: List[str], since: float = None, until: float = None) -> List[str]:
+        """
+        Gets the IDs of the files referred to by IDs, names or glob patterns, looking them up in the local catalog
+        instead of listing the files of the server. The catalog is only reconciled with the server if it is older
+        than catalog_max_age seconds and an argument is a name, a pattern or "all" (anything but a file ID) that it
+        does not know
+        :param selectors: file IDs, file names, glob patterns (e.g. "*.pdf") or "all" for every file
+        :param since: if provided, names, patterns and "all" only match files uploaded at this time (Unix time) or
+        later. The upload time is only known for the files uploaded by this client
+        :param until: if provided, names, patterns and "all" only match files uploaded before this time (Unix time)
+        :return: IDs of the files, without duplicates. Arguments that do not match any file and are not a pattern
+        are returned as they are, as they may be IDs of files uploaded since the catalog was reconciled
+        """
+        with self._open_catalog() as catalog:
+            # IDs of files uploaded by other users (such as the files received) are never in the catalog, so they do
+            # not make it be reconciled
+            if self._catalog_is_stale(catalog, self.catalog_max_age) and \
+                    any(not catalog.contains(selector) and not FILE_ID_PATTERN.fullmatch(selector)
+                        for selector in selectors):
+                print("Listing uploaded files...")
+                catalog.reconcile(self.api.file_list())
+
+            files_id = []
+            for selector in selectors:
+                if catalog.contains(selector):
+                    files_id.append(selector)
+                    continue
+                matches = catalog.find("*" if selector == "all" else selector, since, until)
+                if matches:
+                    files_id.extend(file["fileID"] for file in matches)
+                elif selector != "all" and not any(char in selector for char in "*?[") and \
+                        not catalog.find(selector):
+                    files_id.append(selector)
+        return list(dict.fromkeys(files_id))
+
+    def list_files(self) -> list:
         print("Listing uploaded files...")
         files = self.api.file_list()
+        with self._open_catalog() as catalog:
+            catalog.reconcile(files)
         if files:
             for file in files:
                 print(f"File ID: {file['fileID']}. File name: {file['fileName']}")
         else:
             print("No files found")
+        return files
 
     def download(self, file_id: str, sender_id: str, private_key: RsaKey):
         self.decrypt_helper(file_id=file_id, sender_id=sender_id, private_key=private_key)
 
-    def delete_files(self, *files_id: str):
+    def download_batch(self, files_id: List[str], sender_id: str, private_key: RsaKey, download_workers: int = 4,
+                       crypto_workers: int = None) -> List[dict]:
+        """
+        Downloads several files at the same time, decrypting and verifying them in a pool of processes
+        :param files_id: IDs of the files to be downloaded. If it contains "all", every file will be downloaded
+        :param sender_id: ID of the user who sent the files. Their public key is fetched only once
+        :param private_key: key used to decrypt the files
+        :param download_workers: number of files downloaded at the same time
+        :param crypto_workers: number of processes decrypting (number of CPUs by default)
+        :return: a list with a dictionary per file, with fields file_id, filename and error (None if it succeeded)
+        """
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
         if "all" in files_id:
-            files_id = [file["fileID"] for file in self.api.file_list()]
-        with ThreadPoolExecutor(max_workers=len(files_id)) as pool:
-            for file_id in files_id:
+            files_id = self.find_files(files_id)
+
+        print(f"Retrieving {sender_id}'s public key...")
+        public_key_der = self.api.user_get_public_key(sender_id).export_key("DER")
+        private_key_der = private_key.export_key("DER")
+
+        if not os.path.exists(SecureBoxClient.received_folder):
+            os.mkdir(SecureBoxClient.received_folder)
+
+        def download_and_decrypt(file_id: str) -> str:
+            # Each thread waits for its file to be decrypted, so there are never more than download_workers
+            # encrypted files waiting on disk
+            stream, filename = self.api.file_download_stream(file_id)
+            with stream:
+                encrypted_filename = _write_temp_file(stream, SecureBoxClient.received_folder, ".crypt")
+            print(f"File {filename} downloaded")
+            crypto_pool.submit(_decrypt_file_worker, encrypted_filename,
+                               SecureBoxClient.received_folder + '/' + filename,
+                               private_key_der, public_key_der).result()
+            return filename
+
+        results = []
+        with ProcessPoolExecutor(max_workers=crypto_workers or os.cpu_count()) as crypto_pool, \
+                ThreadPoolExecutor(max_workers=download_workers) as download_pool:
+            futures = {download_pool.submit(download_and_decrypt, file_id): file_id for file_id in files_id}
+            for future in as_completed(futures):
+                try:
+                    filename = future.result()
+                    print(f"File {filename} decrypted and verified")
+                    results.append({"file_id": futures[future], "filename": filename, "error": None})
+                except Exception as e:
+                    results.append({"file_id": futures[future], "filename": None, "error": e})
+
+        self._print_batch_summary(results, lambda result: f"{result['file_id']}"
+                                                          f"{' -> ' + result['filename'] if result['filename'] else ''}")
+        return results
+
+    def delete_files(self, *files_id: str, max_workers: int = 8, rate: float = 10, retries: int = 3) -> List[dict]:
+        """
+        Deletes several files from the server using a bounded pool of threads. Requests are rate limited, and
+        repeated when they fail due to a transient error
+        :param files_id: IDs of the files to be deleted. If it contains "all", every file will be deleted
+        :param max_workers: maximum number of deletions in flight
+        :param rate: maximum number of deletions per second
+        :param retries: times a deletion is repeated after a transient error
+        :return: a list with a dictionary per file, with fields file_id and error (None if it succeeded)
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        if "all" in files_id:
+            files_id = self.find_files(files_id)
+
+        if self.api.batch_delete_endpoint:
+            print(f"Deleting {len(files_id)} files...")
+            deleted = set(self.api.file_delete_batch(list(files_id))["files_id"])
+            results = [{"file_id": file_id, "error": None if file_id in deleted else IncorrectFileIDException()}
+                       for file_id in files_id]
+            self._forget_files(results)
+            self._print_batch_summary(results, lambda result: result["file_id"])
+            return results
+
+        bucket = TokenBucket(rate)
+
+        def delete(file_id: str):
+            print(f"Deleting file {file_id}...")
+            for attempt in range(retries + 1):
+                bucket.acquire()
+                try:
+                    self.api.file_delete(file_id)
+                    return
+                except IncorrectFileIDException:
+                    # The previous attempt may have deleted the file even if its response was lost
+                    if attempt == 0:
+                        raise
+                    return
+                except self.api.transient_errors:
+                    if attempt == retries:
+                        raise
+                    time.sleep(self.api.backoff * 2 ** attempt)
+
+        results = []
+        # There is no point in having more threads than connections in the pool of the API
+        with ThreadPoolExecutor(max_workers=max(min(len(files_id), max_workers, self.api.pool_size), 1)) as pool:
+            futures = {pool.submit(delete, file_id): file_id for file_id in files_id}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    results.append({"file_id": futures[future], "error": None})
+                except Exception as e:
+                    results.append({"file_id": futures[future], "error": e})
+
+        self._forget_files(results)
+        self._print_batch_summary(results, lambda result: result["file_id"])
+        return results
+
+    def _async_api(self, max_concurrency: int):
+        # aiohttp is only needed by the asynchronous operations, so it is not imported until one of them is used
+        from sb_api.sb_async_api import AsyncAPI
+        return AsyncAPI(self.token, max_concurrency=max_concurrency, key_cache=self.api.key_cache)
+
+    async def upload_batch_async(self, paths: List[str], receiver_ids: List[str], private_key: RsaKey,
+                                 max_concurrency: int = 100, crypto_workers: int = None,
+                                 force: bool = False) -> List[dict]:
+        """
+        Asynchronous version of upload_batch: the files are encrypted in a pool of processes and up to
+        max_concurrency of them are uploaded at the same time from the event loop
+        :return: a list with a dictionary per file and receiver, as in upload_batch
+        """
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+
+        filenames = expand_paths(paths)
+        crypto_workers = crypto_workers or os.cpu_count()
+        loop = asyncio.get_running_loop()
+        # Limit the files that are encrypted but not sent yet, as in upload_batch
+        pending = asyncio.Semaphore(crypto_workers + max_concurrency)
+
+        async with self._async_api(max_concurrency) as api:
+            print(f"Retrieving public keys of {', '.join(receiver_ids)}...")
+            public_keys = await asyncio.gather(*(api.user_get_public_key(receiver_id) for receiver_id in receiver_ids))
+            public_keys_der = {receiver_id: public_key.export_key("DER")
+                               for receiver_id, public_key in zip(receiver_ids, public_keys)}
+            private_key_der = private_key.export_key("DER")
+            catalog_filename = None
+            if not force:
+                with self._open_catalog() as catalog:
+                    if self._catalog_is_stale(catalog, self.dedup_max_age):
+                        catalog.reconcile(await api.file_list())
+                catalog_filename = self.index_filename
+            hashes = {}
+
+            async def upload_encrypted_file(filename: str, file_receiver_ids: Tuple[str, ...],
+                                            encrypted_filename: str) -> List[dict]:
+                try:
+                    with open(encrypted_filename, "rb") as encrypted_file:
+                        file_id = (await api.file_upload(filename, encrypted_file))["file_id"]
+                    print(f"Successfully sent {filename} to {', '.join(file_receiver_ids)}, which got ID {file_id}")
+                    error = None
+                except Exception as e:
+                    file_id = None
+                    error = e
+                finally:
+                    os.remove(encrypted_filename)
+                return [{"filename": filename, "receiver_id": receiver_id, "file_id": file_id, "error": error}
+                        for receiver_id in file_receiver_ids]
+
+            async def send(filename: str) -> List[dict]:
+                async with pending:
+                    try:
+                        hashes[filename], existing, encrypted_filenames = await loop.run_in_executor(
+                            crypto_pool, _encrypt_for_recipients_worker, filename, private_key_der, public_keys_der,
+                            folder, self.cipher, self.compression, catalog_filename)
+                    except Exception as e:
+                        return [{"filename": filename, "receiver_id": receiver_id, "file_id": None, "error": e}
+                                for receiver_id in receiver_ids]
+                    uploads = await asyncio.gather(*(upload_encrypted_file(filename, file_receiver_ids,
+                                                                           encrypted_filename)
+                                                     for file_receiver_ids, encrypted_filename
+                                                     in encrypted_filenames.items()))
+                    return self._deduplicated_results(filename, existing) + \
+                        [result for upload_results in uploads for result in upload_results]
+
+            with tempfile.TemporaryDirectory() as folder, \
+                    ProcessPoolExecutor(max_workers=crypto_workers) as crypto_pool:
+                results = [result for file_results in await asyncio.gather(*(send(filename) for filename in filenames))
+                           for result in file_results]
+
+        self._record_uploads(results, hashes)
+        self._print_batch_summary(results, lambda result: f"{result['filename']} -> {result['receiver_id']}"
+                                                          f"{': ' + result['file_id'] if result['file_id'] else ''}")
+        return results
+
+    async def download_batch_async(self, files_id: List[str], sender_id: str, private_key: RsaKey,
+                                   max_concurrency: int = 100, crypto_workers: int = None) -> List[dict]:
+        """
+        Asynchronous version of download_batch: up to max_concurrency files are downloaded at the same time from
+        the event loop, and decrypted in a pool of processes
+        :return: a list with a dictionary per file, as in download_batch
+        """
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        if not os.path.exists(SecureBoxClient.received_folder):
+            os.mkdir(SecureBoxClient.received_folder)
+
+        async with self._async_api(max_concurrency) as api:
+            if "all" in files_id:
+                files_id = self.find_files(files_id)
+
+            print(f"Retrieving {sender_id}'s public key...")
+            public_key_der = (await api.user_get_public_key(sender_id)).export_key("DER")
+            private_key_der = private_key.export_key("DER")
+
+            async def download_and_decrypt(file_id: str) -> dict:
+                try:
+                    fd, encrypted_filename = tempfile.mkstemp(prefix=".", suffix=".crypt",
+                                                              dir=SecureBoxClient.received_folder)
+                    try:
+                        with os.fdopen(fd, "wb") as encrypted_file:
+                            filename = await api.file_download_to(file_id, encrypted_file)
+                    except BaseException:
+                        os.remove(encrypted_filename)
+                        raise
+                    print(f"File {filename} downloaded")
+                    await loop.run_in_executor(crypto_pool, _decrypt_file_worker, encrypted_filename,
+                                               SecureBoxClient.received_folder + '/' + filename,
+                                               private_key_der, public_key_der)
+                    print(f"File {filename} decrypted and verified")
+                    return {"file_id": file_id, "filename": filename, "error": None}
+                except Exception as e:
+                    return {"file_id": file_id, "filename": None, "error": e}
+
+            with ProcessPoolExecutor(max_workers=crypto_workers or os.cpu_count()) as crypto_pool:
+                results = await asyncio.gather(*(download_and_decrypt(file_id) for file_id in files_id))
+
+        self._print_batch_summary(results, lambda result: f"{result['file_id']}"
+                                                          f"{' -> ' + result['filename'] if result['filename'] else ''}")
+        return results
+
+    async def delete_files_async(self, *files_id: str, max_concurrency: int = 100, rate: float = 10,
+                                 retries: int = 3) -> List[dict]:
+        """
+        Asynchronous version of delete_files, with up to max_concurrency deletions in flight
+        :return: a list with a dictionary per file, with fields file_id and error (None if it succeeded)
+        """
+        import asyncio
+
+        bucket = TokenBucket(rate)
+
+        async with self._async_api(max_concurrency) as api:
+            if "all" in files_id:
+                files_id = self.find_files(files_id)
+
+            async def delete(file_id: str) -> dict:
                 print(f"Deleting file {file_id}...")
-                pool.submit(self.api.file_delete, file_id)
+                for attempt in range(retries + 1):
+                    await asyncio.sleep(bucket.reserve())
+                    try:
+                        await api.file_delete(file_id)
+                        return {"file_id": file_id, "error": None}
+                    except IncorrectFileIDException as e:
+                        # The previous attempt may have deleted the file even if its response was lost
+                        return {"file_id": file_id, "error": e if attempt == 0 else None}
+                    except api.transient_errors as e:
+                        if attempt == retries:
+                            return {"file_id": file_id, "error": e}
+                        await asyncio.sleep(api.backoff * 2 ** attempt)
+                    except Exception as e:
+                        return {"file_id": file_id, "error": e}
+
+            results = await asyncio.gather(*(delete(file_id) for file_id in files_id))
 
-    def encrypt_helper(self, filename: str, private_key: RsaKey = None, receiver_id: str = None,
+        self._forget_files(results)
+        self._print_batch_summary(results, lambda result: result["file_id"])
+        return results
+
+    def encrypt_helper(self, filename: str, private_key: RsaKey = None, receiver_id: Union[str, List[str]] = None,
                        to_disk: bool = False) -> bytes:
         """
-        This method performs several actions to a file
+        This method performs several actions to a file. The file is processed in chunks, so when the result is
+        saved to disk memory usage does not depend on the size of the file
         :param filename: name of the file to be read
         :param private_key: if provided, the file will be signed digitally
-        :param receiver_id: if provided, the file will be encrypted
+        :param receiver_id: if provided, the file will be encrypted. In the framed format (if cipher was provided),
+        it can be a list of IDs to encrypt the file once for all of them
         :param to_disk: if true, the resulting message (signed and/or encrypted) will be saved to a file
-        :return: the resulting message, which will be signed and/or encrypted
+        :return: the resulting message, which will be signed and/or encrypted, if to_disk is false. None otherwise
         """
-        with open(filename, "rb") as f:
-            print(f"Opening file {filename}...")
-            message = f.read()
-
-            # Sign the message using our private key if provided
-            if private_key:
-                print("Signing file...")
-                signature = sign_message(message, private_key)
-                message = signature + message
-
-            # Encrypt the message using the remote public key if provided
-            if receiver_id:
-                print(f"Retrieving {receiver_id}'s public key...")
-                public_key = self.api.user_get_public_key(receiver_id)
-                print("Encrypting file...")
-                message = encrypt_message(message, public_key)
-
-            # Save the file to disk if requested
-            if to_disk:
-                output_filename = filename
-                if private_key:
-                    output_filename += ".signed"
-                if receiver_id:
-                    output_filename += ".crypt"
+        public_key = None
+        if isinstance(receiver_id, list):
+            print(f"Retrieving public keys of {', '.join(receiver_id)}...")
+            public_key = [self.api.user_get_public_key(user_id) for user_id in receiver_id]
+        elif receiver_id:
+            print(f"Retrieving {receiver_id}'s public key...")
+            public_key = self.api.user_get_public_key(receiver_id)
 
-                print(f"Saving file {output_filename} to disk")
-                with open(output_filename, "wb") as output_file:
-                    output_file.write(message)
+        print(f"Opening file {filename}...")
+        if private_key:
+            print("Signing file...")
+        if public_key:
+            print("Encrypting file...")
 
-            return message
+        # Save the file to disk if requested
+        if to_disk:
+            output_filename = encrypted_filename(filename, bool(private_key), bool(receiver_id))
+            print(f"Saving file {output_filename} to disk")
+            encrypt_local_file(filename, output_filename, private_key, public_key, self.cipher, self.compression)
+        else:
+            output = BytesIO()
+            encrypt_file(filename, output, private_key, public_key, self.cipher, compression=self.compression)
+            return output.getvalue()
 
     def decrypt_helper(self, filename: str = None, file_id: str = None, sender_id: str = None,
                        private_key: RsaKey = None) -> None:
         # Avoid "referenced before assignment" warnings
-        message = bytes()
         output_filename = ""
         public_key = []
         thread = None
@@ -120,14 +1409,9 @@ class SecureBoxClient:
         # Get mode
         if filename:
             # Local mode (the file could be encrypted and/or signed)
-            with open(filename, "rb") as file:
-                message = file.read()
-
-            output_filename = filename.replace(".crypt", "")
-            output_filename = output_filename.replace(".signed", "")
+            output_filename = decrypted_filename(os.path.basename(filename))
 
-            encrypted = ".crypt" in filename
-            signed = ".signed" in filename
+            signed, encrypted = message_extensions(filename)
         elif file_id:
             # SecureBox mode (the file is encrypted and signed)
             encrypted = True
@@ -137,28 +1421,187 @@ class SecureBoxClient:
             return
 
         if signed:
-            # Fetch the public key in parallel for maximum performance
-            thread = Thread(target=lambda: public_key.append(self.api.user_get_public_key(sender_id)))
+            # Fetch the public key in parallel for maximum performance. Any error is raised once it is needed
+            def fetch_public_key():
+                try:
+                    public_key.append(self.api.user_get_public_key(sender_id))
+                except Exception as e:
+                    public_key.append(e)
+
+            thread = Thread(target=fetch_public_key)
             thread.start()
 
+        stream = None
         if file_id:
-            # Fetch the file from the SecureBox server
-            message, output_filename = self.api.file_download(file_id)
-            print(f"File {output_filename} downloaded")
+            # Fetch the file from the SecureBox server. It is received in a background thread while it is being
+            # decrypted, so the download and the decryption overlap
+            stream, output_filename = self.api.file_download_stream(file_id)
+            chunks = prefetch(stream)
+            print(f"Downloading file {output_filename}...")
+
+        # The download is closed even if it fails before it starts being read, so its connection is given back to
+        # the pool
+        try:
+            if signed:
+                thread.join()
+                public_key = public_key[0]
+                if isinstance(public_key, Exception):
+                    raise public_key
+            else:
+                public_key = None
+
+            if not os.path.exists(SecureBoxClient.received_folder):
+                os.mkdir(SecureBoxClient.received_folder)
+            print(f"Writing file to {SecureBoxClient.received_folder}/{output_filename}...")
+            if file_id:
+                decrypt_file(chunks, SecureBoxClient.received_folder + '/' + output_filename, private_key,
+                             public_key)
+            else:
+                decrypt_local_file(filename, SecureBoxClient.received_folder + '/' + output_filename,
+                                   private_key if encrypted else None, public_key)
+        except SignatureNotAuthentic:
+            # The sender may have changed their key since it was cached, so it is fetched again next time
+            self.api.key_cache.invalidate(sender_id)
+            raise
+        finally:
+            if stream is not None:
+                chunks.close()
+                stream.close()
 
         if encrypted:
-            message = decrypt_message(message, private_key)
             print(f"File {output_filename} decrypted")
-
         if signed:
-            thread.join()
-            public_key = public_key[0]
-            message = verify_signature(message, public_key)
             print(f"File {output_filename} successfully verified")
 
-        if not os.path.exists(SecureBoxClient.received_folder):
-            os.mkdir(SecureBoxClient.received_folder)
-        print(f"Writing file to {SecureBoxClient.received_folder}/{output_filename}...")
-        with open(SecureBoxClient.received_folder + '/' + output_filename, "wb") as file:
-            file.write(message)
+    def encrypt_batch(self, paths: List[str], private_key: RsaKey = None, receiver_id: Union[str, List[str]] = None,
+                      crypto_workers: int = None) -> List[dict]:
+        """
+        Signs and/or encrypts several files, saving each resulting message next to its file as encrypt_helper does
+        with to_disk. The files are processed in a pool of processes, and the public keys are retrieved only once.
+        Files that already have the .signed or .crypt extension (messages created before) are skipped
+        :param paths: files, directories (all the files inside them will be processed) and/or glob patterns
+        :param private_key: if provided, the files will be signed digitally
+        :param receiver_id: if provided, the files will be encrypted. In the framed format (if cipher was provided),
+        it can be a list of IDs to encrypt each file once for all of them
+        :param crypto_workers: number of processes signing and encrypting (number of CPUs by default)
+        :return: a list with a dictionary per file, with fields filename, output (the name of the message) and error
+        (None if it succeeded)
+        """
+        public_key_der = None
+        if isinstance(receiver_id, list):
+            print(f"Retrieving public keys of {', '.join(receiver_id)}...")
+            public_key_der = [self.api.user_get_public_key(user_id).export_key("DER") for user_id in receiver_id]
+        elif receiver_id:
+            print(f"Retrieving {receiver_id}'s public key...")
+            public_key_der = self.api.user_get_public_key(receiver_id).export_key("DER")
+        private_key_der = private_key.export_key("DER") if private_key else None
+
+        filenames = expand_paths(paths)
+        # The messages created by a previous run are not signed or encrypted again
+        messages = [filename for filename in filenames if any(message_extensions(filename))]
+        if messages:
+            print(f"Skipped {len(messages)} files with the .signed or .crypt extension")
+        tasks = [(filename, encrypted_filename(filename, bool(private_key), bool(receiver_id)),
+                  (private_key_der, public_key_der, self.cipher, self.compression))
+                 for filename in filenames if not any(message_extensions(filename))]
+        results = self._run_local_batch(tasks, _encrypt_local_file_worker, crypto_workers)
+        self._print_batch_summary(results, lambda result: f"{result['filename']} -> {result['output']}")
+        return results
+
+    def decrypt_batch(self, paths: List[str], private_key: RsaKey = None, sender_id: str = None,
+                      crypto_workers: int = None) -> List[dict]:
+        """
+        Decrypts and/or verifies several files in a pool of processes, as decrypt_helper does with local files.
+        Whether each file is encrypted and/or signed is told by its extensions (files with neither .signed nor
+        .crypt at the end of their name are skipped). The original files are saved in the received folder, keeping
+        the directories they were found in, and the public key of the sender is retrieved only once
+        :param paths: files, directories (all the files inside them will be processed) and/or glob patterns
+        :param private_key: key used to decrypt the encrypted files
+        :param sender_id: ID of the user who signed the files. Signed files cannot be processed without it
+        :param crypto_workers: number of processes decrypting and verifying (number of CPUs by default)
+        :return: a list with a dictionary per file, with fields filename, output (the name of the original file) and
+        error (None if it succeeded)
+        """
+        public_key_der = None
+        if sender_id:
+            print(f"Retrieving {sender_id}'s public key...")
+            public_key_der = self.api.user_get_public_key(sender_id).export_key("DER")
+        private_key_der = private_key.export_key("DER") if private_key else None
+
+        results = []
+        tasks = []
+        skipped = 0
+        output_filenames = set()
+        for filename, relative_name in walk_paths(paths):
+            signed, encrypted = message_extensions(filename)
+            if not signed and not encrypted:
+                # Files that are neither signed nor encrypted (such as the originals of the messages next to them)
+                # would just be copied
+                skipped += 1
+                continue
+            output_filename = os.path.join(SecureBoxClient.received_folder, decrypted_filename(relative_name))
+            if signed and not public_key_der:
+                error = ValueError("The file is signed, but no sender was given to verify it")
+            elif output_filename in output_filenames:
+                error = ValueError(f"Another file is being saved to {output_filename}")
+            else:
+                error = None
+            if error:
+                results.append({"filename": filename, "output": None, "error": error})
+                continue
+            output_filenames.add(output_filename)
+            os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+            tasks.append((filename, output_filename,
+                          (private_key_der if encrypted else None, public_key_der if signed else None)))
+
+        if skipped:
+            print(f"Skipped {skipped} files without the .signed or .crypt extension")
+        results.extend(self._run_local_batch(tasks, _decrypt_local_file_worker, crypto_workers))
+        if any(isinstance(result["error"], SignatureNotAuthentic) for result in results):
+            # The sender may have changed their key since it was cached, so it is fetched again next time
+            self.api.key_cache.invalidate(sender_id)
+        self._print_batch_summary(results, lambda result: f"{result['filename']}"
+                                                          f"{' -> ' + result['output'] if result['output'] else ''}")
+        return results
+
+    @staticmethod
+    def _run_local_batch(tasks: List[Tuple[str, str, tuple]], worker: Callable, crypto_workers: int = None) \
+            -> List[dict]:
+        """
+        Runs worker(filename, output_filename, *args) for every task in a pool of processes
+        :param tasks: list of tuples with the filename, output_filename and the rest of the arguments of each call
+        :param worker: function run in the processes, which raises an exception if it fails
+        :param crypto_workers: number of processes (number of CPUs by default)
+        :return: a list with a dictionary per task, with fields filename, output and error (None if it succeeded).
+        output is None when the task fails
+        """
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        crypto_workers = crypto_workers or os.cpu_count()
+        results = []
+        # Only a few tasks per process are submitted at a time, so that a large batch does not create all its
+        # futures (and pickled arguments) upfront
+        max_pending = 2 * crypto_workers
+        with ProcessPoolExecutor(max_workers=crypto_workers) as crypto_pool:
+            pending_tasks = iter(tasks)
+            futures = {}
+            while True:
+                while len(futures) < max_pending:
+                    task = next(pending_tasks, None)
+                    if task is None:
+                        break
+                    filename, output_filename, args = task
+                    futures[crypto_pool.submit(worker, filename, output_filename, *args)] = task
+
+                if not futures:
+                    break
 
+                done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+                for future in done:
+                    filename, output_filename, _ = futures.pop(future)
+                    try:
+                        future.result()
+                        results.append({"filename": filename, "output": output_filename, "error": None})
+                    except Exception as e:
+                        results.append({"filename": filename, "output": None, "error": e})
+        return results